@@ -4,15 +4,19 @@ Created on Dec 13, 2013
 @author: space
 '''
 import argparse
+import bisect
 import logging
+import multiprocessing
 import random
 import itertools as it
 import functools as ft
-from lsh import LSHCache, XORHashFamily, MultiplyHashFamily, Shingler
+from collections import Counter
+from lsh import LSHCache, XORHashFamily, MultiplyHashFamily, OnePermutationHashFamily, Shingler
 from nltk.metrics.distance import jaccard_distance, masi_distance, edit_distance
 
 minhash_choices = { 'xor': XORHashFamily,
                     'multiply': MultiplyHashFamily,
+                    'one-permutation': OnePermutationHashFamily,
                   }
 
 similarity_choices = { 'jaccard': lambda a,b,s: 1 - jaccard_distance(set(s.shingle(a)), set(s.shingle(b))),
@@ -39,6 +43,10 @@ def parse_args(argv=None):
                            help="""minimum support of bands in LSH cache for match""")
     lsh_group.add_argument("--minhash",
                            choices=minhash_choices.keys())
+    lsh_group.add_argument("--engine", choices=('python', 'numpy'),
+                           help="""how minhash signatures are computed""")
+    lsh_group.add_argument("--sig-bits", type=int, choices=(1, 2, 4, 8),
+                           help="""number of bits per row of b-bit minhash signatures""")
     lsh_group.add_argument("-u", "--universe-size", type=int,
                            help="""size of the shingle universe"""),
     lsh_group.add_argument("--shingle-len", default=[], nargs='*', type=int,
@@ -63,6 +71,8 @@ def parse_args(argv=None):
     doc_group.add_argument("-s", "--similarity",  default='jaccard',
                            choices=similarity_choices.keys(),
                            help='''similarity algorithm to use to measure distance between documents.  Defaults to %(default)s''')
+    parser.add_argument('--workers', type=int,
+                        help='''number of worker processes computing the jaccard similarities of the documents''')
     parser.add_argument('--sim-cuts', default=10, type=int,
                         help='''cuts of similarity range [0-1] in which to report counts of real similar and lsh similar objects''')
     parser.add_argument('--log', default='info',
@@ -89,7 +99,7 @@ def lsh_cache_from_args(args):
     kwargs = {"shingler": Shingler(*args.shingle_len) }
     if args.minhash:
         kwargs['minhash'] = minhash_choices[args.minhash]
-    for arg_key, kwarg_key in (('num_total','n'),('num_bands','b'),('num_rows','r'),('min_support','m'),('universe_size',)*2):
+    for arg_key, kwarg_key in (('num_total','n'),('num_bands','b'),('num_rows','r'),('min_support','m'),('universe_size',)*2,('engine',)*2,('sig_bits',)*2):
         value = getattr(args, arg_key)
         if value:
             kwargs[kwarg_key] = value
@@ -123,35 +133,122 @@ def similar_from_args(args):
     logging.info("calculating similarity with %s", args.similarity)
     return similarity_choices[args.similarity]
 
+# the shingle sets, inverted index and number of similarity cuts of the worker processes
+_ground_truth = None
+
+def _init_ground_truth(ground_truth):
+    global _ground_truth
+    _ground_truth = ground_truth
+
+def _jaccard_chunk((start, end, lsh_dups)):
+    """
+    the distributions of the jaccard similarity of each of the documents start to end with every
+    earlier document, and of those of them found by lsh
+    """
+    shingle_sets, index, sim_cuts = _ground_truth
+    total_distribution = [0]*(sim_cuts+1)
+    lsh_distribution = [0]*(sim_cuts+1)
+    for ndx, lsh_similar in it.izip(xrange(start, end), lsh_dups):
+        shingles = shingle_sets[ndx]
+        # only the earlier documents sharing a shingle have any intersection
+        overlaps = Counter()
+        for shingle in shingles:
+            postings = index[shingle]
+            overlaps.update(postings[:bisect.bisect_left(postings, ndx)])
+        for o_ndx, intersection in overlaps.iteritems():
+            union = len(shingles) + len(shingle_sets[o_ndx]) - intersection
+            sim_ndx = int(sim_cuts*(1 - float(union - intersection)/union))
+            total_distribution[sim_ndx] += 1
+            if o_ndx in lsh_similar:
+                lsh_distribution[sim_ndx] += 1
+        # and the rest have none
+        total_distribution[0] += ndx - len(overlaps)
+        lsh_distribution[0] += sum(1 for o_ndx in lsh_similar if o_ndx not in overlaps)
+    return total_distribution, lsh_distribution
+
+def jaccard_distributions(docs, lsh_dups, shingler, sim_cuts, workers=None, chunk_size=1000):
+    """
+    the distributions of the jaccard similarity of every pair of docs, and of those found by
+    lsh (lsh_dups holding the earlier documents found for each document).  Each document is
+    shingled once into an inverted index of the documents of each shingle, so that only the pairs
+    sharing a shingle are compared.  With more than one worker, the documents are compared in
+    chunks in a pool of worker processes.
+    """
+    shingle_sets = [set(shingler.shingle(doc)) for doc in docs]
+    index = {}
+    for ndx, shingles in enumerate(shingle_sets):
+        for shingle in shingles:
+            index.setdefault(shingle, []).append(ndx)
+    logging.info("indexed %d documents by %d shingles", len(docs), len(index))
+
+    ground_truth = (shingle_sets, index, sim_cuts)
+    chunks = [(start, min(start + chunk_size, len(docs)), lsh_dups[start:start + chunk_size])
+              for start in xrange(0, len(docs), chunk_size)]
+    if workers is not None and workers > 1:
+        pool = multiprocessing.Pool(workers, _init_ground_truth, (ground_truth,))
+        try:
+            results = pool.map(_jaccard_chunk, chunks)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        _init_ground_truth(ground_truth)
+        results = map(_jaccard_chunk, chunks)
+
+    total_distribution = [0]*(sim_cuts+1)
+    lsh_distribution = [0]*(sim_cuts+1)
+    for chunk_total, chunk_lsh in results:
+        total_distribution = map(sum, zip(total_distribution, chunk_total))
+        lsh_distribution = map(sum, zip(lsh_distribution, chunk_lsh))
+    return total_distribution, lsh_distribution
+
+def pairwise_distributions(docs, lsh_dups, shingler, calc_similar, sim_cuts):
+    """
+    the distributions of the similarity of every pair of docs, and of those found by lsh,
+    comparing each document with every earlier one with calc_similar
+    """
+    total_distribution = [0]*(sim_cuts+1)
+    lsh_distribution = [0]*(sim_cuts+1)
+    for ndx, (doc, lsh_similar) in enumerate(it.izip(docs, lsh_dups)):
+        if ndx and ndx % 100 == 0:
+            logging.info("compared %d documents, %d comparisons", ndx, sum(total_distribution))
+        for o_ndx in xrange(ndx):
+            sim_ndx = int(sim_cuts*calc_similar(doc, docs[o_ndx], shingler))
+            total_distribution[sim_ndx] += 1
+            if o_ndx in lsh_similar:
+                lsh_distribution[sim_ndx] += 1
+    return total_distribution, lsh_distribution
+
 def main(argv=None):
     args = parse_args()
     cache = lsh_cache_from_args(args)
     gen_doc = doc_generator_from_args(args)
     calc_similar = similar_from_args(args)
     
-    total_distribution = [0]*(args.sim_cuts+1)
-    lsh_distribution = [0]*(args.sim_cuts+1)
     docs = []
+    lsh_dups = []
     
     seed_from_args(args)
     try:
         for ndx, doc in enumerate(gen_doc()):
             if args.num_docs and ndx == args.num_docs:
                 break
-            if ndx and ndx % 100 == 0:
-                logging.info("processed %d documents, %d comparisons", ndx, sum(total_distribution))
+            if ndx and ndx % 1000 == 0:
+                logging.info("inserted %d documents", ndx)
             docs.append(doc)
             logging.debug("%d: %s", ndx, doc)
-            lsh_similar = cache.insert(doc)
-            for o_ndx in xrange(ndx):
-                sim_ndx = int(args.sim_cuts*calc_similar(doc, docs[o_ndx], cache.shingler()))
-                total_distribution[sim_ndx] += 1
-                if o_ndx in lsh_similar:
-                    lsh_distribution[sim_ndx] += 1
+            lsh_dups.append(cache.insert(doc))
         else:
             logging.info('done!')
     except KeyboardInterrupt:
-        logging.warn("Received keyboard interrupt.  Stopping generation and comparisons of documents")
+        logging.warn("Received keyboard interrupt.  Stopping generation of documents")
+
+    if args.similarity == 'jaccard':
+        total_distribution, lsh_distribution = jaccard_distributions(
+            docs, lsh_dups, cache.shingler(), args.sim_cuts, args.workers)
+    else:
+        total_distribution, lsh_distribution = pairwise_distributions(
+            docs, lsh_dups, cache.shingler(), calc_similar, args.sim_cuts)
     
     logging.info('processed %d documents, %d comparisons', len(docs), sum(total_distribution))
 
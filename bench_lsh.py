@@ -0,0 +1,297 @@
+'''
+Benchmarks of the speed and memory use of LSHCache.
+
+Runs every combination of the given scenario parameters (corpus size, document length, shingle
+length, hash family, bands/rows/minimum support, signature engine and band table) over a
+generated corpus and reports, for each,
+    insert_docs_per_sec:        documents inserted per second one at a time with insert
+    insert_batch_docs_per_sec:  documents inserted per second with insert_batch
+    get_dups_p50_ms,
+    get_dups_p99_ms:            the median and 99th percentile latency of get_dups
+    bytes_per_doc:              the memory held by the band tables and seen doc_ids per document
+The results can be saved as json (--output) and two saved runs compared (--compare), flagging
+the metrics of any scenario which got worse by more than a tolerance, e.g.,
+
+    $ python bench_lsh.py --num-docs 10000 --bands 20x5 10x10x2 --output before.json
+    $ python bench_lsh.py --num-docs 10000 --bands 20x5 10x10x2 --output after.json
+    $ python bench_lsh.py --compare before.json after.json
+'''
+import argparse
+import json
+import logging
+import platform
+import random
+import sys
+import time
+import itertools as it
+from array import array
+from timeit import default_timer as timer
+
+from lsh import LSHCache, XORHashFamily, MultiplyHashFamily, OnePermutationHashFamily, Shingler, \
+    DictBandTable, CompactBandTable
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+minhash_choices = { 'xor': XORHashFamily,
+                    'multiply': MultiplyHashFamily,
+                    'one-permutation': OnePermutationHashFamily,
+                  }
+
+band_table_choices = { 'dict': DictBandTable,
+                       'compact': CompactBandTable,
+                     }
+
+# whether a larger value of each metric is better
+metric_directions = { 'insert_docs_per_sec': True,
+                      'insert_batch_docs_per_sec': True,
+                      'get_dups_p50_ms': False,
+                      'get_dups_p99_ms': False,
+                      'bytes_per_doc': False,
+                    }
+
+def parse_bands(spec):
+    '''
+    parse bands given as BxR or BxRxM
+    '''
+    try:
+        values = map(int, spec.split('x'))
+    except ValueError:
+        values = []
+    if len(values) not in (2, 3):
+        raise argparse.ArgumentTypeError("bands must be given as BxR or BxRxM, not %r" % spec)
+    return tuple(values) if len(values) == 3 else tuple(values) + (1,)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the speed and memory use of LSH caches")
+
+    scenario_group = parser.add_argument_group('Scenario parameters (every combination is run)')
+    scenario_group.add_argument("-d", "--num-docs", type=int, nargs='+', default=[10000],
+                                help='''number of documents in the corpus.  Defaults to %(default)s''')
+    scenario_group.add_argument("--doc-len", type=int, nargs='+', default=[100],
+                                help='''number of tokens of each document.  Defaults to %(default)s''')
+    scenario_group.add_argument("--shingle-len", type=int, nargs='+', default=[2],
+                                help='''length of shingles.  Defaults to %(default)s''')
+    scenario_group.add_argument("--minhash", nargs='+', default=['multiply'],
+                                choices=sorted(minhash_choices.keys()),
+                                help='''hash family.  Defaults to %(default)s''')
+    scenario_group.add_argument("--bands", type=parse_bands, nargs='+', default=[(20, 5, 1)],
+                                help='''bands, rows per band and (optionally) minimum support as BxR or BxRxM.  Defaults to 20x5''')
+    scenario_group.add_argument("--engine", nargs='+', default=['python'], choices=('python', 'numpy'),
+                                help='''signature engine.  Defaults to %(default)s''')
+    scenario_group.add_argument("--band-table", nargs='+', default=['dict'],
+                                choices=sorted(band_table_choices.keys()),
+                                help='''band table.  Defaults to %(default)s''')
+
+    run_group = parser.add_argument_group('Run parameters')
+    run_group.add_argument("-t", "--num-tokens", type=int, default=10000,
+                           help='''number of distinct tokens in the corpus.  Defaults to %(default)s''')
+    run_group.add_argument("--dup-fraction", type=float, default=0.1,
+                           help='''fraction of documents which are near duplicates of an earlier one.  Defaults to %(default)s''')
+    run_group.add_argument("-q", "--queries", type=int, default=1000,
+                           help='''number of get_dups calls timed.  Defaults to %(default)s''')
+    run_group.add_argument("--chunk-size", type=int, default=1000,
+                           help='''chunk size of insert_batch.  Defaults to %(default)s''')
+    run_group.add_argument("--repeat", type=int, default=1,
+                           help='''number of runs of each scenario, reporting the median of each metric.  Defaults to %(default)s''')
+    run_group.add_argument("--seed", type=long, default=12345,
+                           help='''seed of the generated corpus and of the hash families.  Defaults to %(default)s''')
+    run_group.add_argument("-o", "--output",
+                           help='''file to save the results to as json''')
+
+    compare_group = parser.add_argument_group('Comparison of saved results')
+    compare_group.add_argument("--compare", nargs=2, metavar=('BASELINE', 'RESULTS'),
+                               help='''compare two saved results rather than running benchmarks''')
+    compare_group.add_argument("--tolerance", type=float, default=0.1,
+                               help='''relative change of a metric above which it is a regression.  Defaults to %(default)s''')
+
+    parser.add_argument('--log', default='info',
+                        choices=('debug','info','warning','error','critical'),
+                        help='level of logging to capture')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=getattr(logging, args.log.upper()),
+                        datefmt='%H:%M:%S', format='[%(asctime)s] %(levelname)s %(message)s')
+    return args
+
+def scenarios_from_args(args):
+    for num_docs, doc_len, shingle_len, minhash, (b, r, m), engine, band_table in it.product(
+            args.num_docs, args.doc_len, args.shingle_len, args.minhash, args.bands, args.engine,
+            args.band_table):
+        yield {'num_docs': num_docs, 'doc_len': doc_len, 'shingle_len': shingle_len,
+               'minhash': minhash, 'b': b, 'r': r, 'm': m, 'engine': engine,
+               'band_table': band_table}
+
+def scenario_name(scenario):
+    return ("%(num_docs)d docs of %(doc_len)d, shingle %(shingle_len)d, %(minhash)s, %(b)dx%(r)dx%(m)d, %(engine)s, %(band_table)s" % scenario)
+
+def scenario_key(scenario):
+    return json.dumps(scenario, sort_keys=True)
+
+def generate_corpus(num_docs, doc_len, num_tokens, dup_fraction, seed):
+    '''
+    generate num_docs documents of doc_len random tokens, dup_fraction of which are copies of an
+    earlier document with a tenth of their tokens replaced
+    '''
+    rand = random.Random(seed)
+    docs = []
+    for i in xrange(num_docs):
+        if docs and rand.random() < dup_fraction:
+            doc = list(docs[rand.randrange(len(docs))])
+            for j in rand.sample(xrange(doc_len), doc_len // 10):
+                doc[j] = rand.randrange(num_tokens)
+        else:
+            doc = [rand.randrange(num_tokens) for _ in xrange(doc_len)]
+        docs.append(doc)
+    return docs
+
+def deep_sizeof(obj):
+    '''
+    the number of bytes held by obj and everything it refers to (each object counted once)
+    '''
+    seen = set()
+    total = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        if np is not None and isinstance(obj, np.ndarray):
+            total += obj.nbytes + sys.getsizeof(np.empty(0))
+            continue
+        total += sys.getsizeof(obj)
+        if isinstance(obj, (basestring, int, long, float, array)):
+            continue
+        if isinstance(obj, dict):
+            stack.extend(obj.iterkeys())
+            stack.extend(obj.itervalues())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        if hasattr(obj, '__dict__'):
+            stack.append(obj.__dict__)
+    return total
+
+def percentile(values, pct):
+    '''
+    the nearest rank percentile of a sorted list of values
+    '''
+    return values[min(len(values) - 1, int(pct / 100.0 * len(values)))]
+
+def make_cache(scenario, seed):
+    random.seed(seed)
+    return LSHCache(b=scenario['b'], r=scenario['r'], m=scenario['m'],
+                    shingler=Shingler(scenario['shingle_len']),
+                    minhash=minhash_choices[scenario['minhash']], engine=scenario['engine'],
+                    band_table=band_table_choices[scenario['band_table']])
+
+def run_scenario(scenario, args):
+    docs = generate_corpus(scenario['num_docs'], scenario['doc_len'], args.num_tokens,
+                           args.dup_fraction, args.seed)
+    metrics = {}
+
+    cache = make_cache(scenario, args.seed)
+    start = timer()
+    for doc in docs:
+        cache.insert(doc)
+    metrics['insert_docs_per_sec'] = len(docs) / (timer() - start)
+
+    cache = make_cache(scenario, args.seed)
+    start = timer()
+    cache.insert_batch(docs, chunk_size=args.chunk_size)
+    metrics['insert_batch_docs_per_sec'] = len(docs) / (timer() - start)
+
+    rand = random.Random(args.seed)
+    latencies = []
+    for _ in xrange(args.queries):
+        doc = docs[rand.randrange(len(docs))]
+        start = timer()
+        cache.get_dups(doc)
+        latencies.append(timer() - start)
+    latencies.sort()
+    metrics['get_dups_p50_ms'] = percentile(latencies, 50) * 1000
+    metrics['get_dups_p99_ms'] = percentile(latencies, 99) * 1000
+
+    metrics['bytes_per_doc'] = float(deep_sizeof(cache._storage)) / cache.num_docs()
+    return metrics
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2] if len(values) % 2 else (values[len(values) // 2 - 1] + values[len(values) // 2]) / 2.0
+
+def run(args):
+    results = []
+    for scenario in scenarios_from_args(args):
+        logging.info("running %s", scenario_key(scenario))
+        runs = [run_scenario(scenario, args) for _ in xrange(args.repeat)]
+        metrics = dict((name, median([run[name] for run in runs])) for name in runs[0])
+        logging.info("%s", json.dumps(metrics, sort_keys=True))
+        results.append({'scenario': scenario, 'metrics': metrics})
+    return {
+        'meta': {'time': time.time(), 'python': platform.python_version(),
+                 'numpy': np.__version__ if np is not None else None,
+                 'platform': platform.platform(), 'seed': args.seed,
+                 'num_tokens': args.num_tokens, 'dup_fraction': args.dup_fraction,
+                 'queries': args.queries, 'chunk_size': args.chunk_size, 'repeat': args.repeat},
+        'results': results,
+    }
+
+def compare(baseline, results, tolerance):
+    '''
+    compare the metrics of the scenarios of two runs.  Returns a list of
+    (scenario, metric, baseline value, value, relative change, regressed) of the scenarios in both
+    '''
+    baseline = dict((scenario_key(result['scenario']), result['metrics']) for result in baseline['results'])
+    rows = []
+    for result in results['results']:
+        key = scenario_key(result['scenario'])
+        if key not in baseline:
+            logging.warning("scenario %s is not in the baseline", key)
+            continue
+        for name, value in sorted(result['metrics'].iteritems()):
+            base = baseline[key].get(name)
+            if base is None:
+                continue
+            change = (value - base) / base if base else 0.0
+            worse = -change if metric_directions.get(name, True) else change
+            rows.append((result['scenario'], name, base, value, change, worse > tolerance))
+    return rows
+
+def print_results(results):
+    print ("| %-60s " + "| %14s " * len(metric_directions) + '|') % (("Scenario",) + tuple(sorted(metric_directions)))
+    for result in results['results']:
+        name = scenario_name(result['scenario'])
+        print ("| %-60s " + "| %14.3f " * len(metric_directions) + '|') % \
+            ((name,) + tuple(result['metrics'][metric] for metric in sorted(metric_directions)))
+
+def print_comparison(rows):
+    print "| %-60s | %-25s | %12s | %12s | %8s |" % ("Scenario", "Metric", "Baseline", "Results", "Change")
+    for scenario, name, base, value, change, regressed in rows:
+        print "| %-60s | %-25s | %12.3f | %12.3f | %+7.1f%% |%s" % \
+            (scenario_name(scenario), name, base, value, change * 100, " REGRESSION" if regressed else "")
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.compare:
+        with open(args.compare[0]) as f:
+            baseline = json.load(f)
+        with open(args.compare[1]) as f:
+            results = json.load(f)
+        rows = compare(baseline, results, args.tolerance)
+        print_comparison(rows)
+        regressions = sum(1 for row in rows if row[-1])
+        if regressions:
+            logging.error("%d metrics regressed by more than %.0f%%", regressions, args.tolerance * 100)
+        return 1 if regressions else 0
+
+    results = run(args)
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
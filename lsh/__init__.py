@@ -1,15 +1,64 @@
-from collections import defaultdict, Counter
+from collections import Counter
 import itertools as it
 import functools as ft
 import random
 import sys
 import logging
-from math import sqrt, factorial, fsum
+import multiprocessing
+import time
+from collections import deque, OrderedDict
+from math import sqrt, fsum, lgamma, log, log1p, exp
 import inspect
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from lsh import instrument as _instrument
+from lsh import persist
+from lsh.bands import DictBandTable, CompactBandTable
+from lsh.storage import IStorage, MemoryStorage
+from lsh.signatures import SignatureStore, BITS, pack_bits
+from lsh.hashing import _MASK64, _mix64, _mix64_array, stable_hash, band_hashes, band_hash_matrix, \
+    TokenHashes, window_hashes
+
 
 logging.getLogger().setLevel(logging.INFO)
 
+# with the numpy engine, buckets with fewer postings in all than this are reduced as sets, and
+# doc_ids are counted with a bincount if the largest is less than this many times the postings
+_ARRAY_REDUCE_MIN = 512
+_ARRAY_REDUCE_DENSITY = 64
+# the parameters (see LSHCache.params) which must be the same for caches to be merged
+_HASH_PARAMS = ('b', 'r', 'n', 'universe_size', 'sig_bits', 'shingler', 'shingle_hash', 'minhash')
+
+
+class _NotLogged(object):
+    """
+    the context of a change of a cache without a write-ahead log (see lsh.wal)
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NOT_LOGGED = _NotLogged()
+
+
+def _int_array(xs):
+    """
+    convert a sequence of integers into a 1-d numpy array.  64-bit integers are used
+    if all the values fit, otherwise arbitrary precision (object) integers are used
+    """
+    try:
+        return np.asarray(xs, dtype=np.int64)
+    except OverflowError:
+        return np.asarray(xs, dtype=object)
+
 
 class Shingler(object):
     """
@@ -76,24 +125,138 @@ class Shingler(object):
                 for j in xrange(len(doc) - (n - 1)):
                     yield tuple(doc[j:j + n])
 
+    def _padded(self, token_hashes, n, pad):
+        """
+        the token hashes of a document padded with the hash of None to n tokens, as shingle pads it
+        """
+        return token_hashes if len(token_hashes) >= n else [pad] * (n - len(token_hashes)) + token_hashes
+
+    def shingle_hashes(self, token_hashes, pad):
+        """
+        returns a list of the stable_hash of each of the shingles that shingle yields, given the
+        hashes of the tokens of the document (see lsh.hashing.TokenHashes) and pad, the hash of None
+        """
+        hashes = []
+        for n in xrange(self._begin_shingle, self._end_shingle):
+            hashes.extend(window_hashes(self._padded(token_hashes, n, pad), n))
+        return hashes
+
     def __str__(self):
         return \
             ("Shingler(len %d<=%d)" if self.is_multi_shingler() else "Shingler(len %d)") \
             % self.shingle_len()
 
 
+class RollingShingler(Shingler):
+    """
+    A shingler that yields integer shingle ids rather than tuples of tokens.  Each token is mapped
+    to an integer id once (and remembered), then the ids of the shingles are computed with a
+    rolling polynomial hash over the token ids, so no tuple is built for any shingle.  The shingle
+    length is mixed into each id so shingles of different lengths get different ids.  As with
+    Shingler, documents shorter than the shingle length are padded (with token id 0).
+
+    The ids are non-negative 63-bit integers, so they can be used with LSHCache as a drop-in
+    replacement for Shingler.  With numpy, shingle_array computes the same ids vectorized.
+    """
+    _BASE = 0x100000001b3
+
+    def __init__(self, shingle_len=2, max_shingle=None):
+        Shingler.__init__(self, shingle_len, max_shingle)
+        self._token_ids = {}
+
+    def __getstate__(self):
+        # the remembered token ids are only a cache
+        state = dict(self.__dict__)
+        del state['_token_ids']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._token_ids = {}
+
+    def token_id(self, token):
+        """
+        return the integer id of the token
+        """
+        token_id = self._token_ids.get(token)
+        if token_id is None:
+            token_id = self._token_ids[token] = _mix64(stable_hash(token)) | 1
+        return token_id
+
+    @staticmethod
+    def _finish(h, n):
+        # mix in the shingle length and scramble with a (bijective) odd multiply
+        return ((h ^ (n * 0x9E3779B97F4A7C15 & _MASK64)) * 0xbf58476d1ce4e5b9 & _MASK64) >> 1
+
+    def shingle(self, doc):
+        """
+        Takes a document (a list of tokens) and yields the integer id of each of its shingles
+        """
+        ids = map(self.token_id, doc)
+        base, finish = self._BASE, self._finish
+        for n in xrange(self._begin_shingle, self._end_shingle):
+            if len(ids) < n:
+                # leading padding ids are 0, so they do not change the hash
+                h = 0
+                for token_id in ids:
+                    h = (h * base + token_id) & _MASK64
+                yield finish(h, n)
+                continue
+            top = pow(base, n - 1, 1 << 64)
+            h = 0
+            for token_id in ids[:n - 1]:
+                h = (h * base + token_id) & _MASK64
+            for old_id, token_id in it.izip(ids, ids[n - 1:]):
+                h = (h * base + token_id) & _MASK64
+                yield finish(h, n)
+                h = (h - old_id * top) & _MASK64
+
+    def shingle_array(self, doc):
+        """
+        returns the same shingle ids as shingle, as a numpy array of int64, computed with
+        vectorized operations over the token ids
+        """
+        ids = np.fromiter(it.imap(self.token_id, doc), dtype=np.uint64, count=len(doc))
+        shingles = []
+        for n in xrange(self._begin_shingle, self._end_shingle):
+            window = max(len(ids) - n + 1, 1)
+            padded = ids if len(ids) >= n else np.concatenate([np.zeros(n - len(ids), np.uint64), ids])
+            h = np.zeros(window, dtype=np.uint64)
+            for k in xrange(n):
+                h = h * np.uint64(self._BASE) + padded[k:k + window]
+            h = (h ^ np.uint64(n * 0x9E3779B97F4A7C15 & _MASK64)) * np.uint64(0xbf58476d1ce4e5b9)
+            shingles.append(h >> np.uint64(1))
+        return np.concatenate(shingles).astype(np.int64)
+
+    def __str__(self):
+        return \
+            ("RollingShingler(len %d<=%d)" if self.is_multi_shingler() else "RollingShingler(len %d)") \
+            % self.shingle_len()
+
+
+def _random(seed=None):
+    """
+    the source of the random parameters of a hash family: the random module, or a generator
+    of its own if seeded
+    """
+    return random if seed is None else random.Random(seed)
+
+
 class IHashFamily(object):
     """
     An interface for a hash family provider.  It provides a series of random hashes
     from a universal hash family.  This can then be used for minhashing.
     """
 
-    def __init__(self, num_hashes, num_buckets):
+    def __init__(self, num_hashes, num_buckets, seed=None):
         """
         Initialize the hash family by indicating how many hashes are needed.
         Also indicate the number of buckets that will be hashed to (if that is necessary
         for choosing parameters).  The hash function is not required to return values less
         than num_buckets (They will be modulo'd afterwards).
+        If seed is given, the random parameters of the family are drawn from a generator seeded
+        with it (rather than the random module), so families created with the same arguments
+        are identical.
         """
         pass
 
@@ -104,6 +267,15 @@ class IHashFamily(object):
         """
         raise NotImplementedError()
 
+    def hash_array(self, xs):
+        """
+        return a 2-d numpy array of shape (len(xs), n) whose row i holds the n hashes
+        of xs[i] (the same values, in the same order, as hashn(xs[i])).
+        The default simply stacks the results of hashn.  Implementations should override
+        this with a vectorized version where they can.
+        """
+        return np.array([list(self.hashn(x)) for x in xs], dtype=object).reshape(len(xs), -1)
+
 
 class XORHashFamily(IHashFamily):
     """
@@ -111,11 +283,12 @@ class XORHashFamily(IHashFamily):
     xor'd with the value (It assumes that the value is an integer)
     """
 
-    def __init__(self, num_hashes, num_buckets):
+    def __init__(self, num_hashes, num_buckets, seed=None):
         """
         Initialize a random number of 32-bit fields for xoring
         """
-        self._memomask = [int(random.getrandbits(32)) for _ in xrange(num_hashes)]
+        rand = _random(seed)
+        self._memomask = [int(rand.getrandbits(32)) for _ in xrange(num_hashes)]
 
     def _xor_hash(self, x, mask):
         """
@@ -133,6 +306,14 @@ class XORHashFamily(IHashFamily):
         x = x & 0xffffffff
         return it.imap(lambda mask: self._xor_hash(x, mask), self._memomask)
 
+    def hash_array(self, xs):
+        """
+        vectorized version of hashn over a sequence of values
+        """
+        xs = np.asarray(_int_array(xs) & 0xffffffff, dtype=np.int64)
+        masks = np.array(self._memomask, dtype=np.int64)
+        return xs[:, np.newaxis] ^ masks[np.newaxis, :]
+
 
 class MultiplyHashFamily(IHashFamily):
     """
@@ -143,11 +324,12 @@ class MultiplyHashFamily(IHashFamily):
     and implemented in java (http://blogs.msdn.com/b/spt/archive/2008/06/10/set-similarity-and-min-hash.aspx)
     """
 
-    def __init__(self, num_hashes, num_buckets):
+    def __init__(self, num_hashes, num_buckets, seed=None):
         """
         Initialize a set of 3 random integers < num_buckets for each hash
         """
-        self._params = [[random.randint(1, num_buckets) for _ in xrange(3)] for _ in
+        rand = _random(seed)
+        self._params = [[rand.randint(1, num_buckets) for _ in xrange(3)] for _ in
             xrange(num_hashes)]
 
     def _mult_hash(self, x, params):
@@ -156,6 +338,141 @@ class MultiplyHashFamily(IHashFamily):
     def hashn(self, x):
         return it.imap(lambda params: self._mult_hash(x, params), self._params)
 
+    def hash_array(self, xs):
+        """
+        vectorized version of hashn over a sequence of values.  The hashes are computed
+        with 64-bit integers when the result is guaranteed to fit and fall back to
+        arbitrary precision (object) arrays otherwise, so the values always match hashn
+        """
+        xs = _int_array(xs)
+        params = np.array(self._params, dtype=object).reshape(-1, 3)
+        if xs.dtype != object and len(xs) and len(params):
+            xmax = max(-int(xs.min()), int(xs.max()))
+            if int(params.max()) * (2 * xmax + 1) < 2 ** 63:
+                params = params.astype(np.int64)
+        if params.dtype == object:
+            xs = xs.astype(object)
+        xs = xs[:, np.newaxis]
+        return (xs >> 4) * params[:, 0] + xs * params[:, 1] + params[:, 2]
+
+
+class ISignatureFamily(object):
+    """
+    An interface for a family of signature functions which compute the whole n-row signature of
+    a set of values at once (e.g., OnePermutationHashFamily), rather than the n hashes of each
+    value of an IHashFamily which LSHCache then minhashes.
+    """
+
+    def __init__(self, num_hashes, num_buckets, seed=None):
+        """
+        Initialize the family of signatures of num_hashes rows, as IHashFamily
+        """
+        pass
+
+    def signature(self, xs):
+        """
+        return the n-row signature (a list) of the set of values xs
+        """
+        raise NotImplementedError()
+
+    def signature_matrix(self, xs, lengths):
+        """
+        return the (len(lengths) x n) numpy matrix of the signatures of several sets of values
+        laid out one after the other in xs, lengths[i] being the number of values of set i.
+        The default stacks the results of signature.  Implementations should override this with
+        a vectorized version where they can.
+        """
+        starts = np.cumsum(lengths) - lengths
+        return np.array([self.signature(xs[start:start + length]) for start, length in zip(starts, lengths)],
+                        dtype=np.int64).reshape(len(lengths), -1)
+
+
+class OnePermutationHashFamily(ISignatureFamily):
+    """
+    One permutation hashing with optimal densification (Shrivastava, "Optimal Densification for
+    Fast and Accurate Minwise Hashing", 2017).  Rather than evaluating n hash functions for each
+    shingle, each shingle is hashed once, (a * x + b) mod p, and the hash is split into one of n
+    bins and a value.  The signature holds the minimum value of each bin.  Each empty bin is then
+    filled with the value of a non-empty bin, chosen by probing the bins with a hash of the empty
+    bin's index and the attempt number, which is the same for every document.
+
+    As with minhashing, two documents agree on each row of their signatures with probability
+    equal to their Jaccard similarity, so the banding (and theoretical_percent_found) of an
+    LSHCache are unchanged, while computing a signature costs O(|doc| + n) rather than
+    O(|doc| x n).
+    """
+    _PRIME = (1 << 31) - 1
+
+    def __init__(self, num_hashes, num_buckets, seed=None):
+        rand = _random(seed)
+        self._n = num_hashes
+        self._a = rand.randint(1, self._PRIME - 1)
+        self._b = rand.randint(0, self._PRIME - 1)
+        self._seed = rand.getrandbits(64)
+
+    def _probe(self, i, attempt):
+        """
+        the bin to copy into the empty bin i on the given attempt
+        """
+        return _mix64((self._seed + i * 0x9E3779B97F4A7C15 + attempt * 0xC2B2AE3D27D4EB4F) & _MASK64) \
+            % self._n
+
+    def _densify(self, sig):
+        """
+        fill the empty bins of sig (holding sys.maxint) in place
+        """
+        empty = [i for i, h in enumerate(sig) if h == sys.maxint]
+        if len(empty) == self._n:
+            return sig
+        filled = list(sig)
+        for i in empty:
+            attempt = 1
+            while filled[self._probe(i, attempt)] == sys.maxint:
+                attempt += 1
+            sig[i] = filled[self._probe(i, attempt)]
+        return sig
+
+    def signature(self, xs):
+        """
+        return the densified one permutation signature of the set of values xs
+        """
+        sig = [sys.maxint] * self._n
+        for x in xs:
+            h = (self._a * (x % self._PRIME) + self._b) % self._PRIME
+            i, value = h % self._n, h // self._n
+            if value < sig[i]:
+                sig[i] = value
+        return self._densify(sig)
+
+    def signature_matrix(self, xs, lengths):
+        """
+        return the (len(lengths) x n) matrix of the signatures of several sets of values laid
+        out one after the other in xs, lengths[i] being the number of values of set i
+        """
+        xs = _int_array(xs) % self._PRIME
+        h = (self._a * xs.astype(np.int64) + self._b) % self._PRIME
+        rows = np.repeat(np.arange(len(lengths)), lengths)
+        sigs = np.empty((len(lengths), self._n), dtype=np.int64)
+        sigs.fill(sys.maxint)
+        np.minimum.at(sigs, (rows, h % self._n), h // self._n)
+
+        empty = sigs == sys.maxint
+        # documents without any values stay empty
+        empty[empty.all(axis=1)] = False
+        rows, bins = np.nonzero(empty)
+        filled = sigs.copy()
+        attempt = 1
+        while len(rows):
+            probes = _mix64_array((np.uint64(self._seed) + bins.astype(np.uint64) *
+                                   np.uint64(0x9E3779B97F4A7C15) +
+                                   np.uint64(attempt * 0xC2B2AE3D27D4EB4F & _MASK64))) % np.uint64(self._n)
+            values = filled[rows, probes.astype(np.int64)]
+            found = values != sys.maxint
+            sigs[rows[found], bins[found]] = values[found]
+            rows, bins = rows[~found], bins[~found]
+            attempt += 1
+        return sigs
+
 
 class LSHCache:
     """
@@ -173,12 +490,15 @@ class LSHCache:
     Override _minhash_hash and _minhash_init in order to change how minhashes are calculated
     
     Override _hash_shingle in order to change how shingles are hashed. The default behavior
-    is to simply hash each tuple.  Another approach would be to keep a cache mapping each shingle
-    seen to a unique id and return that.
+    is to stably hash each tuple (see lsh.hashing).  Another approach would be to keep a cache
+    mapping each shingle seen to a unique id and return that.
     """
 
-    def __init__(self, b=None, r=None, n=None, m=1, shingler=Shingler(2), shingle_hash=hash,
-        universe_size=131071, minhash=MultiplyHashFamily, store_signatures=False):
+    def __init__(self, b=None, r=None, n=None, m=1, shingler=Shingler(2), shingle_hash=stable_hash,
+        universe_size=131071, minhash=MultiplyHashFamily, store_signatures=False, engine='python',
+        band_table=DictBandTable, storage=None, store_minhashes=False, max_docs=None, max_age=None,
+        sig_bits=None, instrument=False, max_bucket_size=None, stop_bucket_policy='skip',
+        stop_bucket_sample=100, seed=None):
         """
         An implementation of Locality-Sensitive Hashing (LSH) using minhash
         
@@ -198,7 +518,9 @@ class LSHCache:
             
         You may also specify how a document is shingled and how that shingle is hashed.  Those arguments are:
             shingler: an instance of Shingler (has the method shingle(doc) that returns an iteration)
-            shingle_hash: how to hash the shingles returned by the shingler.  Defaults to built-in hash
+            shingle_hash: how to hash the shingles returned by the shingler.  Defaults to
+                          lsh.hashing.stable_hash, which (unlike the built-in hash) gives the same
+                          shingle ids in every process
 
         You may also specify what method is used for minhashing.  
             universe_size:  size of token universe.  If you know the number of possible tokens
@@ -206,8 +528,10 @@ class LSHCache:
                             a random permutation of rows in a num_tokens x num_rows matrix.  
                             If it is not known, it is better to leave as a prime number for better 
                             hash performance.  Defaults to 131071
-            minhash:        class that implements IHashFamily interface or a method that takes a single
-                            argument and returns a sequence of n hashes
+            minhash:        class that implements IHashFamily interface (or an instance of one) or a method
+                            that takes a single argument and returns a sequence of n hashes, or a
+                            class implementing ISignatureFamily (or an instance of one), computing
+                            whole signatures (e.g., OnePermutationHashFamily)
 
         Finally, there are a few additional optional arguments.
             store_signatures: whether to store the generated signatures.  This allows later lookups to
@@ -216,6 +540,50 @@ class LSHCache:
             dups_on_insert:   whether to return the duplicates found in the cache when a new document is
                               inserted.  If False, it returns the generated doc_id for the inserted document.
                               By default, True
+            engine:           how minhash signatures are computed.  'python' (the default) hashes each
+                              shingle in turn.  'numpy' computes the whole signature as a single
+                              vectorized (shingles x n) hash-then-min reduction.  It requires numpy and
+                              gives identical signatures to 'python' for the same hash family
+            band_table:       class used for the hash table of each band (see lsh.bands).  Defaults to
+                              DictBandTable, a dict of lists.  CompactBandTable holds the same buckets in
+                              typed arrays using several times less memory
+            storage:          where the band buckets and seen doc_ids are kept, an instance of IStorage
+                              (see lsh.storage).  Defaults to a MemoryStorage of band_table tables.  Pass
+                              e.g. a lsh.redis_storage.RedisStorage to share an index between processes
+                              or a lsh.sharding.ShardedStorage to spread its bands across processes
+            store_minhashes:  whether to keep the full minhash signature of each document in a dense
+                              (doc_id x n) array of 32-bit integers (see lsh.signatures).  This allows
+                              ranking duplicates by their estimated Jaccard similarity with
+                              get_ranked_dups.  It requires numpy, non-negative doc_ids (the array is
+                              as long as the largest doc_id) and a universe_size of at most 2**32-1.
+                              By default, minhash signatures are not stored
+            max_docs:         if given, the cache holds at most this many documents, evicting the oldest
+                              inserted documents to make room for new ones
+            max_age:          if given, documents are evicted once they have been in the cache for this
+                              many seconds.  Bounded caches (with max_docs or max_age) always store
+                              signatures so that documents can be evicted
+            sig_bits:         if given (1, 2, 4 or 8), signatures are b-bit minhash signatures holding
+                              only the lowest sig_bits bits of each row.  Stored minhashes (and those
+                              sent back by the worker processes of insert_batch) are then packed
+                              8 / sig_bits rows to a byte, 4 to 32 times smaller than 32-bit rows.
+                              Rows of dissimilar documents agree by chance with probability
+                              2**-sig_bits, which get_ranked_dups and theoretical_percent_found
+                              account for.  As each band can only take 2**(r * sig_bits) values,
+                              use more rows per band than with full signatures
+            instrument:       whether to time each stage of hashing and looking up documents and count
+                              the candidate duplicates found (see lsh.instrument and stats).  When
+                              False (the default), nothing is timed and nothing is wrapped
+            max_bucket_size:  if given, a bucket holding this many doc_ids is a stop bucket: it takes
+                              no more postings (until documents are removed from it) and is skipped
+                              or sampled when looking up duplicates, bounding the cost of documents
+                              falling into very common buckets (e.g., boilerplate or very short
+                              documents).  Stop bucket events are counted and reported by stats
+            stop_bucket_policy: 'skip' (the default) to leave stop buckets out of lookups, or 'sample'
+                              to use every k-th of their doc_ids, at most stop_bucket_sample of them
+            seed:             if given, seeds the hash family created from the minhash class, so that
+                              caches created (e.g., in other processes) with the same arguments and
+                              seed hash documents identically and can be merged (see merge and
+                              from_params).  By default, it is drawn from the random module
         """
 
         # default to 20 bands of 5 rows         
@@ -249,8 +617,26 @@ class LSHCache:
             "building LSH cache with %d total rows (%d matching of %d bands, %d rows per band) with %s and hashing with %s",
             m, n, b, r, shingler, minhash)
 
+        assert not store_minhashes or universe_size < 2 ** 32, "universe_size is too large to store minhashes"
+        assert sig_bits is None or sig_bits in BITS, "sig_bits must be one of %s" % (BITS,)
+        assert engine in ('python', 'numpy'), "engine must be 'python' or 'numpy', not %r" % engine
+        if engine == 'numpy' and np is None:
+            raise ImportError("numpy is required for the numpy signature engine")
+
+        assert seed is None or inspect.isclass(minhash), "seed requires minhash to be a hash family class"
+        hash_family = None
         if inspect.isclass(minhash):
-            minhash = minhash(n, universe_size).hashn
+            assert issubclass(minhash, (IHashFamily, ISignatureFamily)), \
+                "minhash must be an IHashFamily or an ISignatureFamily class, not %r" % minhash
+            hash_family = minhash(n, universe_size) if seed is None else minhash(n, universe_size, seed=seed)
+        elif isinstance(minhash, (IHashFamily, ISignatureFamily)):
+            hash_family = minhash
+        # signature families compute whole signatures rather than the hashes of each shingle
+        self._signature_family = isinstance(hash_family, ISignatureFamily)
+        if isinstance(hash_family, IHashFamily):
+            minhash = hash_family.hashn
+        elif self._signature_family:
+            minhash = None
 
         # assign it
         self._b = b
@@ -260,19 +646,62 @@ class LSHCache:
         if m <= 1:
             self._reduce = self._reduce_sets
         else:
-            self._reduce = ft.partial(self._reduce_sets_by_min, min_support=m)
+            self._reduce = ft.partial(self._reduce_arrays_by_min if engine == 'numpy' else self._reduce_sets_by_min,
+                                      min_support=m)
+        if engine == 'numpy':
+            self._get_sig = self._get_sig_numpy
+        elif self._signature_family:
+            self._get_sig = self._get_sig_from_family
 
         self._shingler = shingler
+        # shinglers yielding integer ids can compute them vectorized for the numpy engine
+        self._shingle_array = engine == 'numpy' and shingle_hash in (hash, stable_hash) and \
+            hasattr(shingler, 'shingle_array')
         self._shingle_hash = shingle_hash
+        # the shingles of Shingler are hashed by stable_hash from the hashes of their tokens, which
+        # are each computed once
+        self._token_hashes = TokenHashes() if shingle_hash is stable_hash and type(shingler) is Shingler \
+            else None
         self._minhash = minhash
+        self._hash_family = hash_family
+        self._engine = engine
         self._universe_size = universe_size
-        self._store_signatures = store_signatures
-
-        # make it 
-        self.clear()
+        self._store_signatures = store_signatures or bool(max_docs or max_age)
+        self._band_table = band_table
+        self._storage = storage if storage is not None else MemoryStorage(band_table)
+        self._sig_bits = sig_bits
+        self._minhashes = SignatureStore(n, bits=sig_bits) if store_minhashes else None
+        assert max_docs is None or max_docs > 0, "max_docs must be positive"
+        assert max_age is None or max_age > 0, "max_age must be positive"
+        assert max_bucket_size is None or max_bucket_size > 0, "max_bucket_size must be positive"
+        assert stop_bucket_policy in ('skip', 'sample'), \
+            "stop_bucket_policy must be 'skip' or 'sample', not %r" % stop_bucket_policy
+        assert stop_bucket_sample > 0, "stop_bucket_sample must be positive"
+        self._max_bucket_size = max_bucket_size
+        self._stop_bucket_policy = stop_bucket_policy
+        self._stop_bucket_sample = stop_bucket_sample
+        # counts of the postings left out of, and the lookups skipping or sampling, stop buckets
+        self._stop_bucket_events = Counter()
+        self._max_docs = max_docs
+        self._max_age = max_age
+        self._clock = time.time
+        # insertion time of each doc_id, oldest first (only for bounded caches)
+        self._insert_times = OrderedDict() if max_docs or max_age else None
+
+        # the write-ahead log of the changes to the cache, if any (see lsh.wal)
+        self._wal = None
+
+        self._instruments = None
+        if instrument:
+            self._instruments = _instrument.Instruments()
+            self._instruments.instrument(self)
+
+        # make it (keeping anything already in a shared storage)
+        self._next_id = 0
+        self._storage.open(self._b)
 
     def _hash_shingle(self, shingle):
-        return hash(shingle)
+        return stable_hash(shingle)
 
     def _get_shingle_vec(self, doc):
         """
@@ -280,6 +709,12 @@ class LSHCache:
         These unique ids, are then added to the shingle_vec object which is just a sparse
         vector implemented as a dict with v[id]=1 when a shingle id is present
         """
+        if self._shingle_array:
+            return np.unique(self._shingler.shingle_array(doc) % self._universe_size)
+        if self._token_hashes is not None:
+            hashes = self._shingler.shingle_hashes(self._token_hashes.hashes(doc), self._token_hashes[None])
+            universe_size = self._universe_size
+            return set([h % universe_size for h in hashes])
         return set(it.imap(lambda shingle: self._shingle_hash(shingle) % self._universe_size,
             self._shingler.shingle(doc)))
 
@@ -299,76 +734,245 @@ class LSHCache:
                     mhash[i] = h
         return mhash
 
+    def _hash_array(self, shingles):
+        """
+        Returns the (len(shingles) x n) matrix of minhash hashes of each shingle, using the
+        vectorized implementation of the hash family if there is one
+        """
+        if self._hash_family is not None:
+            return self._hash_family.hash_array(shingles)
+        return np.array([list(self._minhash(shingle)) for shingle in shingles],
+            dtype=object).reshape(len(shingles), -1)
+
+    def _get_sig_from_family(self, shingle_vec):
+        """
+        Computes the signature with the signature family (see ISignatureFamily), which
+        computes the whole signature itself
+        """
+        return self._hash_family.signature(shingle_vec)
+
+    def _get_sig_numpy(self, shingle_vec):
+        """
+        Computes the same minhash signature as _get_sig, but as a single vectorized
+        hash-then-min reduction over the (shingles x n) matrix of hashes
+        """
+        if self._signature_family:
+            return self._get_sigs_numpy([shingle_vec])[0].tolist()
+        if not len(shingle_vec):
+            return [sys.maxint] * self._n
+        hashes = self._hash_array(_int_array(list(shingle_vec))) % self._universe_size
+        return hashes.min(axis=0).tolist()
+
     def _get_lsh(self, sig):
         """
         Takes an n-dimensional minhash signature and computes b hashes for each of
-        b bands of r rows in the signature.  These hashes can take on any value that
-        can be stored in the 32bit integer.
+        b bands of r rows in the signature.  These hashes are stable (see lsh.hashing)
+        non-negative 63-bit integers.
         """
-        lsh = [None] * self._b
-        for i in xrange(self._b):
-            lsh[i] = hash(tuple(sig[self._r * i:self._r * (i + 1)]))
+        return band_hashes(sig, self._b, self._r)
 
-        # logging.debug('hashed signature: %s\n[get_lsh]\tto bins: %s', (sig,lsh)
-        return lsh
+    def _get_lshs(self, sigs):
+        """
+        the LSH vectors of a matrix of minhash signatures, hashing the bands of all of them at once
+        with the numpy engine
+        """
+        if self._engine != 'numpy':
+            return map(self._get_lsh, sigs)
+        return band_hash_matrix(sigs, self._b, self._r).tolist()
+
+    def _get_sig_from_doc(self, doc):
+        """
+        given an iterable of hashable items, returns its n-dimensional minhash signature
+        """
+        shingle_vec = self._get_shingle_vec(doc)
+        sig = self._get_sig(shingle_vec)
+        if self._sig_bits is not None:
+            mask = (1 << self._sig_bits) - 1
+            sig = [h & mask for h in sig]
+        return sig
 
     def _get_lsh_from_doc(self, doc):
         """
         given an iterable of hashable items, returns a list of bucket ids
         """
-        shingle_vec = self._get_shingle_vec(doc)
-        sig = self._get_sig(shingle_vec)  # n-dimensional min-hash signiture
+        sig = self._get_sig_from_doc(doc)  # n-dimensional min-hash signiture
         lsh = self._get_lsh(sig)  # r-dimensional list of bucket ids
         return lsh
 
-    def _insert_lsh(self, lsh, doc_id):
+    def _get_sigs_numpy(self, shingle_vecs):
+        """
+        Computes the (len(shingle_vecs) x n) matrix of minhash signatures of several documents
+        in one pass.  The shingles of all the documents are laid out as one ragged array,
+        hashed as a single (shingles x n) matrix and then min-reduced per document.
+        """
+        lengths = np.fromiter(it.imap(len, shingle_vecs), dtype=np.int64, count=len(shingle_vecs))
+        if self._shingle_array:
+            shingles = np.concatenate(shingle_vecs) if shingle_vecs else np.empty(0, np.int64)
+        else:
+            shingles = list(it.chain.from_iterable(shingle_vecs))
+        if self._signature_family:
+            return self._hash_family.signature_matrix(shingles, lengths)
+        hashes = self._hash_array(shingles) % self._universe_size
+        sigs = np.empty((len(shingle_vecs), self._n), dtype=hashes.dtype)
+        nonempty = lengths > 0
+        sigs[~nonempty] = sys.maxint
+        if nonempty.any():
+            starts = (np.cumsum(lengths) - lengths)[nonempty]
+            sigs[nonempty] = np.minimum.reduceat(hashes, starts, axis=0)
+        return sigs
+
+    def _get_sigs_from_docs(self, docs):
+        """
+        given a sequence of documents, returns a list of the minhash signature of each document.
+        With the numpy engine, the signatures of all the documents are computed as a single matrix,
+        which is returned as a numpy array.
+        """
+        if self._engine != 'numpy':
+            return map(self._get_sig_from_doc, docs)
+        sigs = self._get_sigs_numpy(map(self._get_shingle_vec, docs))
+        if self._sig_bits is not None:
+            sigs &= (1 << self._sig_bits) - 1
+        return sigs
+
+    def _get_lsh_from_docs(self, docs):
+        """
+        given a sequence of documents, returns the minhash signatures of the documents (or None
+        if minhash signatures are not stored) and a list of the bucket ids of each document.
+        b-bit signatures are returned packed, as strings of bytes (see SignatureStore).
+        """
+        sigs = self._get_sigs_from_docs(docs)
+        lshs = self._get_lshs(sigs)
+        if self._minhashes is None:
+            return None, lshs
+        if self._sig_bits is not None:
+            return [row.tostring() for row in pack_bits(sigs, self._sig_bits)], lshs
+        return sigs if self._engine != 'numpy' else sigs.tolist(), lshs
+
+    def _insert_lsh(self, lsh, doc_id, sig=None):
         """
         Given an LSH vector of bucket indices, this method inserts the current doc
-        id in the corresponding bucket for each of the _b tables
+        id in the corresponding bucket for each of the _b tables.  sig, the minhash
+        signature of the document, is required if minhash signatures are stored.
+        """
+        assert not self._storage.has_doc(doc_id), "Document with doc_id %d has already been inserted" % doc_id
+        if self._insert_times is not None:
+            self._evict(self._max_docs - 1 if self._max_docs else None)
+        with self._wal.log_insert(doc_id, lsh, sig if self._minhashes is not None else None) \
+                if self._wal is not None else _NOT_LOGGED:
+            # reduce the buckets before inserting into them so doc_id is not its own duplicate
+            buckets = self._storage.get_buckets(lsh)
+            dups = self._reduce(self._limit_buckets(buckets) if self._max_bucket_size is not None else buckets)
+            self._store_lsh(lsh, doc_id, sig, buckets)
+        return dups
+
+    def _store_lsh(self, lsh, doc_id, sig=None, buckets=None):
+        """
+        insert doc_id into the buckets of the LSH vector (given the current buckets if the size
+        of buckets is limited) and record its minhash signature and insertion time
         """
-        assert doc_id not in self._seen, "Document with doc_id %d has already been inserted" % doc_id
-        self._seen[doc_id] = lsh if self._store_signatures else None
+        stored = lsh if self._store_signatures else None
+        if self._max_bucket_size is not None:
+            if buckets is None:
+                buckets = self._storage.get_buckets(lsh)
+            lsh = [None if len(bucket) >= self._max_bucket_size else band_bucket
+                   for band_bucket, bucket in it.izip(lsh, buckets)]
+            self._stop_bucket_events['postings_dropped'] += lsh.count(None)
+        # first, as a shared storage refuses a doc_id another cache has just inserted
+        self._storage.insert(lsh, doc_id, stored)
+        if self._insert_times is not None:
+            self._insert_times[doc_id] = self._clock()
+        if self._minhashes is not None:
+            self._minhashes[doc_id] = sig
         if doc_id >= self._next_id:
             self._next_id = doc_id + 1
-        return self._reduce(self._insert_lsh_generator(lsh, doc_id))
 
-    def _insert_lsh_generator(self, lsh, doc_id):
+    def _limit_buckets(self, buckets):
+        """
+        skip or sample the stop buckets (those holding max_bucket_size doc_ids) of buckets
+        """
+        limited = []
+        for bucket in buckets:
+            if len(bucket) >= self._max_bucket_size:
+                if self._stop_bucket_policy == 'skip':
+                    self._stop_bucket_events['buckets_skipped'] += 1
+                    bucket = ()
+                else:
+                    self._stop_bucket_events['buckets_sampled'] += 1
+                    bucket = bucket[::-(-len(bucket) // self._stop_bucket_sample)]
+            limited.append(bucket)
+        return limited
+
+    def _evict(self, max_docs=None):
         """
-        Inserts the doc_id across all the band hashtables by its portion of lsh.  This is to
-        be used with _insert_lsh as it modifies the structure yielding the current contents
-        of each of those bands as it adds the doc_id.
+        evict the documents older than max_age and then the oldest documents until there are
+        at most max_docs left
         """
-        for i, band_bucket in enumerate(lsh):
-            arr = self._cache[i][band_bucket]
-            yield arr
-            arr.append(doc_id)
+        if self._max_age is not None:
+            expired = self._clock() - self._max_age
+            while self._insert_times and next(self._insert_times.itervalues()) <= expired:
+                self.remove(next(self._insert_times.iterkeys()))
+        if max_docs is not None:
+            while self._insert_times and len(self._insert_times) > max_docs:
+                self.remove(next(self._insert_times.iterkeys()))
 
     @staticmethod
     def _reduce_sets(sets):
         """
-        Reduce a set of sequences into the intersection of all the sets.
+        Reduce a set of sequences into the union of all the sets.
         This handles the degenerative case where minimum_support is 1
         """
-        return reduce(set.union, sets, set())
+        return set().union(*sets)
 
     @staticmethod
     def _reduce_sets_by_min(sets, min_support):
         """
         Reduce a set of sequences and return a set of objects occurring at least
         min times across the set.
-        """
 
-        def counter_union(c, s):
-            c.update(s)
-            return c
+        levels[k] holds the objects seen in at least k + 1 of the sequences so far, so each
+        sequence costs a few set intersections rather than counting each of its objects.  Once
+        the remaining sequences cannot lift an object of a level to min_support, that level is
+        no longer kept, and if no level that can is left, nothing can reach min_support.
+        """
+        if min_support <= 1:
+            return set().union(*sets)
+        levels = [set() for _ in xrange(min_support)]
+        num_sets = len(sets)
+        for i, bucket in enumerate(sets):
+            # the lowest level whose objects can still reach min_support with this and the
+            # remaining sequences
+            lowest = max(0, min_support - (num_sets - i) - 1)
+            if lowest:
+                levels[lowest - 1] = set()
+                if not any(levels[lowest:]):
+                    return set()
+            if not len(bucket):
+                continue
+            bucket = set(bucket)
+            for k in xrange(min_support - 1, lowest, -1):
+                if levels[k - 1]:
+                    levels[k] |= levels[k - 1] & bucket
+            if lowest == 0:
+                levels[0] |= bucket
+        return levels[-1]
 
-        counts = reduce(counter_union, sets, Counter())
-        return set(
-            it.imap(
-                lambda (item, _): item,
-                it.ifilter(lambda (_, count): count >= min_support, counts.iteritems())
-            )
-        )
+    @staticmethod
+    def _reduce_arrays_by_min(sets, min_support):
+        """
+        like _reduce_sets_by_min, counting the doc_ids of all the sequences at once as a numpy
+        array, with a bincount for ids which are dense compared to the number of postings and
+        unique otherwise.  Few postings are cheaper to reduce as sets.
+        """
+        num_postings = sum(it.imap(len, sets))
+        if num_postings < _ARRAY_REDUCE_MIN:
+            return LSHCache._reduce_sets_by_min(sets, min_support)
+        doc_ids = np.concatenate([np.asarray(bucket, dtype=np.int64) for bucket in sets if len(bucket)])
+        if 0 <= doc_ids.min() and doc_ids.max() < _ARRAY_REDUCE_DENSITY * num_postings:
+            dups = np.flatnonzero(np.bincount(doc_ids) >= min_support)
+        else:
+            unique, counts = np.unique(doc_ids, return_counts=True)
+            dups = unique[counts >= min_support]
+        return set(dups.tolist())
 
         # public methods
 
@@ -378,55 +982,413 @@ class LSHCache:
         of any matching documents.  If the cache was built in chronological order
         then buckets are also in chronological order
         """
-        if (doc):
-            lsh = self._get_lsh_from_doc(doc)
-        else:
-            assert self._store_signatures, "must store signatures if doc is not specified"
-            assert doc_id is not None, "must specify doc or doc_id"
-            lsh = self._seen[doc_id]
-        for i, band_bucket in enumerate(lsh):
-            yield self._cache[i][band_bucket]
+        return self._get_lsh_buckets(self._get_doc_lsh(doc, doc_id))
 
-    def get_dups(self, doc, doc_id=None):
+    def _get_doc_lsh(self, doc, doc_id=None):
+        """
+        returns the LSH vector of the document, or, if no document is given, the stored
+        LSH vector of doc_id
+        """
+        if (doc):
+            return self._get_lsh_from_doc(doc)
+        assert self._store_signatures, "must store signatures if doc is not specified"
+        assert doc_id is not None, "must specify doc or doc_id"
+        return self._storage.get_doc(doc_id)
 
-        buckets = self.get_dup_buckets(doc, doc_id)
-        all_buckets = self._reduce(buckets)
+    def _get_lsh_buckets(self, lsh):
+        """
+        returns the bucket of each band that the LSH vector of bucket indices falls in
+        (skipping or sampling stop buckets if the size of buckets is limited)
+        """
+        buckets = self._storage.get_buckets(lsh)
+        if self._max_bucket_size is not None:
+            buckets = self._limit_buckets(buckets)
+        return buckets
+
+    def _get_dups_from_lsh(self, lsh, doc_id=None):
+        if self._max_age is not None:
+            self._evict()
+        all_buckets = self._reduce(self._get_lsh_buckets(lsh))
         if doc_id is not None:
             all_buckets.discard(doc_id)
         return all_buckets
 
+    def _get_dups_from_lshs(self, lshs, doc_ids, flat=False):
+        """
+        the duplicates of each of several LSH vectors (excluding its doc_id, if not None), as a
+        list of sets or, if flat, as the number of duplicates of each and their doc_ids (see
+        get_dups_batch)
+        """
+        assert not flat or np is not None, "numpy is required for flat results"
+        if self._max_age is not None:
+            self._evict()
+        buckets = self._storage.get_buckets_batch(lshs)
+        if self._max_bucket_size is not None:
+            buckets = map(self._limit_buckets, buckets)
+        if flat and self._engine == 'numpy':
+            return self._reduce_batch(buckets, doc_ids) if self._m > 1 else self._union_batch(buckets, doc_ids)
+        dups = map(self._reduce, buckets)
+        for doc_dups, doc_id in it.izip(dups, doc_ids):
+            if doc_id is not None:
+                doc_dups.discard(doc_id)
+        return _flat_dups(dups) if flat else dups
+
+    def _reduce_batch(self, buckets, doc_ids):
+        """
+        reduce the buckets of each of several documents, as _reduce followed by discarding its
+        doc_id, with array operations over the (document, doc_id) pairs of all of their buckets.
+        Returns the number of duplicates of each document and their doc_ids.
+        """
+        sizes = np.fromiter((sum(it.imap(len, doc_buckets)) for doc_buckets in buckets), dtype=np.int64,
+                            count=len(buckets))
+        dups = np.fromiter(it.chain.from_iterable(it.chain.from_iterable(buckets)), dtype=np.int64,
+                           count=sizes.sum())
+        owners = np.repeat(np.arange(len(buckets)), sizes)
+        # sort the pairs by document then doc_id and count the runs of equal pairs
+        order = np.lexsort((dups, owners))
+        owners, dups = owners[order], dups[order]
+        starts = np.ones(len(dups), dtype=bool)
+        starts[1:] = (owners[1:] != owners[:-1]) | (dups[1:] != dups[:-1])
+        starts = np.flatnonzero(starts)
+        support = np.diff(np.append(starts, len(dups)))
+        starts = starts[support >= self._m]
+        owners, dups = owners[starts], dups[starts]
+        if self._instruments is not None:
+            self._instruments.reductions += len(buckets)
+            self._instruments.candidates += len(dups)
+        has_id = np.array([doc_id is not None for doc_id in doc_ids], dtype=bool)
+        if has_id.any():
+            query_ids = np.array([doc_id if doc_id is not None else 0 for doc_id in doc_ids], dtype=np.int64)
+            own = has_id[owners] & (dups == query_ids[owners])
+            owners, dups = owners[~own], dups[~own]
+        return np.bincount(owners, minlength=len(buckets)), dups
+
+    def _union_batch(self, buckets, doc_ids):
+        """
+        the flat duplicates (see _reduce_batch) of each of several documents for a minimum support
+        of 1.  The union of the buckets of each document is taken as a set (which drops the
+        repeated doc_ids of its buckets cheaper than any array operation), and the doc_ids of all
+        the unions are then sorted within each document at once, as keys offset by document.
+        """
+        dups = [set().union(*doc_buckets) for doc_buckets in buckets]
+        if self._instruments is not None:
+            self._instruments.reductions += len(dups)
+            self._instruments.candidates += sum(it.imap(len, dups))
+        for doc_dups, doc_id in it.izip(dups, doc_ids):
+            if doc_id is not None:
+                doc_dups.discard(doc_id)
+        counts = np.fromiter(it.imap(len, dups), dtype=np.int64, count=len(dups))
+        ids = np.fromiter(it.chain.from_iterable(dups), dtype=np.int64, count=counts.sum())
+        if not len(ids):
+            return counts, ids
+        owners = np.repeat(np.arange(len(dups), dtype=np.int64), counts)
+        span = int(ids.max()) + 1
+        if len(dups) * span > sys.maxint:
+            return counts, ids[np.lexsort((ids, owners))]
+        owners *= span
+        return counts, np.sort(ids + owners) - owners
+
+    def _get_lsh_from_chunks(self, docs, chunk_size, workers=None):
+        """
+        Splits docs into chunks of chunk_size documents and yields the doc_ids, the minhash
+        signatures (see _get_lsh_from_docs) and the LSH vectors of each chunk, in order.  If more than one worker is requested, the
+        LSH vectors are computed in a pool of worker processes (keeping a couple of chunks
+        per worker in flight) while the chunks are yielded in the order of docs.
+        """
+        chunks = it.imap(_split_doc_tuples, _chunks(docs, chunk_size))
+        if workers is None or workers <= 1:
+            for doc_ids, chunk_docs in chunks:
+                yield (doc_ids,) + self._get_lsh_from_docs(chunk_docs)
+            return
+
+        pool = multiprocessing.Pool(workers, _init_worker, (self,))
+        try:
+            pending = deque()
+            for doc_ids, chunk_docs in chunks:
+                pending.append((doc_ids, pool.apply_async(_worker_lsh_from_docs, (chunk_docs,))))
+                if len(pending) >= 2 * workers:
+                    doc_ids, result = pending.popleft()
+                    yield (doc_ids,) + result.get()
+            while pending:
+                doc_ids, result = pending.popleft()
+                yield (doc_ids,) + result.get()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def get_dups(self, doc, doc_id=None):
+        return self._get_dups_from_lsh(self._get_doc_lsh(doc, doc_id), doc_id)
+
+    def get_ranked_dups(self, doc, doc_id=None, threshold=0.0, k=None):
+        """
+        Like get_dups, but ranks the duplicates by their estimated Jaccard similarity to the
+        document (the fraction of the rows of their stored minhash signatures that agree).
+        Returns a list of (doc_id, similarity) pairs, most similar first, of the duplicates
+        whose similarity is at least threshold, at most k of them if k is given.
+        If doc is not given, the stored minhash signature of doc_id is used.
+        Requires store_minhashes.
+        """
+        assert self._minhashes is not None, "must store minhashes to rank duplicates"
+        if doc:
+            sig = self._get_sig_from_doc(doc)
+        else:
+            assert doc_id is not None, "must specify doc or doc_id"
+            sig = self._minhashes[doc_id]
+        dups = self._get_dups_from_lsh(self._get_lsh(list(sig)), doc_id)
+        return self._minhashes.rank(sig, dups, threshold, k)
+
+    def get_dups_batch(self, docs, chunk_size=1000, workers=None, flat=False):
+        """
+        Batch counterpart of get_dups.  Each item of docs is either a document or a
+        (document, doc_id) tuple.  Returns a list of the duplicates found for each document.
+        The band hashes are computed chunk_size documents at a time, and, if workers is greater
+        than 1, in a pool of that many worker processes.  The buckets of each chunk are looked
+        up together, band by band (in a single request for remote storages).
+
+        If flat, the duplicates are returned as two numpy arrays, offsets and dup_ids, rather
+        than a list of sets: the duplicates of document i are dup_ids[offsets[i]:offsets[i + 1]],
+        in increasing order.  With the numpy engine, they are then laid out for the whole chunk at
+        once with array operations: counted, for a minimum support above 1, or, for a minimum
+        support of 1, sorted after taking the union of the buckets of each document as a set
+        (which is cheaper than deduplicating all of their doc_ids as an array).  Requires numpy.
+        """
+        return _join_dups([self._get_dups_from_lshs(lshs, doc_ids, flat)
+                           for doc_ids, _, lshs in self._get_lsh_from_chunks(docs, chunk_size, workers)], flat)
+
+    def get_dups_batch_by_id(self, doc_ids, chunk_size=1000, flat=False):
+        """
+        Like get_dups_batch, for documents of the cache given by doc_id, using their stored
+        signatures (as get_dups does when no document is given).  A document is not its own
+        duplicate.  Requires store_signatures.
+        """
+        assert self._store_signatures, "must store signatures to look up documents by doc_id"
+        return _join_dups([self._get_dups_from_lshs(map(self._storage.get_doc, chunk), chunk, flat)
+                           for chunk in _chunks(doc_ids, chunk_size)], flat)
+
+    def _new_doc_id(self):
+        """
+        the doc_id of a document inserted without one: the next one, unless the storage
+        allocates them (when it is shared with other caches)
+        """
+        return self._storage.new_doc_id(self._next_id)
+
     def insert(self, doc, doc_id=None):
         if doc_id is None:
-            doc_id = self._next_id
-        lsh = self._get_lsh_from_doc(doc)
+            doc_id = self._new_doc_id()
+        sig = self._get_sig_from_doc(doc)
+        lsh = self._get_lsh(sig)
         logging.debug('id: %d lsh: %s', doc_id, lsh)
-        return self._insert_lsh(lsh, doc_id)
+        return self._insert_lsh(lsh, doc_id, sig)
 
-    def insert_batch(self, docs):
-        """Batch method for adding db docs to cache"""
-        dups = []
+    def insert_batch(self, docs, chunk_size=1000, workers=None):
+        """
+        Batch method for adding db docs to cache.  Each item of docs is either a document or a
+        (document, doc_id) tuple.  Returns a list of the duplicates found for each document.
+
+        Documents are processed chunk_size at a time: the band hashes of the whole chunk are
+        computed at once (as a single signature matrix with the numpy engine) and then inserted
+        in order, so the results are the same as inserting the documents one by one.
+        If workers is greater than 1, the band hashes are computed in a pool of that many
+        worker processes while this process inserts them, still in the order of docs.
+        """
         logging.debug('batch inserting len(docs)=%d', len(docs) if hasattr(docs, '__len__') else -1)
-        for i, doc_tuple in enumerate(docs):
-            if (i % 100 == 0):
-                logging.debug('batch processed %d docs', i)
-            if len(doc_tuple) == 2 and isinstance(doc_tuple[1], int):
-                dups.append(self.insert(*doc_tuple))
+        return [dups for _, dups in self.insert_iter(docs, chunk_size, workers)]
+
+    def insert_iter(self, docs, chunk_size=1000, workers=None):
+        """
+        Like insert_batch, but yields the (doc_id, duplicates) of each document as it is
+        inserted rather than returning a list, so that docs can be a stream of any length read
+        chunk_size documents at a time.
+        """
+        for i, (doc_ids, sigs, lshs) in enumerate(self._get_lsh_from_chunks(docs, chunk_size, workers)):
+            logging.debug('batch processed %d docs', i * chunk_size)
+            for doc_id, sig, lsh in it.izip(doc_ids, sigs or it.repeat(None), lshs):
+                if doc_id is None:
+                    doc_id = self._new_doc_id()
+                yield doc_id, self._insert_lsh(lsh, doc_id, sig)
+
+    def remove(self, doc_id, doc=None):
+        """
+        Remove the document doc_id from the cache.  The band hashes of the document are needed
+        to find its buckets, so unless signatures or minhashes are stored, the document itself
+        must be given.  Removing a document does not change max_doc_id.
+        """
+        assert self._storage.has_doc(doc_id), "Document with doc_id %d has not been inserted" % doc_id
+        lsh = self._storage.get_doc(doc_id)
+        if lsh is None:
+            if doc:
+                lsh = self._get_lsh_from_doc(doc)
             else:
-                dups.append(self.insert(doc_tuple))
-        return dups
+                assert self._minhashes is not None, "must store signatures if doc is not specified"
+                lsh = self._get_lsh(self._minhashes[doc_id])
+        with self._wal.log_remove(doc_id, lsh) if self._wal is not None else _NOT_LOGGED:
+            self._remove_lsh(lsh, doc_id)
+
+    def _remove_lsh(self, lsh, doc_id):
+        """
+        remove doc_id from the buckets of its LSH vector and forget its signature and insertion time
+        """
+        if self._max_bucket_size is not None:
+            # doc_id was left out of the buckets which were stop buckets when it was inserted
+            lsh = [band_bucket if doc_id in bucket else None
+                   for band_bucket, bucket in it.izip(lsh, self._storage.get_buckets(lsh))]
+        self._storage.remove(lsh, doc_id)
+        if self._minhashes is not None:
+            del self._minhashes[doc_id]
+        if self._insert_times is not None:
+            self._insert_times.pop(doc_id, None)
+
+    def evict_expired(self):
+        """
+        evict the documents older than max_age.  Expired documents are evicted whenever a document
+        is inserted, this allows evicting them while no documents are being inserted
+        """
+        if self._insert_times is not None:
+            self._evict()
 
     def clear(self):
         """recreate an empty cache of all entries and reset the doc_id counter"""
-        self._seen = {}  # the set of doc ids which have already been hashed
-        self._next_id = 0
-        self._cache = [defaultdict(list) for _ in xrange(self._b)]
+        with self._wal.log_clear() if self._wal is not None else _NOT_LOGGED:
+            self._next_id = 0
+            self._storage.clear(self._b)
+            if self._minhashes is not None:
+                self._minhashes.clear()
+            if self._insert_times is not None:
+                self._insert_times.clear()
+
+    def save(self, path):
+        """
+        save the cache to path in a compact binary format that can be opened (memory mapped)
+        with from_file.  The shingler, shingle_hash and hash family must be serializable (i.e.,
+        module level functions and classes with json serializable attributes)
+        """
+        persist.save(self, path)
+
+    @classmethod
+    def from_file(cls, path, mmap=True, **kwargs):
+        """
+        load a cache saved with save.  If mmap is True, the band tables and the seen doc_ids
+        are memory mapped from the file rather than read into memory, so opening the cache is
+        nearly instant and several processes opening the same file share its pages.  The cache
+        can still be inserted into, in which case the changed buckets are copied into memory.
+        Any additional keyword arguments are passed on to the constructor.
+        """
+        return persist.load(cls, path, mmap, **kwargs)
+
+    def params(self):
+        """
+        the parameters of the cache, including the random parameters of its hash family, as a
+        json serializable dict.  from_params creates an empty cache with them (e.g., in another
+        process or on another machine) which hashes documents identically, so that caches built
+        over parts of a corpus can be merged.  The shingler, shingle_hash and hash family must
+        be serializable (see save)
+        """
+        return persist.params(self)
+
+    @classmethod
+    def from_params(cls, params, **kwargs):
+        """
+        create an empty cache with params (as returned by params).  Any additional keyword
+        arguments (e.g., storage) are passed on to the constructor.
+        """
+        return persist.from_params(cls, params, **kwargs)
+
+    def merge(self, other, find_dups=False):
+        """
+        Merge the documents of the cache other into this cache.  Both caches must hash documents
+        identically (see params and seed), e.g., caches built in parallel over parts of a corpus.
+        Each document of other keeps its doc_id unless this cache already holds that doc_id, in
+        which case it is given a new one past the max_doc_id of both caches.  The documents are
+        merged in the order they were inserted into other if it is bounded and by doc_id
+        otherwise, evicting the oldest documents of this cache if it is bounded.
+
+        The storage of other must hold band tables and the seen doc_ids (a MemoryStorage, mapped
+        from a file or not, or a ShardedStorage).  Returns the dict of the new doc_ids given to
+        documents of other and, if find_dups, the list of (doc_id, dup_id) pairs of each document
+        of other (by its new doc_id) and each of its duplicates among the documents this cache
+        held before merging.
+        """
+        assert self.__class__ is other.__class__, \
+            "cannot merge a %s into a %s" % (other.__class__.__name__, self.__class__.__name__)
+        params, other_params = self.params(), other.params()
+        assert [params[name] for name in _HASH_PARAMS] == [other_params[name] for name in _HASH_PARAMS], \
+            "caches must hash documents identically to be merged"
+        assert self._minhashes is None or other._minhashes is not None, \
+            "cannot merge a cache without minhashes into one storing them"
+        storage = other._storage
+        assert hasattr(storage, 'tables') and hasattr(storage, 'seen'), \
+            "cannot merge a cache whose storage does not hold band tables, %r" % storage
+        assert other._store_signatures or other._max_bucket_size is None, \
+            "cannot merge a cache limiting the size of its buckets unless it stores signatures"
+        if other._store_signatures:
+            lshs = dict(storage.seen.iteritems())
+        else:
+            # rebuild the LSH vector of each document from the buckets it was inserted into
+            lshs = dict((doc_id, [None] * other._b) for doc_id, _ in storage.seen.iteritems())
+            for band, table in enumerate(storage.tables):
+                for band_bucket, doc_ids in table.iteritems():
+                    for doc_id in doc_ids:
+                        lshs[doc_id][band] = band_bucket
+        doc_ids = other._insert_times.keys() if other._insert_times is not None else sorted(lshs)
+
+        new_ids = {}
+        next_id = max(self._next_id, other._next_id)
+        for doc_id in doc_ids:
+            if self._storage.has_doc(doc_id):
+                new_ids[doc_id] = next_id
+                next_id += 1
+        pairs = []
+        if find_dups:
+            for doc_id in doc_ids:
+                new_id = new_ids.get(doc_id, doc_id)
+                pairs.extend((new_id, dup_id) for dup_id in sorted(self._get_dups_from_lsh(lshs[doc_id])))
+
+        for doc_id in doc_ids:
+            lsh, new_id = lshs[doc_id], new_ids.get(doc_id, doc_id)
+            sig = other._minhashes[doc_id] if self._minhashes is not None else None
+            if self._insert_times is not None:
+                self._evict(self._max_docs - 1 if self._max_docs else None)
+            with self._wal.log_insert(new_id, lsh, sig) if self._wal is not None else _NOT_LOGGED:
+                self._store_lsh(lsh, new_id, sig)
+        return (new_ids, pairs) if find_dups else new_ids
+
+    def stats(self, top=10):
+        """
+        Returns a dict of statistics of the cache: its number of documents, the statistics of the
+        buckets of each band (for storages holding band tables, see lsh.instrument.bucket_stats)
+        including the top largest buckets, if the cache is instrumented, the timings of each
+        stage and the candidate duplicates found and, if the size of buckets is limited, the
+        number of stop buckets and stop bucket events.  lsh.instrument.prometheus_text formats them
+        for Prometheus.
+        """
+        stats = {'num_docs': self.num_docs()}
+        tables = getattr(self._storage, 'tables', None)
+        if tables is not None:
+            stats.update(_instrument.bucket_stats(tables, top))
+        if self._instruments is not None:
+            stats.update(self._instruments.stats())
+        if self._max_bucket_size is not None:
+            stats['stop_bucket_events'] = dict(self._stop_bucket_events)
+            if tables is not None:
+                stats['stop_buckets'] = sum(1 for table in tables for _, doc_ids in table.iteritems()
+                                            if len(doc_ids) >= self._max_bucket_size)
+        return stats
 
     def num_docs(self):
-        return len(self._seen)
+        return self._storage.num_docs()
 
     def max_doc_id(self):
         return self._next_id - 1
 
+    def oldest_doc_id(self):
+        """
+        the doc_id of the oldest document of a cache with max_docs or max_age (the next to be
+        evicted), or None if it is empty or keeps its documents until they are removed
+        """
+        if not self._insert_times:
+            return None
+        return next(self._insert_times.iterkeys())
+
     def num_bands(self):
         return self._b
 
@@ -442,24 +1404,115 @@ class LSHCache:
     def shingler(self):
         return self._shingler
 
+    def shingle_ids(self, doc):
+        """
+        Returns the set of the ids of the shingles of doc (modulo universe_size), the set whose
+        Jaccard similarity to those of other documents the minhash signatures estimate
+        """
+        shingle_vec = self._get_shingle_vec(doc)
+        return set(shingle_vec.tolist() if self._shingle_array else shingle_vec)
+
     def theoretical_percent_found(self, pct_similar):
         """
         Returns the theoretical percentage of documents that should be found with the
         given pct_similarity from this cache
         """
-        pct_band_match = pct_similar ** self._r
+        return self._percent_found(pct_similar, self._r, self._m)
 
-        if self._m < self._b - self._m:
-            return 1 - pbinom(pct_band_match, self._b, self._m - 1)
+    def _percent_found(self, pct_similar, r, m):
+        """
+        the theoretical percentage of documents with pct_similarity found with r rows per band
+        and a minimum support of m bands
+        """
+        if self._sig_bits is not None:
+            # rows of b-bit signatures also agree by chance
+            pct_similar += (1 - pct_similar) * 2.0 ** -self._sig_bits
+        pct_band_match = pct_similar ** r
+
+        if m < self._b - m:
+            return 1 - pbinom(pct_band_match, self._b, m - 1)
+        else:
+            return pbinom(pct_band_match, self._b, min_r=m, r=self._b)
+
+
+# the cache used by the worker processes of insert_batch and get_dups_batch
+_worker_cache = None
+
+
+def _init_worker(cache):
+    global _worker_cache
+    _worker_cache = cache
+
+
+def _worker_lsh_from_docs(docs):
+    """
+    compute the minhash signatures (if needed) and LSH vectors of docs in a worker process
+    """
+    return _worker_cache._get_lsh_from_docs(docs)
+
+
+def _flat_dups(dups):
+    """
+    the number of duplicates in each of a list of sets of duplicates and all of their doc_ids
+    """
+    counts = np.fromiter(it.imap(len, dups), dtype=np.int64, count=len(dups))
+    return counts, np.fromiter(it.chain.from_iterable(it.imap(sorted, dups)), dtype=np.int64,
+                               count=counts.sum())
+
+
+def _join_dups(chunks, flat):
+    """
+    join the duplicates found for each chunk of documents by _get_dups_from_lshs into a list of
+    sets or, if flat, the offsets and doc_ids of the duplicates of every document
+    """
+    if not flat:
+        return list(it.chain.from_iterable(chunks))
+    offsets = np.zeros(sum(len(counts) for counts, _ in chunks) + 1, dtype=np.int64)
+    if chunks:
+        np.cumsum(np.concatenate([counts for counts, _ in chunks]), out=offsets[1:])
+    return offsets, np.concatenate([dups for _, dups in chunks] or [np.empty(0, dtype=np.int64)])
+
+
+def _chunks(iterable, chunk_size):
+    """
+    split an iterable into a sequence of lists of (at most) chunk_size items
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(it.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _split_doc_tuples(doc_tuples):
+    """
+    split a sequence of documents, any of which may be a (document, doc_id) tuple, into
+    a list of doc_ids (None where no doc_id was given) and a list of documents
+    """
+    doc_ids, docs = [], []
+    for doc_tuple in doc_tuples:
+        if len(doc_tuple) == 2 and isinstance(doc_tuple[1], int):
+            doc_ids.append(doc_tuple[1])
+            docs.append(doc_tuple[0])
         else:
-            return pbinom(pct_band_match, self._b, min_r=self._m, r=self._b)
+            doc_ids.append(None)
+            docs.append(doc_tuple)
+    return doc_ids, docs
 
 
 def nCr(n, r):
     """
     combinatorics n choose r
     """
-    return factorial(n) / (factorial(r) * factorial(n - r))
+    r = min(r, n - r)
+    if r < 0:
+        return 0
+    c = 1
+    for i in xrange(1, r + 1):
+        # exact, as each partial product is itself a binomial coefficient
+        c = c * (n - r + i) // i
+    return c
 
 
 def dbinom(pct, n, r):
@@ -468,7 +1521,12 @@ def dbinom(pct, n, r):
     exactly r  of n independent trials given pct of a single trial
     Follows naming conventions of r
     """
-    return nCr(n, r) * (pct ** r) * ((1 - pct) ** (n - r))
+    if n < 1000:
+        return nCr(n, r) * (pct ** r) * ((1 - pct) ** (n - r))
+    if pct <= 0 or pct >= 1:
+        return float(r == (n if pct >= 1 else 0))
+    # in log space, as nCr overflows a float for large n
+    return exp(lgamma(n + 1) - lgamma(r + 1) - lgamma(n - r + 1) + r * log(pct) + (n - r) * log1p(-pct))
 
 
 def pbinom(pct, n, r, min_r=0):
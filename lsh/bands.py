@@ -0,0 +1,339 @@
+"""
+Band tables: the per-band hash tables of an LSHCache mapping each bucket key (the hash of a band
+of the minhash signature) to the doc_ids of the documents that fall in that bucket.
+
+A band table provides
+    get(key, default):     the doc_ids in the bucket (a list, or another sequence which must not
+                           be modified, in insertion order) or default if the bucket is empty.
+                           It must not create the bucket.
+    append(key, doc_id):   add doc_id to the bucket
+    remove(key, doc_id):   remove doc_id from the bucket, dropping the bucket if it is left empty
+    iteritems():           iterate over the (key, doc_ids) of the non-empty buckets
+    __len__, __contains__: number of buckets and whether a bucket exists
+"""
+import itertools as it
+from array import array
+from collections import defaultdict
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_FIB = 0x9E3779B97F4A7C15
+_MASK64 = 0xFFFFFFFFFFFFFFFF
+# the size from which the buckets of a DictBandTable are OrderedBuckets rather than lists (and
+# those of a CompactBandTable are indexed by doc_id)
+_ORDERED_BUCKET_SIZE = 64
+
+
+class OrderedBucket(object):
+    """
+    A large bucket of a DictBandTable: its doc_ids in insertion order, the removed ones left as
+    holes (None), and the index of each doc_id, so that removing a doc_id costs O(1) rather
+    than the O(bucket size) of list.remove.  Removing the oldest doc_id (as evicting does) only
+    moves the start of the bucket, and the list is compacted once half of it is holes.  It is a
+    read-only sequence to anything but its band table (slicing it gives a list) and is pickled
+    as a list.
+    """
+
+    def __init__(self, doc_ids):
+        self._ids = list(doc_ids)
+        self._reindex()
+
+    def _reindex(self):
+        self._index = dict((doc_id, i) for i, doc_id in enumerate(self._ids))
+        self._start = 0
+        # the number of holes after _start
+        self._holes = 0
+
+    def append(self, doc_id):
+        self._index[doc_id] = len(self._ids)
+        self._ids.append(doc_id)
+
+    def remove(self, doc_id):
+        i = self._index.pop(doc_id, None)
+        if i is None:
+            raise ValueError("%r is not in the bucket" % (doc_id,))
+        self._ids[i] = None
+        if i == self._start:
+            self._start += 1
+            while self._start < len(self._ids) and self._ids[self._start] is None:
+                self._start += 1
+                self._holes -= 1
+        else:
+            self._holes += 1
+        if 2 * (self._start + self._holes) > len(self._ids):
+            self._ids = list(self)
+            self._reindex()
+
+    def __len__(self):
+        return len(self._ids) - self._start - self._holes
+
+    def __iter__(self):
+        doc_ids = it.islice(self._ids, self._start, None)
+        return doc_ids if not self._holes else (doc_id for doc_id in doc_ids if doc_id is not None)
+
+    def __contains__(self, doc_id):
+        return doc_id in self._index
+
+    def __getitem__(self, key):
+        return list(self)[key]
+
+    def __array__(self, dtype=None):
+        return np.fromiter(self, dtype=dtype or np.int64, count=len(self))
+
+    def __reduce__(self):
+        return list, (list(self),)
+
+    def __repr__(self):
+        return 'OrderedBucket(%r)' % list(self)
+
+
+class DictBandTable(defaultdict):
+    """
+    The default band table: a defaultdict mapping each bucket key to a list of doc_ids, or to
+    an OrderedBucket once it holds _ORDERED_BUCKET_SIZE doc_ids, so that removing doc_ids from
+    large buckets does not cost the size of the bucket.
+    """
+
+    def __init__(self):
+        defaultdict.__init__(self, list)
+
+    def append(self, key, doc_id):
+        bucket = self[key]
+        bucket.append(doc_id)
+        if len(bucket) == _ORDERED_BUCKET_SIZE and isinstance(bucket, list):
+            self[key] = OrderedBucket(bucket)
+
+    def remove(self, key, doc_id):
+        bucket = self[key]
+        try:
+            bucket.remove(doc_id)
+        finally:
+            # even when doc_id was not in the bucket, which may have just been made
+            if not bucket:
+                del self[key]
+
+
+class _IntTable(object):
+    """
+    An open addressing hash table (linear probing) of typed arrays, mapping 64-bit integer keys to
+    32-bit integer values other than -1, which marks the empty slots.  Its slots are used
+    directly: slot gives the slot of a key, whose value is values[slot].
+    """
+
+    def __init__(self, capacity=8):
+        self._init_slots(max(3, (capacity - 1).bit_length()))
+        self.size = 0
+
+    def _init_slots(self, bits):
+        self._bits = bits
+        self.keys = array('l', [0]) * (1 << bits)
+        self.values = array('i', [-1]) * (1 << bits)
+
+    def _home(self, key):
+        """
+        return the slot key would be placed in if there were no collisions
+        """
+        return ((key * _FIB) & _MASK64) >> (64 - self._bits)
+
+    def slot(self, key):
+        """
+        return the slot holding key, or the empty slot where key would be placed
+        """
+        bits = self._bits
+        mask = (1 << bits) - 1
+        i = ((key * _FIB) & _MASK64) >> (64 - bits)
+        keys, values = self.keys, self.values
+        while values[i] != -1 and keys[i] != key:
+            i = (i + 1) & mask
+        return i
+
+    def put(self, i, key, value):
+        """
+        add key, which is not in the table, with value, given the empty slot i that slot gave
+        """
+        if 3 * (self.size + 1) > 2 * len(self.values):
+            self._resize()
+            i = self.slot(key)
+        self.keys[i] = key
+        self.values[i] = value
+        self.size += 1
+
+    def _resize(self):
+        keys, values = self.keys, self.values
+        self._init_slots(self._bits + 1)
+        for key, value in zip(keys, values):
+            if value != -1:
+                i = self.slot(key)
+                self.keys[i] = key
+                self.values[i] = value
+
+    def delete(self, i):
+        """
+        empty slot i, shifting back any later slots of its probe sequence (so that no
+        tombstones are needed)
+        """
+        mask = (1 << self._bits) - 1
+        keys, values = self.keys, self.values
+        values[i] = -1
+        self.size -= 1
+        j = i
+        while True:
+            j = (j + 1) & mask
+            if values[j] == -1:
+                return
+            home = self._home(keys[j])
+            # move j back into i unless its home lies cyclically in (i, j]
+            if (i < j and (home <= i or home > j)) or (i > j and home <= i and home > j):
+                keys[i], values[i] = keys[j], values[j]
+                values[j] = -1
+                i = j
+
+    def iteritems(self):
+        for key, value in zip(self.keys, self.values):
+            if value != -1:
+                yield key, value
+
+    def nbytes(self):
+        return self.keys.itemsize * len(self.keys) + self.values.itemsize * len(self.values)
+
+
+class CompactBandTable(object):
+    """
+    A memory-compact band table.  Rather than a dict of lists of boxed ints, the buckets are
+    kept in an open addressing hash table of typed arrays holding each 64-bit bucket key and the
+    index of the bucket's most recent posting.  The postings themselves are held in three more
+    typed arrays: the doc_id and the index of the previous and of the next posting in the same
+    bucket (so a band table holds at most 2**31 postings).  Removed postings are kept on a free
+    list and reused, so a table with a steady number of postings stays the same size.  This costs
+    roughly 50 bytes per (band, doc) posting rather than the 250 or so of a dict of lists.
+
+    As with the OrderedBuckets of a DictBandTable, removing a doc_id from a bucket of
+    _ORDERED_BUCKET_SIZE doc_ids or more (e.g., evicting the oldest one of a hot bucket) costs O(1)
+    rather than the size of the bucket: once a removal has searched that many postings, the
+    postings of the bucket are indexed by doc_id, in another such hash table, and unlinked from
+    the bucket directly.  The head of an indexed bucket is stored as -2 - head.  A doc_id must
+    be in at most one bucket of a table, as a document is in one bucket of each band.
+    """
+
+    def __init__(self, capacity=8):
+        self._buckets = _IntTable(capacity)  # the most recent posting of each bucket key
+        self._postings = _IntTable()  # the posting of each doc_id of the indexed buckets
+        self._docs = array('l')  # doc_id of each posting
+        self._next = array('i')  # index of the previous posting of the same bucket, or -1
+        self._prev = array('i')  # index of the next posting of the same bucket, or -1
+        self._free = -1  # the first of the removed postings (chained through _next), or -1
+
+    def _bucket(self, posting):
+        if posting < -1:
+            posting = -2 - posting
+        bucket = []
+        docs, next_posting = self._docs, self._next
+        while posting != -1:
+            bucket.append(docs[posting])
+            posting = next_posting[posting]
+        bucket.reverse()
+        return bucket
+
+    def get(self, key, default=None):
+        buckets = self._buckets
+        posting = buckets.values[buckets.slot(key)]
+        return self._bucket(posting) if posting != -1 else default
+
+    def append(self, key, doc_id):
+        buckets = self._buckets
+        i = buckets.slot(key)
+        head = buckets.values[i]
+        indexed = head < -1
+        if indexed:
+            head = -2 - head
+        if self._free != -1:
+            posting = self._free
+            self._free = self._next[posting]
+            self._docs[posting] = doc_id
+            self._next[posting] = head
+            self._prev[posting] = -1
+        else:
+            posting = len(self._docs)
+            self._docs.append(doc_id)
+            self._next.append(head)
+            self._prev.append(-1)
+        if head == -1:
+            buckets.put(i, key, posting)
+            return
+        self._prev[head] = posting
+        if indexed:
+            buckets.values[i] = -2 - posting
+            postings = self._postings
+            postings.put(postings.slot(doc_id), doc_id, posting)
+        else:
+            buckets.values[i] = posting
+
+    def _index(self, i):
+        """
+        index the postings of the bucket in slot i by doc_id
+        """
+        buckets, postings = self._buckets, self._postings
+        posting = head = buckets.values[i]
+        docs, next_posting = self._docs, self._next
+        while posting != -1:
+            postings.put(postings.slot(docs[posting]), docs[posting], posting)
+            posting = next_posting[posting]
+        buckets.values[i] = -2 - head
+
+    def remove(self, key, doc_id):
+        buckets = self._buckets
+        i = buckets.slot(key)
+        head = buckets.values[i]
+        indexed = head < -1
+        searched = 0
+        if indexed:
+            head = -2 - head
+            postings = self._postings
+            j = postings.slot(doc_id)
+            posting = postings.values[j]
+            if posting != -1 and (self._prev[posting] != -1 or posting == head):
+                postings.delete(j)
+            else:
+                posting = -1
+        else:
+            posting, docs, next_posting = head, self._docs, self._next
+            while posting != -1 and docs[posting] != doc_id:
+                posting = next_posting[posting]
+                searched += 1
+        if posting == -1:
+            raise ValueError("%r is not in bucket %r" % (doc_id, key))
+        prev, next_posting = self._prev[posting], self._next[posting]
+        if prev != -1:
+            self._next[prev] = next_posting
+        elif next_posting == -1:
+            buckets.delete(i)
+            searched = 0
+        else:
+            buckets.values[i] = -2 - next_posting if indexed else next_posting
+        if next_posting != -1:
+            self._prev[next_posting] = prev
+        self._next[posting] = self._free
+        self._free = posting
+        if searched >= _ORDERED_BUCKET_SIZE:
+            self._index(i)
+
+    def iteritems(self):
+        for key, head in self._buckets.iteritems():
+            yield key, self._bucket(head)
+
+    def __contains__(self, key):
+        buckets = self._buckets
+        return buckets.values[buckets.slot(key)] != -1
+
+    def __len__(self):
+        return self._buckets.size
+
+    def nbytes(self):
+        """
+        the number of bytes used by the arrays of the table
+        """
+        return self._buckets.nbytes() + self._postings.nbytes() + \
+            sum(a.itemsize * len(a) for a in (self._docs, self._next, self._prev))
@@ -0,0 +1,242 @@
+"""
+An LSH Forest (Bawa, Condie and Ganesan, "LSH Forest: Self-Tuning Indexes for Similarity Search",
+2005): an LSH index whose rows per band and minimum support are chosen per query rather than
+when the index is built.
+
+Rather than the hash of its r rows, each band of a document's minhash signature is kept whole,
+as a label of r rows, in a table of labels sorted so that the documents whose labels share a
+prefix are next to each other.  A query with r' <= r rows per band then finds the documents
+agreeing with it on the first r' rows of a band with a binary search.  Fewer rows per band (or a
+lower minimum support) find less similar documents, more find only the most similar.
+"""
+import bisect
+import functools as ft
+import itertools as it
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from lsh import LSHCache, _flat_dups, _join_dups
+from lsh.storage import MemoryStorage
+
+
+class PrefixBandTable(object):
+    """
+    A band table (see lsh.bands) whose keys are labels (tuples of the rows of a band) which can
+    also look up all the doc_ids whose label starts with a given prefix.
+
+    The labels (and the doc_id of each) are held in a large sorted list and a small sorted list
+    of recent inserts, which is merged into the large one once it grows past a fraction of its
+    size, so inserting costs amortized O(log n) comparisons rather than moving half the list.
+    Removing a doc_id from the large list leaves a tombstone (a doc_id of None) rather than
+    moving the rest of the list, and the tombstones are dropped by the next merge (or once they
+    are half of the list).  Lookups binary search both lists.  The doc_ids of a bucket are in
+    doc_id order.
+    """
+
+    def __init__(self, merge_fraction=64, min_merge=1024):
+        # the sorted labels and the doc_id of each (None for the removed ones)
+        self._labels, self._doc_ids = [], []
+        self._recent_labels, self._recent_doc_ids = [], []
+        self._merge_fraction = merge_fraction
+        self._min_merge = min_merge
+        # the number of distinct labels, and of the tombstones of the large list
+        self._num_buckets = 0
+        self._tombstones = 0
+
+    @staticmethod
+    def _range(labels, prefix):
+        """
+        the slice of the sorted labels which start with prefix
+        """
+        begin = bisect.bisect_left(labels, prefix)
+        if not prefix:
+            return begin, len(labels)
+        # every label starting with prefix sorts before the next prefix of the same length
+        end = bisect.bisect_left(labels, prefix[:-1] + (prefix[-1] + 1,), begin)
+        return begin, end
+
+    def prefix(self, prefix):
+        """
+        return the list of the doc_ids whose label starts with the tuple prefix
+        """
+        prefix = tuple(prefix)
+        begin, end = self._range(self._labels, prefix)
+        doc_ids = self._doc_ids[begin:end]
+        if self._tombstones:
+            doc_ids = [doc_id for doc_id in doc_ids if doc_id is not None]
+        if self._recent_labels:
+            begin, end = self._range(self._recent_labels, prefix)
+            if begin < end:
+                doc_ids = sorted(doc_ids + self._recent_doc_ids[begin:end])
+        return doc_ids
+
+    def get(self, key, default=None):
+        # all the labels of a band have the same length, so a whole label only prefixes itself
+        return self.prefix(key) or default
+
+    def _count(self, key):
+        """
+        the number of doc_ids with the label key
+        """
+        begin, end = self._range(self._labels, key)
+        count = end - begin
+        if self._tombstones:
+            count -= self._doc_ids[begin:end].count(None)
+        begin, end = self._range(self._recent_labels, key)
+        return count + end - begin
+
+    def _merge(self):
+        """
+        merge the recent lists into the large ones, dropping the tombstones
+        """
+        entries = zip(self._labels, self._doc_ids)
+        if self._tombstones:
+            entries = [entry for entry in entries if entry[1] is not None]
+            self._tombstones = 0
+        entries.extend(it.izip(self._recent_labels, self._recent_doc_ids))
+        # timsort merges the two sorted runs in linear time
+        entries.sort()
+        self._labels, self._doc_ids = map(list, zip(*entries)) if entries else ([], [])
+        self._recent_labels, self._recent_doc_ids = [], []
+
+    def append(self, key, doc_id):
+        if not self._count(key):
+            self._num_buckets += 1
+        i = bisect.bisect_right(self._recent_labels, key)
+        self._recent_labels.insert(i, key)
+        self._recent_doc_ids.insert(i, doc_id)
+        if len(self._recent_labels) > max(self._min_merge, len(self._labels) // self._merge_fraction):
+            self._merge()
+
+    def remove(self, key, doc_id):
+        for labels, doc_ids in ((self._recent_labels, self._recent_doc_ids), (self._labels, self._doc_ids)):
+            begin, end = self._range(labels, key)
+            for i in xrange(begin, end):
+                if doc_ids[i] == doc_id:
+                    if labels is self._labels:
+                        doc_ids[i] = None
+                        self._tombstones += 1
+                    else:
+                        del labels[i], doc_ids[i]
+                    if not self._count(key):
+                        self._num_buckets -= 1
+                    if 2 * self._tombstones > len(self._labels):
+                        self._merge()
+                    return
+        raise ValueError("doc_id %d is not in bucket %r" % (doc_id, key))
+
+    def iteritems(self):
+        entries = sorted(it.chain(it.izip(self._labels, self._doc_ids),
+                                  it.izip(self._recent_labels, self._recent_doc_ids)))
+        if self._tombstones:
+            entries = [entry for entry in entries if entry[1] is not None]
+        for key, entries in it.groupby(entries, lambda (label, _): label):
+            yield key, [doc_id for _, doc_id in entries]
+
+    def __len__(self):
+        return self._num_buckets
+
+    def __contains__(self, key):
+        return bool(self.get(key))
+
+
+class LSHForest(LSHCache):
+    """
+    An LSHCache whose get_dups (and get_dups_batch) can be given the rows per band r and the
+    minimum support m of the lookup, up to the r and b it was built with.  For example, a forest
+    built with b=20, r=10 can serve lookups with 20 bands of 3 rows for high recall as well as
+    20 bands of 10 rows matching at least 2 of them for high precision.  By default, lookups use
+    the r and m given to the constructor.
+
+    The arguments are those of LSHCache, except that the band buckets are always held in
+    memory (in PrefixBandTables) and the forest cannot be saved (or logged, see lsh.wal).  Keeping
+    whole bands rather than their hashes costs r rather than 1 integer per band and document.
+    Stop buckets (see max_bucket_size) are the buckets of the rows per band of a lookup.
+    """
+
+    def __init__(self, *args, **kwargs):
+        assert 'storage' not in kwargs and 'band_table' not in kwargs, \
+            "an LSHForest keeps its bands in PrefixBandTables"
+        kwargs['storage'] = MemoryStorage(PrefixBandTable)
+        LSHCache.__init__(self, *args, **kwargs)
+        # the reduce functions of lookups with another minimum support than the forest's
+        self._reducers = {}
+
+    def _reducer(self, m):
+        """
+        the reduce function of lookups with minimum support m (timed and counted as the reduce
+        stage if the forest is instrumented, as _reduce is)
+        """
+        if m == self._m:
+            return self._reduce
+        reduce = self._reducers.get(m)
+        if reduce is None:
+            if m <= 1:
+                reduce = self._reduce_sets
+            else:
+                reduce = ft.partial(self._reduce_arrays_by_min if self._engine == 'numpy' else
+                                    self._reduce_sets_by_min, min_support=m)
+            if self._instruments is not None:
+                reduce = self._instruments.counted(self._instruments.timed('reduce', reduce))
+            self._reducers[m] = reduce
+        return reduce
+
+    def _get_lsh(self, sig):
+        """
+        the label of each band: the tuple of its r rows of the minhash signature
+        """
+        return [tuple(sig[self._r * i:self._r * (i + 1)]) for i in xrange(self._b)]
+
+    def _get_lshs(self, sigs):
+        return map(self._get_lsh, sigs if self._engine != 'numpy' else sigs.tolist())
+
+    def _get_dups_from_lsh(self, lsh, doc_id=None, r=None, m=None):
+        r = self._r if r is None else r
+        m = self._m if m is None else m
+        assert 0 < r <= self._r, "rows per band must be between 1 and %d" % self._r
+        assert 0 <= m <= self._b, "minimum support must be at most %d" % self._b
+        if self._max_age is not None:
+            self._evict()
+        buckets = [table.prefix(label[:r]) for table, label in zip(self._storage.tables, lsh)]
+        if self._max_bucket_size is not None:
+            buckets = self._limit_buckets(buckets)
+        dups = self._reducer(m)(buckets)
+        dups.discard(doc_id)
+        return dups
+
+    def get_dups(self, doc, doc_id=None, r=None, m=None):
+        """
+        like LSHCache.get_dups, matching documents on the first r rows of each band (at most
+        the rows per band of the forest) in at least m of the bands
+        """
+        return self._get_dups_from_lsh(self._get_doc_lsh(doc, doc_id), doc_id, r, m)
+
+    def _get_dups_from_lshs(self, lshs, doc_ids, flat=False, r=None, m=None):
+        assert not flat or np is not None, "numpy is required for flat results"
+        dups = [self._get_dups_from_lsh(lsh, doc_id, r, m) for lsh, doc_id in it.izip(lshs, doc_ids)]
+        return _flat_dups(dups) if flat else dups
+
+    def get_dups_batch(self, docs, chunk_size=1000, workers=None, r=None, m=None, flat=False):
+        """
+        like LSHCache.get_dups_batch, with the rows per band r and minimum support m of get_dups
+        """
+        return _join_dups([self._get_dups_from_lshs(lshs, doc_ids, flat, r, m)
+                           for doc_ids, _, lshs in self._get_lsh_from_chunks(docs, chunk_size, workers)], flat)
+
+    def theoretical_percent_found(self, pct_similar, r=None, m=None):
+        """
+        like LSHCache.theoretical_percent_found, for lookups with r rows per band and minimum
+        support m
+        """
+        return self._percent_found(pct_similar, self._r if r is None else r,
+                                   self._m if m is None else m)
+
+    def save(self, path):
+        raise ValueError("an LSHForest cannot be saved, its band tables hold labels rather than band hashes")
+
+    @classmethod
+    def from_file(cls, path, mmap=True, **kwargs):
+        raise ValueError("an LSHForest cannot be loaded, only an LSHCache")
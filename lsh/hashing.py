@@ -0,0 +1,221 @@
+"""
+Stable 64-bit hashing of shingles and bands, independent of Python's hash().
+
+The built-in hash of strings (and so of tuples of tokens) changes with PYTHONHASHSEED and between
+interpreter versions, so band keys computed with it cannot be saved, logged or compared between
+processes.  The functions here give the same values in every process, on every platform:
+    stable_hash:        the hash of a shingle (an integer, a string or a tuple of them), the default
+                        shingle_hash of LSHCache
+    TokenHashes:        the hashes of the items of tuples (tokens), computed once per token
+    window_hashes:      stable_hash of every tuple of n consecutive tokens, given their TokenHashes
+    band_hashes:        the bucket keys of the bands of a minhash signature
+    band_hash_matrix:   band_hashes of every row of a numpy matrix of signatures at once
+
+Strings are hashed with the first 8 bytes of their md5 digest, which in pure Python is several
+times faster than hashing them a word at a time.  Tuples (of the scrambled hashes of their items)
+and bands (of their rows) are hashed with the tuple hash of CPython 2.7, which only depends on the
+integers hashed and which the built-in hash computes in C on 64-bit CPython 2.7 (and _tuple_hash
+in Python anywhere else), so a shingle costs an md5 digest per distinct token (kept by
+TokenHashes) and a built-in hash of a tuple of integers.  The tuple hash vectorizes with numpy
+over a matrix of signatures.  Hashes are non-negative integers below 2**63 (so they fit the signed
+64-bit keys of the band tables, files and logs).  Every function takes a seed; LSHCache uses the
+default seed of 0 (its band keys already depend on the seed of its hash family through the minhash
+signatures).
+"""
+import struct
+from hashlib import md5
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_MASK64 = 0xFFFFFFFFFFFFFFFF
+_MIX = 0x9E3779B97F4A7C15
+_MAX = 1 << 63
+_MAX63 = int(_MAX - 1)
+_WORD = struct.Struct('<Q')
+_unpack_word = _WORD.unpack_from
+
+
+def _mix64(x):
+    """
+    the splitmix64 finalizer, scrambling the bits of a 64-bit integer
+    """
+    x = (x ^ (x >> 30)) * 0xbf58476d1ce4e5b9 & _MASK64
+    x = (x ^ (x >> 27)) * 0x94d049bb133111eb & _MASK64
+    return x ^ (x >> 31)
+
+
+def _mix64_array(x):
+    """
+    vectorized _mix64 over a numpy array of uint64
+    """
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+def _start(seed, length):
+    """
+    the initial state of the hash of a sequence of length values
+    """
+    return (seed * _MIX + length) & _MASK64
+
+
+def _finish(h):
+    return int(_mix64(h & _MASK64) >> 1)
+
+
+def _hash_bytes(data, seed):
+    """
+    hash a string of bytes, tagged with a byte telling strings and the reprs of other values apart
+    """
+    if seed:
+        data = _WORD.pack(seed & _MASK64) + data
+    return int(_unpack_word(md5(data).digest())[0] >> 1)
+
+
+def _tuple_state(items, n):
+    """
+    the (x, mult) state of the tuple hash of CPython 2.7 (tuplehash in Objects/tupleobject.c)
+    after the first items of a tuple of n items
+    """
+    x, mult = 0x345678, 1000003
+    for item in items:
+        n -= 1
+        x = ((x ^ item) * mult) & _MASK64
+        mult += 82520 + n + n
+    return x, mult
+
+
+def _tuple_hash(items):
+    """
+    the tuple hash of CPython 2.7 of a sequence of integers from 0 up to 2**63 (which hash to
+    themselves), without its sign bit
+    """
+    x = (_tuple_state(items, len(items))[0] + 97531) & _MASK64
+    # a hash of -1 means an error, so CPython gives -2 instead
+    return (x - 1 if x == _MASK64 else x) & _MAX63
+
+
+def _tuple_hash_array(columns, prefix=()):
+    """
+    vectorized _tuple_hash of the tuples of prefix (a sequence of integers) followed by an item of
+    each of the columns (numpy arrays of the same shape)
+    """
+    n = len(prefix) + len(columns)
+    x, mult = _tuple_state(prefix, n)
+    n -= len(prefix)
+    h = np.empty(columns[0].shape, dtype=np.uint64)
+    h.fill(x)
+    for column in columns:
+        n -= 1
+        h = (h ^ column.astype(np.uint64)) * np.uint64(mult)
+        mult += 82520 + n + n
+    h += np.uint64(97531)
+    h[h == np.uint64(_MASK64)] -= np.uint64(1)
+    return (h & np.uint64(_MAX63)).astype(np.int64)
+
+
+# whether the built-in hash of tuples of integers below 2**63 is _tuple_hash (with its sign bit)
+_NATIVE_TUPLE_HASH = all(hash(t) & _MAX63 == _tuple_hash(t)
+                         for t in ((), (0,), (1, 1 << 62, 3), (_MAX63, 12345, 0, 7)))
+_hash_tuple = hash if _NATIVE_TUPLE_HASH else _tuple_hash
+
+
+def _seed_prefix(seed):
+    """
+    the items hashed before those of a tuple for a seed (none for the default seed of 0)
+    """
+    return (int(_mix64(seed & _MASK64) >> 1),) if seed else ()
+
+
+def _token_hash(x, seed):
+    """
+    the hash of an item of a tuple: its stable_hash scrambled, so that items with nearby hashes
+    (e.g., small integers) do not give tuples nearby hashes
+    """
+    return int(_mix64(stable_hash(x, seed)) >> 1)
+
+
+def stable_hash(x, seed=0):
+    """
+    a stable hash of x, an integer, a string (unicode strings are hashed as their utf-8 bytes),
+    None or a tuple of them.  Integers from 0 up to 2**63 hash to themselves, as with the built-in
+    hash, so integer shingle ids (e.g., those of RollingShingler) are kept as they are.  Any other
+    value (e.g., a float) is hashed by the name of its type and its repr, which must not change
+    between processes.
+    """
+    if isinstance(x, tuple):
+        hashes = tuple(_token_hash(item, seed) for item in x)
+        return _hash_tuple(_seed_prefix(seed) + hashes) & _MAX63
+    if isinstance(x, (int, long)):
+        if 0 <= x < _MAX and not seed:
+            return x
+        return _finish(_start(seed, 0) ^ x)
+    if isinstance(x, str):
+        return _hash_bytes('s' + x, seed)
+    if isinstance(x, unicode):
+        return _hash_bytes('s' + x.encode('utf-8'), seed)
+    if x is None:
+        return _finish(_start(seed, 1))
+    return _hash_bytes('r%s:%r' % (type(x).__name__, x), seed)
+
+
+class TokenHashes(dict):
+    """
+    A dict of the hashes of tokens as items of tuples (for window_hashes), computing the hash of
+    each token the first time it is looked up.  It is emptied once it holds max_size tokens.
+    """
+
+    def __init__(self, seed=0, max_size=1 << 20):
+        dict.__init__(self)
+        self.seed = seed
+        self.max_size = max_size
+
+    def __missing__(self, token):
+        if len(self) >= self.max_size:
+            self.clear()
+        h = self[token] = _token_hash(token, self.seed)
+        return h
+
+    def hashes(self, tokens):
+        """
+        return a list of the hashes of tokens (of which some may be unhashable, e.g., lists)
+        """
+        try:
+            return map(self.__getitem__, tokens)
+        except TypeError:
+            return [_token_hash(token, self.seed) for token in tokens]
+
+
+def window_hashes(token_hashes, n, seed=0):
+    """
+    return a list of the stable_hash of each tuple of n consecutive tokens (of which there must be
+    at least n), given the list of the hashes of the tokens (see TokenHashes)
+    """
+    windows = zip(*[token_hashes[k:len(token_hashes) - n + 1 + k] for k in xrange(n)])
+    prefix = _seed_prefix(seed)
+    if prefix:
+        windows = [prefix + window for window in windows]
+    hash_tuple, mask = _hash_tuple, _MAX63
+    return [hash_tuple(window) & mask for window in windows]
+
+
+def band_hashes(sig, b, r, seed=0):
+    """
+    return the b bucket keys of the bands of r rows of the minhash signature sig, whose rows are
+    integers from 0 up to 2**63
+    """
+    prefix, hash_tuple, mask = _seed_prefix(seed), _hash_tuple, _MAX63
+    return [hash_tuple(prefix + tuple(sig[r * i:r * (i + 1)])) & mask for i in xrange(b)]
+
+
+def band_hash_matrix(sigs, b, r, seed=0):
+    """
+    return the (len(sigs) x b) int64 matrix of the band_hashes of each row of the matrix of
+    minhash signatures sigs, computed with vectorized operations over all the signatures
+    """
+    rows = np.asarray(sigs).astype(np.uint64).reshape(len(sigs), b, r)
+    return _tuple_hash_array([rows[:, :, k] for k in xrange(r)], _seed_prefix(seed))
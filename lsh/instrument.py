@@ -0,0 +1,183 @@
+"""
+Opt-in instrumentation of an LSHCache (see the instrument argument of LSHCache and its stats
+method): timings of each stage of hashing and looking up a document, counts of the candidate
+duplicates found and statistics of the sizes of the band buckets, which can be exported in the
+Prometheus text format with prometheus_text.
+
+The stages are
+    shingle:        shingling a document into its set of shingle ids (_get_shingle_vec)
+    minhash:        computing the minhash signature of a document (_get_sig)
+    minhash_batch:  computing the signatures of a chunk of documents with the numpy engine
+    band_hash:      hashing the bands of a signature (_get_lsh)
+    band_hash_batch: hashing the bands of a chunk of signatures (_get_lshs)
+    reduce:         combining the buckets of a document into its duplicates (_reduce)
+Only the stages run in this process are timed, not those of the worker processes of
+insert_batch and get_dups_batch.
+"""
+import bisect
+import heapq
+import itertools as it
+from timeit import default_timer
+
+# the upper bounds (in seconds) of the buckets of the histograms of stage timings
+LATENCY_BUCKETS = (1e-5, 3e-5, 1e-4, 3e-4, 1e-3, 3e-3, 1e-2, 3e-2, 0.1, 0.3, 1.0, 3.0, 10.0)
+
+# the methods of an LSHCache timed as each stage
+STAGES = (('shingle', '_get_shingle_vec'),
+          ('minhash', '_get_sig'),
+          ('minhash_batch', '_get_sigs_numpy'),
+          ('band_hash', '_get_lsh'),
+          ('band_hash_batch', '_get_lshs'),
+          ('reduce', '_reduce'))
+
+
+class StageTimer(object):
+    """
+    The number of calls, total time and histogram of the times of a stage
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one for the times above every bucket
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def stats(self):
+        return {'count': self.count, 'seconds': self.total,
+                'histogram': zip(self.buckets + (float('inf'),), self.counts)}
+
+
+class Instruments(object):
+    """
+    The stage timers and candidate counters of an LSHCache
+    """
+
+    def __init__(self, clock=default_timer):
+        self.timers = dict((stage, StageTimer()) for stage, _ in STAGES)
+        self.reductions = 0
+        self.candidates = 0
+        self._clock = clock
+
+    def timed(self, stage, func):
+        """
+        wrap func to time each call as the given stage
+        """
+        timer, clock = self.timers[stage], self._clock
+
+        def timed_func(*args, **kwargs):
+            start = clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timer.observe(clock() - start)
+        return timed_func
+
+    def counted(self, func):
+        """
+        wrap a reduce function to count the candidate duplicates it returns
+        """
+        def counted_func(*args, **kwargs):
+            dups = func(*args, **kwargs)
+            self.reductions += 1
+            self.candidates += len(dups)
+            return dups
+        return counted_func
+
+    def instrument(self, cache):
+        """
+        replace the methods of each stage of cache with timed (and counted) ones
+        """
+        for stage, name in STAGES:
+            if hasattr(cache, name):
+                setattr(cache, name, self.timed(stage, getattr(cache, name)))
+        cache._reduce = self.counted(cache._reduce)
+
+    def stats(self):
+        return {'stages': dict((stage, timer.stats()) for stage, timer in self.timers.iteritems()),
+                'reductions': self.reductions,
+                'candidates': self.candidates}
+
+
+def bucket_stats(tables, top=10):
+    """
+    statistics of the buckets of the band tables: for each band its number of buckets, postings
+    and the size of its largest bucket, the distribution of bucket sizes over every band (as a
+    histogram of (upper bound, count) with power of two bounds) and the top largest buckets
+    (as (size, band, key))
+    """
+    bands = []
+    sizes = {}
+    largest = []
+    for band, table in enumerate(tables):
+        band_sizes = [(len(doc_ids), key) for key, doc_ids in table.iteritems()]
+        bands.append({'buckets': len(band_sizes),
+                      'postings': sum(size for size, _ in band_sizes),
+                      'largest': max(size for size, _ in band_sizes) if band_sizes else 0})
+        for size, _ in band_sizes:
+            bound = 1 << (size - 1).bit_length()
+            sizes[bound] = sizes.get(bound, 0) + 1
+        largest = heapq.nlargest(top, it.chain(largest, ((size, band, key) for size, key in band_sizes)))
+    return {'bands': bands,
+            'bucket_sizes': sorted(sizes.iteritems()),
+            'largest_buckets': largest}
+
+
+def _labels(**labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, value) for name, value in sorted(labels.iteritems()))
+
+
+def _histogram(lines, name, histogram, total, count, **labels):
+    cumulative = 0
+    for bound, bucket_count in histogram:
+        cumulative += bucket_count
+        lines.append('%s_bucket%s %d' % (name, _labels(le='+Inf' if bound == float('inf') else repr(bound), **labels),
+                                         cumulative))
+    if not histogram or histogram[-1][0] != float('inf'):
+        lines.append('%s_bucket%s %d' % (name, _labels(le='+Inf', **labels), count))
+    lines.append('%s_sum%s %r' % (name, _labels(**labels), total))
+    lines.append('%s_count%s %d' % (name, _labels(**labels), count))
+
+
+def prometheus_text(stats, prefix='lsh'):
+    """
+    format the stats of an LSHCache in the Prometheus text exposition format
+    """
+    lines = ['# TYPE %s_docs gauge' % prefix, '%s_docs %d' % (prefix, stats['num_docs'])]
+    if 'bands' in stats:
+        for metric in ('buckets', 'postings', 'largest'):
+            name = '%s_band_%s' % (prefix, metric)
+            lines.append('# TYPE %s gauge' % name)
+            lines.extend('%s%s %d' % (name, _labels(band=band), values[metric])
+                         for band, values in enumerate(stats['bands']))
+        name = '%s_bucket_size' % prefix
+        lines.append('# TYPE %s histogram' % name)
+        _histogram(lines, name, stats['bucket_sizes'], sum(band['postings'] for band in stats['bands']),
+                   sum(band['buckets'] for band in stats['bands']))
+        name = '%s_largest_bucket_size' % prefix
+        lines.append('# TYPE %s gauge' % name)
+        lines.extend('%s%s %d' % (name, _labels(rank=rank, band=band, key=key), size)
+                     for rank, (size, band, key) in enumerate(stats['largest_buckets']))
+    if 'stages' in stats:
+        name = '%s_stage_seconds' % prefix
+        lines.append('# TYPE %s histogram' % name)
+        for stage, timer in sorted(stats['stages'].iteritems()):
+            _histogram(lines, name, timer['histogram'], timer['seconds'], timer['count'], stage=stage)
+        for counter in ('reductions', 'candidates'):
+            lines.append('# TYPE %s_%s_total counter' % (prefix, counter))
+            lines.append('%s_%s_total %d' % (prefix, counter, stats[counter]))
+    if 'stop_bucket_events' in stats:
+        if 'stop_buckets' in stats:
+            lines.append('# TYPE %s_stop_buckets gauge' % prefix)
+            lines.append('%s_stop_buckets %d' % (prefix, stats['stop_buckets']))
+        name = '%s_stop_bucket_events_total' % prefix
+        lines.append('# TYPE %s counter' % name)
+        lines.extend('%s%s %d' % (name, _labels(event=event), count)
+                     for event, count in sorted(stats['stop_bucket_events'].iteritems()))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,659 @@
+"""
+The lsh command line tool (the lsh console script).
+
+    lsh dedup [options] [FILE ...]
+
+streams documents from files (or stdin) through an LSHCache and writes out their duplicates
+(see dedup_records), and
+
+    lsh serve [options]
+
+runs an HTTP/JSON near-duplicate detection service around an LSHCache, e.g.,
+
+    lsh serve --port 8080 -b 20 -r 5 --engine numpy
+
+    curl -d '{"doc": "you can put lipstick on a pig"}' localhost:8080/insert
+    {"doc_id": 0, "dups": []}
+
+Its endpoints are
+    POST /insert            insert {"doc": ..., "doc_id": ...} (doc_id is optional) and return
+                            its doc_id and the doc_ids of its duplicates
+    POST /query             return the doc_ids of the duplicates of {"doc": ...} without
+                            inserting it
+    POST /insert_or_query   return the duplicates of {"doc": ...}, inserting it only if it has
+                            none, as {"doc_id": ..., "inserted": ..., "dups": [...]} (without a
+                            doc_id if it was not inserted and none was given)
+    GET  /stats             the stats of the cache (see LSHCache.stats) as JSON
+    GET  /metrics           the stats of the cache in the Prometheus text format
+A doc is either a string, which is split on whitespace, or a list of tokens (strings or
+integers).  A request not processed within --request-timeout seconds gets a 503 (it may still
+be processed later).  The stats scan every bucket, so they are computed at most once every
+--stats-interval seconds.
+
+Each request is handled in its own thread, but the cache is only used by a single batching
+thread (see DedupService): it takes the requests waiting in its queue, up to batch_size of them
+or those arriving within max_wait seconds of the first, computes their signatures together (as a
+single signature matrix with the numpy engine) and then applies them in the order they arrived.
+Once max_pending requests are waiting, new ones are turned away with a 503 rather than queued.
+"""
+import argparse
+import BaseHTTPServer
+import gzip
+import json
+import logging
+import Queue
+import SocketServer
+import sys
+import threading
+import time
+from collections import deque, OrderedDict
+
+from lsh import LSHCache, Shingler, XORHashFamily, MultiplyHashFamily, OnePermutationHashFamily, \
+    CompactBandTable, DictBandTable
+from lsh.instrument import prometheus_text
+
+minhash_choices = {'xor': XORHashFamily,
+                   'multiply': MultiplyHashFamily,
+                   'one-permutation': OnePermutationHashFamily}
+
+band_table_choices = {'dict': DictBandTable,
+                      'compact': CompactBandTable}
+
+OPERATIONS = ('insert', 'query', 'insert_or_query')
+
+
+class Overloaded(Exception):
+    """
+    raised when a DedupService has max_pending requests waiting
+    """
+    pass
+
+
+class Timeout(Exception):
+    """
+    raised when a request of a DedupService is not processed in time
+    """
+    pass
+
+
+class _Request(object):
+    """
+    a request waiting in the queue of a DedupService, and its result once it is processed
+    """
+
+    def __init__(self, op, doc, doc_id):
+        self.op = op
+        self.doc = doc
+        self.doc_id = doc_id
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+
+    def finish(self, result=None, error=None):
+        self.result, self.error = result, error
+        self._done.set()
+
+    def wait(self, timeout=None):
+        """
+        wait for the request to be processed and return its result (or raise its error)
+        """
+        self._done.wait(timeout)
+        if not self._done.is_set():
+            raise Timeout("request was not processed within %s seconds" % timeout)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class DedupService(object):
+    """
+    Micro-batches insert and query requests into an LSHCache from any number of threads.
+
+    Requests are queued and processed by a single thread, batch_size at a time: the thread
+    waits up to max_wait seconds after the first request of a batch for more to arrive,
+    computes the band hashes of the documents of the whole batch at once and then applies
+    them in order, so the results are the same as processing the requests one by one.
+    At most max_pending requests are queued, submit raises Overloaded beyond that.  The stats of
+    the cache (which scan every bucket while holding up the batches) are computed at most once
+    every stats_interval seconds.
+    """
+
+    def __init__(self, cache, batch_size=64, max_wait=0.005, max_pending=1024, stats_interval=10.0):
+        assert batch_size >= 1, "batch_size must be positive"
+        assert max_wait >= 0, "max_wait must not be negative"
+        assert max_pending >= 1, "max_pending must be positive"
+        self.cache = cache
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.stats_interval = stats_interval
+        self._queue = Queue.Queue(max_pending)
+        # the cache is only changed while holding the lock, stats are read while holding it
+        self._lock = threading.Lock()
+        # the last stats of the cache and when they were computed
+        self._stats_lock = threading.Lock()
+        self._cache_stats = None
+        self._stats_time = None
+        self._thread = None
+        self.batches = 0
+        self.requests = 0
+        self.rejected = 0
+
+    def start(self):
+        assert self._thread is None, "service already started"
+        self._thread = threading.Thread(target=self._run, name='lsh-batcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        stop the batching thread once the requests already queued are processed
+        """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, op, doc, doc_id=None):
+        """
+        queue a request and return it (see _Request.wait), to be processed once the service is
+        started.  Raises Overloaded if max_pending requests are already waiting
+        """
+        assert op in OPERATIONS, "op must be one of %s" % (OPERATIONS,)
+        request = _Request(op, doc, doc_id)
+        try:
+            self._queue.put_nowait(request)
+        except Queue.Full:
+            self.rejected += 1
+            raise Overloaded("%d requests are already waiting" % self._queue.maxsize)
+        return request
+
+    def call(self, op, doc, doc_id=None, timeout=None):
+        """
+        submit a request and wait for its result
+        """
+        return self.submit(op, doc, doc_id).wait(timeout)
+
+    def stats(self):
+        with self._stats_lock:
+            now = time.time()
+            if self._stats_time is None or now - self._stats_time >= self.stats_interval:
+                with self._lock:
+                    self._cache_stats = self.cache.stats()
+                self._stats_time = now
+            stats = dict(self._cache_stats)
+        stats.update(num_docs=self.cache.num_docs(), batches=self.batches, requests=self.requests,
+                     rejected=self.rejected, pending=self._queue.qsize())
+        return stats
+
+    def _next_batch(self):
+        """
+        the next batch of requests: the first to arrive and those following it within max_wait
+        seconds, at most batch_size of them, ending with None if the service was stopped
+        """
+        batch = [self._queue.get()]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.batch_size and batch[-1] is not None:
+            try:
+                batch.append(self._queue.get(True, max(0.0, deadline - time.time()))
+                             if self.max_wait > 0 else self._queue.get_nowait())
+            except Queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        stopped = False
+        while not stopped:
+            batch = self._next_batch()
+            if batch[-1] is None:
+                stopped = True
+                batch.pop()
+                if not batch:
+                    break
+            try:
+                with self._lock:
+                    self._process(batch)
+            except Exception as e:
+                logging.exception("failed to process a batch of %d requests", len(batch))
+                for request in batch:
+                    if not request._done.is_set():
+                        request.finish(error=e)
+            self.batches += 1
+            self.requests += len(batch)
+
+    def _hash(self, batch):
+        """
+        the minhash signatures (or None) and band hashes of the documents of the requests of
+        batch, computed together.  If that fails, each document is hashed on its own and the
+        requests whose documents cannot be hashed are finished with the error.
+        """
+        try:
+            sigs, lshs = self.cache._get_lsh_from_docs([request.doc for request in batch])
+            return sigs or [None] * len(batch), lshs
+        except Exception:
+            logging.debug("failed to hash a batch of %d requests, hashing them one by one", len(batch))
+        sigs, lshs = [], []
+        for request in batch:
+            try:
+                request_sigs, request_lshs = self.cache._get_lsh_from_docs([request.doc])
+            except Exception as e:
+                request.finish(error=ValueError("cannot hash doc: %s" % e))
+                request_sigs, request_lshs = None, [None]
+            sigs.append(request_sigs[0] if request_sigs is not None else None)
+            lshs.extend(request_lshs)
+        return sigs, lshs
+
+    def _process(self, batch):
+        cache = self.cache
+        sigs, lshs = self._hash(batch)
+        for request, sig, lsh in zip(batch, sigs, lshs):
+            if lsh is None:
+                continue
+            try:
+                if request.op == 'query':
+                    result = {'dups': sorted(cache._get_dups_from_lsh(lsh, request.doc_id))}
+                else:
+                    dups = None
+                    if request.op == 'insert_or_query':
+                        dups = cache._get_dups_from_lsh(lsh, request.doc_id)
+                    if not dups:
+                        doc_id = request.doc_id if request.doc_id is not None else cache._new_doc_id()
+                        dups = cache._insert_lsh(lsh, doc_id, sig)
+                        result = {'doc_id': doc_id, 'dups': sorted(dups)}
+                        if request.op == 'insert_or_query':
+                            result['inserted'] = True
+                    else:
+                        result = {'inserted': False, 'dups': sorted(dups)}
+                        if request.doc_id is not None:
+                            result['doc_id'] = request.doc_id
+            except (AssertionError, ValueError) as e:
+                request.finish(error=ValueError(str(e)))
+            else:
+                request.finish(result)
+
+
+def _parse_doc(body):
+    """
+    the (document, doc_id) of the JSON body of a request
+    """
+    try:
+        request = json.loads(body)
+    except ValueError:
+        raise ValueError("request body is not JSON")
+    if not isinstance(request, dict) or 'doc' not in request:
+        raise ValueError("request must be a JSON object with a doc")
+    doc, doc_id = request['doc'], request.get('doc_id')
+    if isinstance(doc, basestring):
+        doc = doc.split()
+    elif not isinstance(doc, list) or \
+            not all(isinstance(token, (basestring, int, long)) and not isinstance(token, bool) for token in doc):
+        raise ValueError("doc must be a string or a list of tokens (strings or integers)")
+    if doc_id is not None and (not isinstance(doc_id, (int, long)) or isinstance(doc_id, bool)):
+        raise ValueError("doc_id must be an integer")
+    return doc, doc_id
+
+
+class DedupRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    the HTTP front end of the DedupService of its server
+    """
+    server_version = 'lsh/0.0.1'
+
+    def _send(self, status, body, content_type='application/json'):
+        if content_type == 'application/json':
+            body = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if status == 503:
+            self.send_header('Retry-After', '1')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path == '/stats':
+            self._send(200, service.stats())
+        elif self.path == '/metrics':
+            self._send(200, prometheus_text(service.stats()), 'text/plain; version=0.0.4')
+        else:
+            self._send(404, {'error': 'no such endpoint %s' % self.path})
+
+    def do_POST(self):
+        op = self.path.strip('/')
+        if op not in OPERATIONS:
+            self._send(404, {'error': 'no such endpoint %s' % self.path})
+            return
+        try:
+            doc, doc_id = _parse_doc(self.rfile.read(int(self.headers.getheader('Content-Length', 0))))
+            result = self.server.service.call(op, doc, doc_id, self.server.request_timeout)
+        except (Overloaded, Timeout) as e:
+            self._send(503, {'error': str(e)})
+        except ValueError as e:
+            self._send(400, {'error': str(e)})
+        except Exception as e:
+            self._send(500, {'error': str(e)})
+        else:
+            self._send(200, result)
+
+    def log_message(self, format, *args):
+        logging.debug("%s - %s", self.address_string(), format % args)
+
+
+class DedupServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    an HTTP server handling each request in its own thread with DedupRequestHandler, waiting up
+    to request_timeout seconds for the service to process each request
+    """
+    daemon_threads = True
+
+    def __init__(self, address, service, request_timeout=30.0):
+        BaseHTTPServer.HTTPServer.__init__(self, address, DedupRequestHandler)
+        self.service = service
+        self.request_timeout = request_timeout
+
+
+def add_cache_args(parser):
+    """
+    add the arguments of the LSHCache of a command to parser
+    """
+    group = parser.add_argument_group('LSH cache parameters')
+    group.add_argument("-b", "--num-bands", type=int,
+                       help="""number of bands in LSH cache""")
+    group.add_argument("-r", "--num-rows", type=int,
+                       help="""number of rows per band in LSH cache""")
+    group.add_argument("-n", "--num-total", type=int,
+                       help="""total number of rows in LSH cache""")
+    group.add_argument("-m", "--min-support", type=int, default=1,
+                       help="""minimum support of bands in LSH cache for match.  Defaults to %(default)s""")
+    group.add_argument("--minhash", choices=minhash_choices.keys(), default='multiply',
+                       help="""hash family of the minhash signatures.  Defaults to %(default)s""")
+    group.add_argument("--engine", choices=('python', 'numpy'), default='python',
+                       help="""how minhash signatures are computed.  Defaults to %(default)s""")
+    group.add_argument("--band-table", choices=band_table_choices.keys(), default='dict',
+                       help="""hash table of each band.  Defaults to %(default)s""")
+    group.add_argument("--sig-bits", type=int, choices=(1, 2, 4, 8),
+                       help="""number of bits per row of b-bit minhash signatures""")
+    group.add_argument("--shingle-len", type=int, default=2,
+                       help="""length of shingles generated from documents.  Defaults to %(default)s""")
+    group.add_argument("--max-bucket-size", type=int,
+                       help="""size at which buckets become stop buckets""")
+    group.add_argument("--max-docs", type=int,
+                       help="""largest number of documents kept, evicting the oldest""")
+    group.add_argument("--seed", type=int,
+                       help="""seed of the hash family, so that runs hash documents identically""")
+    group.add_argument("--load", metavar='FILE',
+                       help="""open a cache saved with LSHCache.save rather than creating one""")
+
+
+def make_cache(args):
+    """
+    the LSHCache described by the arguments of add_cache_args
+    """
+    if args.load:
+        return LSHCache.from_file(args.load)
+    return LSHCache(b=args.num_bands, r=args.num_rows, n=args.num_total, m=args.min_support,
+                    shingler=Shingler(args.shingle_len), minhash=minhash_choices[args.minhash],
+                    engine=args.engine, band_table=band_table_choices[args.band_table],
+                    sig_bits=args.sig_bits, max_bucket_size=args.max_bucket_size,
+                    max_docs=args.max_docs, seed=args.seed)
+
+
+def _open(path):
+    if path == '-':
+        return sys.stdin
+    if path.endswith('.gz'):
+        return gzip.open(path)
+    return open(path)
+
+
+def read_records(paths, format='lines', text_field='text', id_field=None):
+    """
+    yield the (id, text, line) of each document of the files (or stdin for '-'), one document
+    per line, either as plain text ('lines') or as JSON objects ('jsonl') holding the text in
+    text_field and, if id_field is given, the id of the document (otherwise the id is None).
+    Files ending in .gz are decompressed.  Blank lines are skipped.
+    """
+    for path in paths:
+        f = _open(path)
+        try:
+            for line in f:
+                line = line.rstrip('\r\n')
+                if not line.strip():
+                    continue
+                if format == 'lines':
+                    yield None, line, line
+                else:
+                    record = json.loads(line)
+                    yield record.get(id_field) if id_field else None, record[text_field], line
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+
+def read_ahead(iterable, size):
+    """
+    iterate over iterable in a background thread which keeps up to size items read ahead, so
+    that reading (and decompressing and parsing) the input overlaps with processing it
+    """
+    queue = Queue.Queue(size)
+    done = object()
+
+    def read():
+        try:
+            for item in iterable:
+                queue.put((item, None))
+        except Exception as e:
+            queue.put((done, e))
+        else:
+            queue.put((done, None))
+
+    thread = threading.Thread(target=read, name='lsh-read-ahead')
+    thread.daemon = True
+    thread.start()
+    while True:
+        item, error = queue.get()
+        if item is done:
+            if error is not None:
+                raise error
+            return
+        yield item
+
+
+tokenizers = {'words': lambda text: text.split(),
+              'chars': list}
+
+
+class _Progress(object):
+    """
+    logs the number of documents processed and their throughput every interval seconds
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.docs = 0
+        self.with_dups = 0
+        self.start = self.last = time.time()
+
+    def update(self, dups):
+        self.docs += 1
+        self.with_dups += bool(dups)
+        if self.interval and time.time() - self.last >= self.interval:
+            self.last = time.time()
+            self.log()
+
+    def log(self):
+        logging.info("%d docs, %d with duplicates, %.0f docs/s", self.docs, self.with_dups,
+                     self.docs / max(time.time() - self.start, 1e-9))
+
+
+def dedup_records(cache, records, output='dups', chunk_size=1000, workers=None,
+                  tokenize=tokenizers['words'], progress_interval=None):
+    """
+    insert the (id, text, line) records (see read_records) into cache, chunk_size documents at
+    a time (see LSHCache.insert_iter), and yield the output for each document as it is inserted:
+        'dups':     {"id": ..., "dups": [...]} for each document with duplicates
+        'clusters': {"id": ..., "cluster": ...} for each document, its cluster being that of
+                    its earliest duplicate, or its own id if it has none
+        'unique':   the line of each document without duplicates
+    The id of a document is the id of its record or, if it has none, its doc_id in the cache.
+    Only a few chunks of records are held at a time, along with the ids (and clusters) of the
+    documents still in the cache, so records can be a stream of any length if the cache is
+    bounded (with max_docs or max_age).
+    """
+    assert output in ('dups', 'clusters', 'unique'), "output must be 'dups', 'clusters' or 'unique'"
+    progress = _Progress(progress_interval)
+    first_id = cache.max_doc_id() + 1
+    # the (id, line) of the records read ahead by insert_iter but not yet output
+    pending = deque()
+    # the record ids of the doc_ids of records having one, in the order inserted
+    ids = OrderedDict()
+    # the cluster (as the id output) of each doc_id from clusters_start on
+    clusters = []
+    clusters_start = first_id
+
+    def docs():
+        for record_id, text, line in records:
+            pending.append((record_id, line))
+            yield tokenize(text)
+
+    for doc_id, dups in cache.insert_iter(docs(), chunk_size, workers):
+        record_id, line = pending.popleft()
+        if record_id is not None:
+            ids[doc_id] = record_id
+        progress.update(dups)
+        result = None
+        if output == 'dups':
+            if dups:
+                result = {'id': ids.get(doc_id, doc_id), 'dups': [ids.get(dup, dup) for dup in sorted(dups)]}
+        elif output == 'clusters':
+            cluster = min(dups) if dups else doc_id
+            if clusters_start <= cluster < doc_id:
+                cluster = clusters[cluster - clusters_start]
+            else:
+                cluster = ids.get(cluster, cluster)
+            clusters.append(cluster)
+            result = {'id': ids.get(doc_id, doc_id), 'cluster': cluster}
+        elif not dups:
+            result = line
+        # forget the ids and clusters of the documents the cache has evicted, which are no
+        # longer anyone's duplicates (dropping those of clusters once they are half of it)
+        oldest = cache.oldest_doc_id()
+        if oldest is not None:
+            while ids and next(ids.iterkeys()) < oldest:
+                ids.popitem(last=False)
+            if oldest - clusters_start > len(clusters) // 2:
+                del clusters[:oldest - clusters_start]
+                clusters_start = oldest
+        if result is not None:
+            yield result
+    if progress_interval:
+        progress.log()
+
+
+def dedup(args):
+    cache = make_cache(args)
+    records = read_ahead(read_records(args.files or ['-'], args.format, args.text_field, args.id_field),
+                         args.read_ahead)
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        for result in dedup_records(cache, records, args.write, args.chunk_size, args.workers,
+                                    tokenizers[args.tokens], args.progress):
+            out.write((result if args.write == 'unique' else json.dumps(result)) + '\n')
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    if args.save:
+        cache.save(args.save)
+    return 0
+
+
+def serve(args):
+    service = DedupService(make_cache(args), args.batch_size, args.max_wait, args.max_pending,
+                           args.stats_interval)
+    server = DedupServer((args.host, args.port), service, args.request_timeout)
+    service.start()
+    logging.info("serving on %s:%d", *server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
+        if args.save:
+            service.cache.save(args.save)
+    return 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='lsh', description="Near-duplicate document detection with LSH")
+    parser.add_argument('--log', default='info',
+                        choices=('debug', 'info', 'warning', 'error', 'critical'),
+                        help='level of logging to capture')
+    commands = parser.add_subparsers(title='commands')
+
+    dedup_parser = commands.add_parser('dedup', help="find the duplicates of a stream of documents")
+    dedup_parser.set_defaults(command=dedup)
+    dedup_parser.add_argument("files", nargs='*', metavar='FILE',
+                              help="""files of one document per line (.gz files are decompressed).
+                                   Defaults to stdin""")
+    dedup_parser.add_argument("--format", choices=('lines', 'jsonl'), default='lines',
+                              help="""documents as lines of text or JSON objects.  Defaults to %(default)s""")
+    dedup_parser.add_argument("--text-field", default='text',
+                              help="""field of the text of JSON documents.  Defaults to %(default)s""")
+    dedup_parser.add_argument("--id-field",
+                              help="""field of the id of JSON documents.  Defaults to their doc_id""")
+    dedup_parser.add_argument("--tokens", choices=sorted(tokenizers), default='words',
+                              help="""whether documents are shingled by words or characters.
+                                   Defaults to %(default)s""")
+    dedup_parser.add_argument("--write", choices=('dups', 'clusters', 'unique'), default='dups',
+                              help="""write the duplicates of each document with any, the cluster of
+                                   every document or the documents without duplicates.  Defaults to %(default)s""")
+    dedup_parser.add_argument("-o", "--output", metavar='FILE',
+                              help="""file to write to.  Defaults to stdout""")
+    dedup_parser.add_argument("--chunk-size", type=int, default=1000,
+                              help="""documents hashed together.  Defaults to %(default)s""")
+    dedup_parser.add_argument("--workers", type=int,
+                              help="""number of worker processes hashing documents""")
+    dedup_parser.add_argument("--read-ahead", type=int, default=10000,
+                              help="""documents read ahead of those being hashed.  Defaults to %(default)s""")
+    dedup_parser.add_argument("--progress", type=float, default=10,
+                              help="""seconds between progress reports (0 for none).  Defaults to %(default)s""")
+    dedup_parser.add_argument("--save", metavar='FILE',
+                              help="""save the cache to FILE once done""")
+    add_cache_args(dedup_parser)
+
+    serve_parser = commands.add_parser('serve', help="run an HTTP/JSON dedup service")
+    serve_parser.set_defaults(command=serve)
+    serve_parser.add_argument("--host", default='localhost',
+                              help="""address to listen on.  Defaults to %(default)s""")
+    serve_parser.add_argument("--port", type=int, default=8080,
+                              help="""port to listen on.  Defaults to %(default)s""")
+    serve_parser.add_argument("--batch-size", type=int, default=64,
+                              help="""largest number of requests processed together.  Defaults to %(default)s""")
+    serve_parser.add_argument("--max-wait", type=float, default=0.005,
+                              help="""seconds to wait for more requests to batch.  Defaults to %(default)s""")
+    serve_parser.add_argument("--max-pending", type=int, default=1024,
+                              help="""number of waiting requests beyond which requests are turned away.
+                                   Defaults to %(default)s""")
+    serve_parser.add_argument("--request-timeout", type=float, default=30.0,
+                              help="""seconds to wait for a request to be processed.  Defaults to %(default)s""")
+    serve_parser.add_argument("--stats-interval", type=float, default=10.0,
+                              help="""seconds for which the stats of the cache are reused.
+                                   Defaults to %(default)s""")
+    serve_parser.add_argument("--save", metavar='FILE',
+                              help="""save the cache to FILE when the server stops""")
+    add_cache_args(serve_parser)
+
+    args = parser.parse_args(argv)
+    logging.getLogger().setLevel(getattr(logging, args.log.upper()))
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    return args.command(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,478 @@
+"""
+Saving an LSHCache to disk in a compact binary format which can be opened memory-mapped.
+
+The file is laid out as
+    magic (8 bytes) | header length (8 bytes) | header (json) | arrays
+The header holds the parameters of the cache (including the hash family parameters) along with
+the offset, dtype and shape of each of the arrays.  Every array is little endian and 8-byte
+aligned so that it can be mapped directly from the file.  The arrays are
+    band_starts:    (b+1) offsets into keys of the buckets of each band
+    keys:           the bucket keys (band hashes) of each band, sorted within each band
+    posting_starts: (len(keys)+1) offsets into postings of the doc_ids of each bucket
+    postings:       the doc_ids of all the buckets
+    seen_ids:       the sorted doc_ids which have been inserted into the cache
+    seen_lsh:       (len(seen_ids) x b) band hashes of each doc_id (only if signatures are stored)
+    minhashes:      (k x n) 32-bit minhash signatures of doc_ids 0 to k-1, or the packed bytes of
+                    b-bit signatures (only if minhashes are stored)
+    minhash_present: whether each row of minhashes holds a signature (only if minhashes are stored)
+    order_ids:      the doc_ids in insertion order (only for bounded caches)
+    order_times:    the insertion time of each of order_ids (only for bounded caches)
+
+When opened memory-mapped, lookups binary search the mapped arrays (and the minhash signatures
+and insertion times are used as they are) so that opening the file is nearly instant and
+processes opening the same file share its pages.  Documents can still be inserted into a mapped
+cache: any bucket that is inserted into is copied into memory, and the minhash signatures are
+mapped copy-on-write.
+"""
+import importlib
+import json
+import os
+import struct
+from collections import OrderedDict
+
+from lsh.storage import MemoryStorage
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+MAGIC = 'LSHIDX\x00\x01'
+# version 2 files hold stable band hashes (see lsh.hashing) rather than those of the built-in hash,
+# version 3 files hold the minhash signatures by doc_id so that they can be mapped,
+# version 4 files hold band hashes (and shingle ids) computed with the tuple hash of lsh.hashing
+VERSION = 4
+_ALIGN = 8
+_INT = '<i8'
+_UINT32 = '<u4'
+# the arrays mapped copy-on-write rather than read-only
+_WRITABLE = ('minhashes', 'minhash_present')
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError("numpy is required to save and load LSH caches")
+
+
+def _dump_callable(func):
+    """
+    describe a module level function (or builtin) by its module and name
+    """
+    module = getattr(func, '__module__', None) or '__builtin__'
+    name = func.__name__
+    if name == '<lambda>' or getattr(importlib.import_module(module), name, None) is not func:
+        raise ValueError("cannot save %r, it is not a module level function" % func)
+    return {'module': module, 'name': name}
+
+
+def _dump_object(obj):
+    """
+    describe an object (e.g., a shingler or a hash family) by its class and its attributes
+    """
+    cls = obj.__class__
+    state = obj.__getstate__() if hasattr(obj, '__getstate__') else dict(obj.__dict__)
+    try:
+        json.dumps(state)
+    except (TypeError, ValueError):
+        raise ValueError("cannot save %r, its attributes are not json serializable" % obj)
+    return {'module': cls.__module__, 'name': cls.__name__, 'state': state}
+
+
+def _load_attr(desc):
+    return getattr(importlib.import_module(desc['module']), desc['name'])
+
+
+def _load_object(desc):
+    cls = _load_attr(desc)
+    obj = cls.__new__(cls)
+    if hasattr(obj, '__setstate__'):
+        obj.__setstate__(desc['state'])
+    else:
+        obj.__dict__.update(desc['state'])
+    return obj
+
+
+def _band_arrays(band_tables):
+    """
+    lay out the non-empty buckets of each band table in CSR form
+    """
+    band_starts, keys, posting_starts, postings = [0], [], [0], []
+    for table in band_tables:
+        for key, bucket in sorted(table.iteritems()):
+            if len(bucket):
+                keys.append(key)
+                postings.extend(bucket)
+                posting_starts.append(len(postings))
+        band_starts.append(len(keys))
+    return {'band_starts': band_starts, 'keys': keys,
+            'posting_starts': posting_starts, 'postings': postings}
+
+
+def params(cache):
+    """
+    the parameters of cache, including those of its shingler and hash family, as a json
+    serializable dict
+    """
+    return {
+        'b': cache._b, 'r': cache._r, 'n': cache._n, 'm': cache._m,
+        'universe_size': cache._universe_size,
+        'store_signatures': cache._store_signatures,
+        'store_minhashes': cache._minhashes is not None,
+        'sig_bits': cache._sig_bits,
+        'max_docs': cache._max_docs, 'max_age': cache._max_age,
+        'max_bucket_size': cache._max_bucket_size,
+        'stop_bucket_policy': cache._stop_bucket_policy,
+        'stop_bucket_sample': cache._stop_bucket_sample,
+        'engine': cache._engine,
+        'band_table': _dump_callable(cache._band_table),
+        'shingler': _dump_object(cache._shingler),
+        'shingle_hash': _dump_callable(cache._shingle_hash),
+        'minhash': _dump_object(cache._hash_family) if cache._hash_family is not None \
+            else {'function': _dump_callable(cache._minhash)},
+    }
+
+
+def from_params(cls, params, **kwargs):
+    """
+    create an empty instance of the LSHCache class cls with params (as returned by params).
+    Any additional arguments are passed on to the constructor
+    """
+    kwargs = dict({
+        'b': params['b'], 'r': params['r'], 'm': params['m'],
+        'universe_size': params['universe_size'],
+        'store_signatures': params['store_signatures'],
+        'store_minhashes': params['store_minhashes'],
+        'sig_bits': params.get('sig_bits'),
+        'max_docs': params['max_docs'], 'max_age': params['max_age'],
+        'max_bucket_size': params.get('max_bucket_size'),
+        'stop_bucket_policy': params.get('stop_bucket_policy', 'skip'),
+        'stop_bucket_sample': params.get('stop_bucket_sample', 100),
+        'engine': params['engine'],
+        'band_table': _load_attr(params['band_table']),
+        'shingler': _load_object(params['shingler']),
+        'shingle_hash': _load_attr(params['shingle_hash']),
+        'minhash': _load_attr(params['minhash']['function']) if 'function' in params['minhash'] \
+            else _load_object(params['minhash']),
+    }, **kwargs)
+    return cls(**kwargs)
+
+
+def save(cache, path):
+    """
+    save the cache to path.  The file is written to a temporary file first and renamed into
+    place, so a reader never sees a partially written file
+    """
+    _require_numpy()
+    storage = cache._storage
+    if not isinstance(storage, MemoryStorage):
+        raise ValueError("only caches with a MemoryStorage can be saved, not %r" % storage)
+    header = params(cache)
+    header.update(version=VERSION, next_id=cache._next_id)
+
+    arrays = _band_arrays(storage.tables)
+    seen = sorted(storage.seen.iteritems())
+    arrays['seen_ids'] = [doc_id for doc_id, _ in seen]
+    if cache._store_signatures:
+        arrays['seen_lsh'] = np.array([lsh for _, lsh in seen], dtype=_INT).reshape(len(seen), cache._b)
+    arrays = dict((name, np.ascontiguousarray(values, dtype=_INT)) for name, values in arrays.iteritems())
+    if cache._minhashes is not None:
+        ids = np.flatnonzero(cache._minhashes._present)
+        end = ids[-1] + 1 if len(ids) else 0
+        arrays['minhash_present'] = np.ascontiguousarray(cache._minhashes._present[:end])
+        arrays['minhashes'] = np.ascontiguousarray(cache._minhashes._sigs[:end],
+                                                   dtype=_UINT32 if cache._sig_bits is None else np.uint8)
+    if cache._insert_times is not None:
+        arrays['order_ids'] = np.array(cache._insert_times.keys(), dtype=_INT)
+        arrays['order_times'] = np.array(cache._insert_times.values(), dtype='<f8')
+
+    # header lengths depend on the offsets, so lay out the arrays relative to the header end
+    offset = 0
+    header['arrays'] = {}
+    for name in sorted(arrays):
+        header['arrays'][name] = {'offset': offset, 'dtype': arrays[name].dtype.str,
+                                  'shape': arrays[name].shape}
+        offset += -(-arrays[name].nbytes // _ALIGN) * _ALIGN
+    encoded = json.dumps(header)
+    start = -(-(len(MAGIC) + 8 + len(encoded)) // _ALIGN) * _ALIGN
+    encoded += ' ' * (start - len(MAGIC) - 8 - len(encoded))
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(encoded)))
+        f.write(encoded)
+        for name in sorted(arrays):
+            f.seek(start + header['arrays'][name]['offset'])
+            f.write(arrays[name].tostring())
+        f.truncate(start + offset)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+
+
+def read_header(path):
+    """
+    read the header of a saved cache, returning the header and the offset of the arrays
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(len(MAGIC))
+        if magic != MAGIC:
+            raise ValueError("%s is not an LSH cache file" % path)
+        header_len, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_len))
+    if header['version'] != VERSION:
+        raise ValueError("unsupported LSH cache file version %s" % header['version'])
+    return header, len(MAGIC) + 8 + header_len
+
+
+def _read_arrays(path, header, start, mmap):
+    arrays = {}
+    for name, desc in header['arrays'].iteritems():
+        shape = tuple(desc['shape'])
+        count = int(np.prod(shape))
+        if mmap and count:
+            # the minhash signatures are stored into in place, without writing to the file
+            arrays[name] = np.memmap(path, dtype=desc['dtype'], mode='c' if name in _WRITABLE else 'r',
+                                     offset=start + desc['offset'], shape=shape)
+        else:
+            with open(path, 'rb') as f:
+                f.seek(start + desc['offset'])
+                arrays[name] = np.fromfile(f, dtype=desc['dtype'], count=count).reshape(shape)
+    return arrays
+
+
+def load(cls, path, mmap=True, **kwargs):
+    """
+    create an instance of the LSHCache class cls (with a MemoryStorage) from the cache saved at
+    path.  If mmap is True, the band tables and seen doc_ids are left in the file and memory mapped.  Any
+    additional arguments are passed on to the constructor, which allows overriding, e.g.,
+    the engine or a shingle_hash function that could not be saved.
+    """
+    _require_numpy()
+    header, start = read_header(path)
+    cache = from_params(cls, header, **kwargs)
+
+    arrays = _read_arrays(path, header, start, mmap)
+    band_starts = arrays['band_starts']
+    tables = []
+    for i in xrange(cache._b):
+        begin, end = int(band_starts[i]), int(band_starts[i + 1])
+        keys = arrays['keys'][begin:end]
+        posting_starts = arrays['posting_starts'][begin:end + 1]
+        if mmap:
+            tables.append(MappedBandTable(keys, posting_starts, arrays['postings']))
+        else:
+            table = cache._band_table()
+            postings = arrays['postings'].tolist()
+            for key, p_begin, p_end in zip(keys.tolist(), posting_starts[:-1].tolist(),
+                                           posting_starts[1:].tolist()):
+                for doc_id in postings[p_begin:p_end]:
+                    table.append(key, doc_id)
+            tables.append(table)
+
+    seen_lsh = arrays.get('seen_lsh')
+    if mmap:
+        seen = MappedSeen(arrays['seen_ids'], seen_lsh)
+    elif seen_lsh is not None:
+        seen = dict(zip(arrays['seen_ids'].tolist(), seen_lsh.tolist()))
+    else:
+        seen = dict.fromkeys(arrays['seen_ids'].tolist())
+
+    if 'minhashes' in arrays and cache._minhashes is not None:
+        cache._minhashes.load(arrays['minhashes'], arrays['minhash_present'])
+
+    if 'order_ids' in arrays and cache._insert_times is not None:
+        if mmap:
+            cache._insert_times = MappedInsertTimes(arrays['order_ids'], arrays['order_times'])
+        else:
+            cache._insert_times.update(zip(arrays['order_ids'].tolist(), arrays['order_times'].tolist()))
+
+    cache._storage.tables = tables
+    cache._storage.seen = seen
+    cache._next_id = header['next_id']
+    return cache
+
+
+class MappedBandTable(object):
+    """
+    A band table (see lsh.bands) whose buckets are held in sorted (memory mapped) arrays.
+    Appending to a bucket copies that bucket into an in-memory overlay.
+    """
+
+    def __init__(self, keys, posting_starts, postings):
+        self._keys = keys
+        self._posting_starts = posting_starts
+        self._postings = postings
+        self._overlay = {}
+
+    def _find(self, key):
+        """
+        return the index of key in the mapped keys or -1 if it is not there
+        """
+        i = int(np.searchsorted(self._keys, key))
+        if i < len(self._keys) and self._keys[i] == key:
+            return i
+        return -1
+
+    def _mapped_bucket(self, i):
+        return self._postings[self._posting_starts[i]:self._posting_starts[i + 1]].tolist()
+
+    def get(self, key, default=None):
+        if key in self._overlay:
+            return self._overlay[key] or default
+        i = self._find(key)
+        if i < 0:
+            return default
+        # the mapped doc_ids themselves, read-only
+        return self._postings[self._posting_starts[i]:self._posting_starts[i + 1]]
+
+    def __getitem__(self, key):
+        bucket = self._overlay.get(key)
+        if bucket is None:
+            i = self._find(key)
+            bucket = self._overlay[key] = self._mapped_bucket(i) if i >= 0 else []
+        return bucket
+
+    def append(self, key, doc_id):
+        self[key].append(doc_id)
+
+    def remove(self, key, doc_id):
+        bucket = self[key]
+        bucket.remove(doc_id)
+        # an emptied bucket of the mapped arrays is kept (empty) to hide the mapped one
+        if not bucket and self._find(key) < 0:
+            del self._overlay[key]
+
+    def __contains__(self, key):
+        if key in self._overlay:
+            return bool(self._overlay[key])
+        return self._find(key) >= 0
+
+    def __len__(self):
+        mapped = [self._find(key) >= 0 for key in self._overlay]
+        return len(self._keys) + mapped.count(False) - \
+            sum(1 for bucket, in_keys in zip(self._overlay.itervalues(), mapped) if in_keys and not bucket)
+
+    def iteritems(self):
+        for i, key in enumerate(self._keys.tolist()):
+            if key not in self._overlay:
+                yield key, self._mapped_bucket(i)
+        for key, bucket in self._overlay.iteritems():
+            if bucket:
+                yield key, bucket
+
+
+class MappedSeen(object):
+    """
+    The map of inserted doc_ids (to their band hashes, if signatures are stored) held in sorted
+    (memory mapped) arrays.  Newly inserted doc_ids are kept in an in-memory overlay and removed
+    doc_ids of the arrays in a set of removed doc_ids.
+    """
+
+    def __init__(self, ids, lshs=None):
+        self._ids = ids
+        self._lshs = lshs
+        self._overlay = {}
+        self._removed = set()
+
+    def _find(self, doc_id):
+        if doc_id in self._removed:
+            return -1
+        i = int(np.searchsorted(self._ids, doc_id))
+        if i < len(self._ids) and self._ids[i] == doc_id:
+            return i
+        return -1
+
+    def __contains__(self, doc_id):
+        return doc_id in self._overlay or self._find(doc_id) >= 0
+
+    def __getitem__(self, doc_id):
+        if doc_id in self._overlay:
+            return self._overlay[doc_id]
+        i = self._find(doc_id)
+        if i < 0:
+            raise KeyError(doc_id)
+        return self._lshs[i].tolist() if self._lshs is not None else None
+
+    def __setitem__(self, doc_id, lsh):
+        self._overlay[doc_id] = lsh
+
+    def __delitem__(self, doc_id):
+        if doc_id in self._overlay:
+            del self._overlay[doc_id]
+        elif self._find(doc_id) >= 0:
+            self._removed.add(doc_id)
+        else:
+            raise KeyError(doc_id)
+
+    def __len__(self):
+        return len(self._ids) - len(self._removed) + \
+            sum(1 for doc_id in self._overlay if self._find(doc_id) < 0)
+
+    def iteritems(self):
+        for doc_id in self._ids.tolist():
+            if doc_id not in self._overlay and doc_id not in self._removed:
+                yield doc_id, self[doc_id]
+        for item in self._overlay.iteritems():
+            yield item
+
+
+class MappedInsertTimes(object):
+    """
+    The insertion time of each doc_id of a bounded cache, oldest first, held in (memory mapped)
+    arrays in insertion order.  It supports the operations of the OrderedDict of LSHCache: the
+    oldest documents are evicted from the front of the arrays, documents removed elsewhere are
+    kept in a set of removed doc_ids and newly inserted documents in an in-memory overlay.
+    Only doc_ids of the cache are removed, so they are not looked up in the arrays.
+    """
+
+    def __init__(self, ids, times):
+        self._ids = ids
+        self._times = times
+        self._start = 0
+        self._removed = set()
+        self._overlay = OrderedDict()
+
+    def _skip_removed(self):
+        while self._start < len(self._ids) and int(self._ids[self._start]) in self._removed:
+            self._removed.discard(int(self._ids[self._start]))
+            self._start += 1
+
+    def __len__(self):
+        return len(self._ids) - self._start - len(self._removed) + len(self._overlay)
+
+    def __setitem__(self, doc_id, insert_time):
+        self._overlay[doc_id] = insert_time
+
+    def pop(self, doc_id, default=None):
+        if doc_id in self._overlay:
+            return self._overlay.pop(doc_id)
+        self._removed.add(doc_id)
+        self._skip_removed()
+        return default
+
+    def clear(self):
+        self._start = len(self._ids)
+        self._removed.clear()
+        self._overlay.clear()
+
+    def iteritems(self):
+        self._skip_removed()
+        for i in xrange(self._start, len(self._ids)):
+            doc_id = int(self._ids[i])
+            if doc_id not in self._removed:
+                yield doc_id, float(self._times[i])
+        for item in self._overlay.iteritems():
+            yield item
+
+    def iterkeys(self):
+        return (doc_id for doc_id, _ in self.iteritems())
+
+    def itervalues(self):
+        return (insert_time for _, insert_time in self.iteritems())
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
@@ -0,0 +1,178 @@
+"""
+A storage backend which keeps the band buckets and seen doc_ids of an LSHCache in a Redis server
+(or anything else speaking the Redis protocol), so that several processes can share one index.
+
+Each bucket is a Redis set of doc_ids named prefix:band:<band>:<key> and the seen doc_ids are a
+hash named prefix:seen mapping each doc_id to its comma separated band hashes (or an empty string
+if signatures are not stored).  The bucket lookups of a document are sent as a single pipeline of
+SMEMBERS commands, one per band, and the lookups of a batch of documents (see
+LSHCache.get_dups_batch) as a single pipeline for all of them.
+
+Several processes can insert into the same index: the doc_ids of documents inserted without one
+are allocated with INCR on prefix:next_id, and a document is inserted by a Lua script (a single
+EVAL, run atomically by the server) which records its doc_id as seen with HSETNX and only then
+adds it to its buckets, so two processes cannot both insert the same doc_id and a document is
+never left seen but missing from its buckets.
+"""
+import itertools as it
+import socket
+
+from lsh.storage import IStorage
+
+# KEYS: the seen hash and the buckets of the document, ARGV: its doc_id and its stored band hashes
+_INSERT_SCRIPT = """\
+if redis.call('HSETNX', KEYS[1], ARGV[1], ARGV[2]) == 0 then
+    return 0
+end
+for i = 2, #KEYS do
+    redis.call('SADD', KEYS[i], ARGV[1])
+end
+return 1
+"""
+
+
+class RedisError(Exception):
+    """
+    an error reply from the server
+    """
+    pass
+
+
+class RedisConnection(object):
+    """
+    A minimal client of the Redis protocol (RESP) supporting single commands and pipelines
+    """
+
+    def __init__(self, host='localhost', port=6379, timeout=None):
+        self._sock = socket.create_connection((host, port), timeout)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._file = self._sock.makefile('rb')
+
+    @staticmethod
+    def _encode(args):
+        parts = ['*%d\r\n' % len(args)]
+        for arg in args:
+            arg = str(arg)
+            parts.append('$%d\r\n%s\r\n' % (len(arg), arg))
+        return ''.join(parts)
+
+    def _read_reply(self):
+        line = self._file.readline()
+        if not line:
+            raise RedisError("connection closed by server")
+        kind, rest = line[0], line[1:-2]
+        if kind == '+':
+            return rest
+        if kind == '-':
+            return RedisError(rest)
+        if kind == ':':
+            return int(rest)
+        if kind == '$':
+            length = int(rest)
+            if length < 0:
+                return None
+            data = self._file.read(length + 2)
+            return data[:-2]
+        if kind == '*':
+            length = int(rest)
+            if length < 0:
+                return None
+            return [self._read_reply() for _ in xrange(length)]
+        raise RedisError("unknown reply %r" % line)
+
+    def pipeline(self, commands):
+        """
+        send a sequence of commands (each a sequence of arguments) in one round trip and return
+        the list of their replies
+        """
+        commands = list(commands)
+        if not commands:
+            return []
+        self._sock.sendall(''.join(self._encode(command) for command in commands))
+        replies = [self._read_reply() for _ in commands]
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+    def execute(self, *args):
+        return self.pipeline([args])[0]
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+
+class RedisStorage(IStorage):
+    """
+    Keeps the band buckets and seen doc_ids of an LSHCache in a Redis server under the given
+    key prefix.  connection is a RedisConnection (or anything with a compatible pipeline method).
+    """
+
+    def __init__(self, connection, prefix='lsh'):
+        self._conn = connection
+        self._prefix = prefix
+        self._seen_key = '%s:seen' % prefix
+        self._next_id_key = '%s:next_id' % prefix
+
+    def _bucket_key(self, band, band_bucket):
+        return '%s:band:%d:%d' % (self._prefix, band, band_bucket)
+
+    def open(self, num_bands):
+        pass
+
+    def clear(self, num_bands):
+        # SCAN rather than KEYS, which would block a server shared with other clients
+        cursor = '0'
+        while True:
+            cursor, keys = self._conn.execute('SCAN', cursor, 'MATCH', '%s:*' % self._prefix, 'COUNT', 1000)
+            if keys:
+                self._conn.execute('DEL', *keys)
+            if cursor == '0':
+                break
+
+    def get_buckets(self, lsh):
+        replies = self._conn.pipeline(('SMEMBERS', self._bucket_key(i, band_bucket))
+                                      for i, band_bucket in enumerate(lsh))
+        return [sorted(map(int, members)) for members in replies]
+
+    def get_buckets_batch(self, lshs):
+        # a single pipeline for the buckets of every LSH vector
+        replies = self._conn.pipeline(('SMEMBERS', self._bucket_key(i, band_bucket))
+                                      for lsh in lshs for i, band_bucket in enumerate(lsh))
+        buckets = iter([sorted(map(int, members)) for members in replies])
+        return [list(it.islice(buckets, len(lsh))) for lsh in lshs]
+
+    def new_doc_id(self, next_id):
+        # skipping the doc_ids given explicitly to documents inserted before
+        while True:
+            doc_id = self._conn.execute('INCR', self._next_id_key) - 1
+            if not self.has_doc(doc_id):
+                return doc_id
+
+    def insert(self, lsh, doc_id, stored=None):
+        # claims doc_id and adds it to its buckets atomically, so that of two processes inserting
+        # it only one adds it to buckets
+        keys = [self._seen_key] + [self._bucket_key(i, band_bucket)
+                                   for i, band_bucket in enumerate(lsh) if band_bucket is not None]
+        args = [doc_id, ','.join(map(str, stored)) if stored is not None else '']
+        if not self._conn.execute('EVAL', _INSERT_SCRIPT, len(keys), *(keys + args)):
+            raise ValueError("Document with doc_id %d has already been inserted" % doc_id)
+
+    def remove(self, lsh, doc_id):
+        commands = [('SREM', self._bucket_key(i, band_bucket), doc_id)
+                    for i, band_bucket in enumerate(lsh) if band_bucket is not None]
+        commands.append(('HDEL', self._seen_key, doc_id))
+        self._conn.pipeline(commands)
+
+    def has_doc(self, doc_id):
+        return bool(self._conn.execute('HEXISTS', self._seen_key, doc_id))
+
+    def get_doc(self, doc_id):
+        stored = self._conn.execute('HGET', self._seen_key, doc_id)
+        if stored is None:
+            raise KeyError(doc_id)
+        return map(int, stored.split(',')) if stored else None
+
+    def num_docs(self):
+        return self._conn.execute('HLEN', self._seen_key)
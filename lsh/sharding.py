@@ -0,0 +1,358 @@
+"""
+A storage backend which partitions the bands of an LSHCache across shards, each holding the band
+tables of a group of bands in its own process, so that the index can outgrow the memory of one
+process (or, with shard servers, of one machine).
+
+The cache computes the band hashes of a document once and ShardedStorage scatters the bucket
+keys of each group of bands to its shard and gathers back the buckets, which the cache reduces
+(by union or minimum support) as with any other storage, so a sharded cache finds exactly the
+same duplicates as an unsharded one.  Requests are sent to every shard before waiting for any
+of them, so the shards look up their bands in parallel (the lookups of a batch of documents as a
+single request to each shard).  Inserts and removes are acknowledged by every shard before the
+doc_id is recorded as seen (or forgotten), and a change which fails in any shard is undone in
+the others and raised as a ShardError.  The seen doc_ids (and stored signatures) are kept by the
+storage itself, in the process of the cache.
+
+Shards are either worker processes started by the storage, connected by pipes:
+
+    cache = LSHCache(storage=ShardedStorage(num_shards=4))
+
+or shard servers, possibly on other machines, started with
+
+    python -m lsh.sharding --listen 0.0.0.0:7000 --authkey secret
+
+and connected with
+
+    cache = LSHCache(storage=ShardedStorage(addresses=[('host1', 7000), ('host2', 7000)],
+                                            authkey='secret'))
+
+Shards are cleared when the storage is opened, as the seen doc_ids are not kept by the shards.
+
+Requests and replies are pickled (by multiprocessing.connection), so a peer which can send a
+shard server requests can run any code in it.  A shard server therefore only listens without an
+authkey on a loopback address, and the authkey of one listening on the network must be kept
+secret (and its port firewalled from untrusted networks, as the messages are not encrypted).
+"""
+import argparse
+import logging
+import multiprocessing
+import socket
+import sys
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+from lsh.bands import DictBandTable, CompactBandTable
+from lsh.storage import IStorage
+
+
+class ShardError(Exception):
+    """
+    an error raised in a shard
+    """
+    pass
+
+
+def _update(tables, lsh, doc_id, insert):
+    """
+    insert doc_id into (or remove it from) the bucket of each band of lsh (except the bands whose
+    bucket key is None), either in every band or, if that fails, in none of them
+    """
+    done = []
+    try:
+        for table, key in zip(tables, lsh):
+            if key is not None:
+                if insert:
+                    table.append(key, doc_id)
+                else:
+                    table.remove(key, doc_id)
+                done.append((table, key))
+    except Exception:
+        for table, key in done:
+            if insert:
+                table.remove(key, doc_id)
+            else:
+                table.append(key, doc_id)
+        raise
+
+
+def _serve(conn, band_table):
+    """
+    serve the requests of a storage on conn until it is closed, answering each of them (but
+    close) with ('ok', result) or ('error', message)
+    """
+    tables = []
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            return
+        op = request[0]
+        result = None
+        try:
+            if op == 'get':
+                result = [table.get(key, ()) for table, key in zip(tables, request[1])]
+            elif op == 'get_batch':
+                result = [[table.get(key, ()) for table, key in zip(tables, lsh)] for lsh in request[1]]
+            elif op == 'items':
+                result = list(tables[request[1]].iteritems())
+            elif op == 'len':
+                result = len(tables[request[1]])
+            elif op in ('insert', 'remove'):
+                _update(tables, request[1], request[2], op == 'insert')
+            elif op == 'clear':
+                tables = [band_table() for _ in xrange(request[1])]
+            elif op == 'close':
+                conn.close()
+                return
+            else:
+                raise ValueError("unknown request %r" % (op,))
+        except Exception as e:
+            # the error is raised by the storage, which may well expect it
+            logging.debug("shard failed to %s", op, exc_info=True)
+            conn.send(('error', "%s: %s" % (type(e).__name__, e)))
+        else:
+            conn.send(('ok', result))
+
+
+def _no_delay(conn):
+    """
+    disable Nagle's algorithm on the socket of conn, as each message is written in two parts (its
+    length and then its data), which would otherwise wait for the acknowledgement of the first
+    """
+    sock = socket.fromfd(conn.fileno(), socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    finally:
+        sock.close()
+    return conn
+
+
+def _is_loopback(host):
+    """
+    whether host is (or resolves to) a loopback address
+    """
+    try:
+        addresses = set(info[4][0] for info in socket.getaddrinfo(host, None))
+    except socket.gaierror:
+        return False
+    return all(address.startswith('127.') or address == '::1' for address in addresses)
+
+
+def serve_shard(address, authkey=None, band_table=DictBandTable):
+    """
+    serve the requests of ShardedStorages connecting to address (a (host, port) tuple), one
+    connection at a time.  As requests are pickled, an authkey is required unless address is a
+    loopback address
+    """
+    if authkey is None and not _is_loopback(address[0]):
+        raise ValueError("an authkey is required to listen on %s, which is not a loopback address, "
+                         "as requests are pickled" % address[0])
+    listener = Listener(address, authkey=authkey)
+    logging.info("shard listening on %s:%d", *listener.address)
+    try:
+        while True:
+            try:
+                conn = listener.accept()
+            except (AuthenticationError, IOError, EOFError):
+                logging.exception("shard failed to accept a connection")
+                continue
+            logging.info("shard serving %s", listener.last_accepted)
+            _serve(_no_delay(conn), band_table)
+    finally:
+        listener.close()
+
+
+class _ShardBandTable(object):
+    """
+    a view of the buckets of a band table of a shard (for LSHCache.stats)
+    """
+
+    def __init__(self, storage, band):
+        self._storage = storage
+        self._band = band
+
+    def iteritems(self):
+        return iter(self._storage._items(self._band))
+
+    def __len__(self):
+        return self._storage._band_request('len', self._band)
+
+
+class ShardedStorage(IStorage):
+    """
+    Keeps the band tables of contiguous groups of bands in shards: num_shards worker processes
+    started by the storage (holding band_table tables) or the shard servers at addresses
+    (see serve_shard), and the seen doc_ids in a dict in this process.  Call close to stop the
+    worker processes (or disconnect from the shard servers).
+    """
+
+    def __init__(self, num_shards=2, band_table=DictBandTable, addresses=None, authkey=None):
+        assert addresses or num_shards >= 1, "must have at least one shard"
+        self.band_table = band_table
+        self._addresses = addresses
+        self._authkey = authkey
+        self._num_shards = len(addresses) if addresses else num_shards
+        self._conns = []
+        self._processes = []
+        # the first band of each shard, and one past the last band of the last shard
+        self._starts = [0]
+        self._num_bands = 0
+        self.seen = {}
+
+    def _connect(self):
+        if self._addresses:
+            self._conns = [_no_delay(Client(tuple(address), authkey=self._authkey))
+                           for address in self._addresses]
+            return
+        for _ in xrange(self._num_shards):
+            conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_serve, args=(child_conn, self.band_table),
+                                              name='lsh-shard')
+            process.daemon = True
+            process.start()
+            child_conn.close()
+            self._conns.append(conn)
+            self._processes.append(process)
+
+    def open(self, num_bands):
+        if not self._conns:
+            self._connect()
+        self.clear(num_bands)
+
+    def clear(self, num_bands):
+        assert self._conns, "storage is not open"
+        self._num_bands = num_bands
+        self._starts = [shard * num_bands // self._num_shards for shard in xrange(self._num_shards + 1)]
+        for conn, start, end in zip(self._conns, self._starts, self._starts[1:]):
+            conn.send(('clear', end - start))
+        self._gather()
+        self.seen = {}
+
+    def close(self):
+        for conn in self._conns:
+            try:
+                conn.send(('close',))
+                conn.close()
+            except (IOError, EOFError):
+                pass
+        for process in self._processes:
+            process.join()
+        self._conns, self._processes = [], []
+
+    def _send(self, op, lsh, *args):
+        for conn, start, end in zip(self._conns, self._starts, self._starts[1:]):
+            conn.send((op, lsh[start:end]) + args)
+
+    def _gather(self):
+        """
+        the answer of every shard, raising a ShardError for the first that failed (after
+        receiving them all, so that no answer is left behind)
+        """
+        replies = [conn.recv() for conn in self._conns]
+        for status, value in replies:
+            if status == 'error':
+                raise ShardError(value)
+        return [value for _, value in replies]
+
+    def get_buckets(self, lsh):
+        self._send('get', lsh)
+        return [bucket for buckets in self._gather() for bucket in buckets]
+
+    def get_buckets_batch(self, lshs):
+        # one request per shard for the buckets of every LSH vector
+        for conn, start, end in zip(self._conns, self._starts, self._starts[1:]):
+            conn.send(('get_batch', [lsh[start:end] for lsh in lshs]))
+        buckets = [[] for _ in lshs]
+        for value in self._gather():
+            for doc_buckets, shard_buckets in zip(buckets, value):
+                doc_buckets.extend(shard_buckets)
+        return buckets
+
+    def _band_request(self, op, band):
+        shard = next(shard for shard, end in enumerate(self._starts[1:]) if band < end)
+        conn = self._conns[shard]
+        conn.send((op, band - self._starts[shard]))
+        status, value = conn.recv()
+        if status == 'error':
+            raise ShardError(value)
+        return value
+
+    def _items(self, band):
+        return self._band_request('items', band)
+
+    def _update(self, lsh, doc_id, insert):
+        """
+        insert doc_id into (or remove it from) the buckets of lsh in every shard and wait for
+        them to acknowledge it.  If any shard fails, the change is undone in the others (each
+        shard has already undone its own part) and a ShardError raised.
+        """
+        op, undo = ('insert', 'remove') if insert else ('remove', 'insert')
+        self._send(op, lsh, doc_id)
+        replies = [conn.recv() for conn in self._conns]
+        errors = [value for status, value in replies if status == 'error']
+        if not errors:
+            return
+        for (status, _), conn, start, end in zip(replies, self._conns, self._starts, self._starts[1:]):
+            if status == 'ok':
+                conn.send((undo, lsh[start:end], doc_id))
+        for (status, _), conn in zip(replies, self._conns):
+            if status == 'ok':
+                conn.recv()
+        raise ShardError(errors[0])
+
+    @property
+    def tables(self):
+        return [_ShardBandTable(self, band) for band in xrange(self._num_bands)]
+
+    def insert(self, lsh, doc_id, stored=None):
+        self._update(lsh, doc_id, True)
+        self.seen[doc_id] = stored
+
+    def remove(self, lsh, doc_id):
+        if doc_id not in self.seen:
+            raise KeyError(doc_id)
+        self._update(lsh, doc_id, False)
+        del self.seen[doc_id]
+
+    def has_doc(self, doc_id):
+        return doc_id in self.seen
+
+    def get_doc(self, doc_id):
+        return self.seen[doc_id]
+
+    def num_docs(self):
+        return len(self.seen)
+
+
+def _address(value):
+    host, _, port = value.rpartition(':')
+    return host or 'localhost', int(port)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a shard of the band tables of sharded LSH caches")
+    parser.add_argument("--listen", type=_address, default=('localhost', 7000),
+                        help="""host:port to listen on.  Defaults to localhost:7000""")
+    parser.add_argument("--authkey",
+                        help="""key the caches must authenticate with, required unless listening on a
+                        loopback address (requests are pickled, so any peer able to send them can
+                        run code in the shard)""")
+    parser.add_argument("--band-table", choices=('dict', 'compact'), default='dict',
+                        help="""hash table of each band.  Defaults to %(default)s""")
+    parser.add_argument('--log', default='info',
+                        choices=('debug', 'info', 'warning', 'error', 'critical'),
+                        help='level of logging to capture')
+    args = parser.parse_args(argv)
+    if args.authkey is None and not _is_loopback(args.listen[0]):
+        parser.error("--authkey is required to listen on %s, which is not a loopback address" % args.listen[0])
+    logging.getLogger().setLevel(getattr(logging, args.log.upper()))
+    try:
+        serve_shard(args.listen, args.authkey,
+                    CompactBandTable if args.band_table == 'compact' else DictBandTable)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
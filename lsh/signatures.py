@@ -0,0 +1,171 @@
+"""
+Storage of full minhash signatures, used to rank the duplicates found by an LSHCache by their
+estimated Jaccard similarity.
+
+Signatures may also be b-bit minhash signatures (Li and Konig, "b-Bit Minwise Hashing", 2010),
+holding only the lowest b bits of each row, which are packed 8/b rows to a byte.
+"""
+import sys
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# rows of the signature of a document without any shingles hold sys.maxint, which is stored as
+_EMPTY = 0xFFFFFFFF
+
+# the number of bits per row of b-bit minhash signatures which can be packed
+BITS = (1, 2, 4, 8)
+
+
+def pack_bits(sigs, bits):
+    """
+    pack the lowest bits of each row of the (k x n) matrix of signatures sigs into a
+    (k x ceil(n * bits / 8)) matrix of bytes
+    """
+    per_byte = 8 // bits
+    sigs = np.asarray(sigs, dtype=np.int64) & ((1 << bits) - 1)
+    k, n = sigs.shape
+    padded = np.zeros((k, -(-n // per_byte) * per_byte), dtype=np.uint8)
+    padded[:, :n] = sigs
+    shifts = np.arange(per_byte, dtype=np.uint8) * bits
+    return (padded.reshape(k, -1, per_byte) << shifts).sum(axis=2).astype(np.uint8)
+
+
+def unpack_bits(packed, bits, n):
+    """
+    unpack the (k x n) matrix of b-bit signatures from the bytes packed by pack_bits
+    """
+    per_byte = 8 // bits
+    shifts = np.arange(per_byte, dtype=np.uint8) * bits
+    rows = (packed[..., np.newaxis] >> shifts) & np.uint8((1 << bits) - 1)
+    return rows.reshape(packed.shape[:-1] + (-1,))[..., :n]
+
+
+def bbit_similarity(agreement, bits):
+    """
+    the estimated Jaccard similarity given the fraction of the rows of two b-bit minhash
+    signatures which agree.  Rows of dissimilar documents still agree by chance with
+    probability 2**-bits, so agreement = J + (1 - J) * 2**-bits.
+    """
+    chance = 2.0 ** -bits
+    return np.clip((agreement - chance) / (1 - chance), 0.0, 1.0)
+
+
+class SignatureStore(object):
+    """
+    The minhash signatures of documents held in a dense (doc_id x n) array of 32-bit integers,
+    grown (by doubling) as larger doc_ids are stored.  If bits is given, the signatures are
+    b-bit minhash signatures packed into n * bits / 8 bytes each.
+    """
+
+    def __init__(self, n, capacity=1024, bits=None):
+        if np is None:
+            raise ImportError("numpy is required to store minhash signatures")
+        assert bits is None or bits in BITS, "bits must be one of %s" % (BITS,)
+        self._n = n
+        self._bits = bits
+        self._width = n if bits is None else -(-n * bits // 8)
+        self._initial_capacity = capacity
+        self.clear()
+
+    def clear(self):
+        self._sigs = np.zeros((self._initial_capacity, self._width),
+                              dtype=np.uint32 if self._bits is None else np.uint8)
+        self._present = np.zeros(self._initial_capacity, dtype=bool)
+
+    def load(self, sigs, present):
+        """
+        hold the signatures of the rows of sigs whose entry of present is set (as saved by
+        lsh.persist), using the arrays themselves, e.g., copy-on-write memory mapped from a file
+        """
+        if len(present):
+            self._sigs, self._present = sigs, present
+        else:
+            self.clear()
+
+    def _grow(self, doc_id):
+        capacity = len(self._present)
+        while capacity <= doc_id:
+            capacity *= 2
+        sigs = np.zeros((capacity, self._width), dtype=self._sigs.dtype)
+        sigs[:len(self._sigs)] = self._sigs
+        present = np.zeros(capacity, dtype=bool)
+        present[:len(self._present)] = self._present
+        self._sigs, self._present = sigs, present
+
+    def __setitem__(self, doc_id, sig):
+        """
+        store the signature sig of doc_id.  A b-bit signature may also be given already packed,
+        as the string of bytes of its row of pack_bits
+        """
+        assert doc_id >= 0, "doc_ids must be non-negative to store minhashes"
+        if doc_id >= len(self._present):
+            self._grow(doc_id)
+        if isinstance(sig, str):
+            assert self._bits is not None, "only b-bit signatures can be stored packed"
+            self._sigs[doc_id] = np.frombuffer(sig, dtype=np.uint8)
+        elif self._bits is not None:
+            self._sigs[doc_id] = pack_bits([sig], self._bits)[0]
+        else:
+            sig = np.asarray(sig, dtype=np.int64)
+            self._sigs[doc_id] = np.where(sig == sys.maxint, _EMPTY, sig)
+        self._present[doc_id] = True
+
+    def _unpacked(self, doc_ids):
+        """
+        the (len(doc_ids) x n) matrix of the stored signatures of doc_ids
+        """
+        if self._bits is None:
+            return self._sigs[doc_ids]
+        return unpack_bits(self._sigs[doc_ids], self._bits, self._n)
+
+    def __contains__(self, doc_id):
+        return 0 <= doc_id < len(self._present) and bool(self._present[doc_id])
+
+    def __getitem__(self, doc_id):
+        if doc_id not in self:
+            raise KeyError(doc_id)
+        if self._bits is not None:
+            return self._unpacked(doc_id).tolist()
+        return [sys.maxint if h == _EMPTY else h for h in self._sigs[doc_id].tolist()]
+
+    def __len__(self):
+        return int(self._present.sum())
+
+    def __delitem__(self, doc_id):
+        if doc_id not in self:
+            raise KeyError(doc_id)
+        self._present[doc_id] = False
+
+    def similarity(self, sig, doc_ids):
+        """
+        return an array of the estimated Jaccard similarity of each of the doc_ids to the
+        document with the minhash signature sig: the fraction of their signatures that agree
+        (corrected for the rows that agree by chance for b-bit signatures)
+        """
+        sig = np.asarray(sig, dtype=np.int64)
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        if self._bits is not None:
+            sig = (sig & ((1 << self._bits) - 1)).astype(np.uint8)
+            return bbit_similarity((self._unpacked(doc_ids) == sig).mean(axis=1), self._bits)
+        sig = np.where(sig == sys.maxint, _EMPTY, sig).astype(np.uint32)
+        return (self._sigs[doc_ids] == sig).mean(axis=1)
+
+    def rank(self, sig, doc_ids, threshold=0.0, k=None):
+        """
+        return a list of (doc_id, similarity) of the doc_ids whose estimated Jaccard similarity
+        to sig is at least threshold, most similar first (ties broken by doc_id), and at most k
+        of them if k is given
+        """
+        doc_ids = sorted(doc_id for doc_id in doc_ids if doc_id in self)
+        if not doc_ids:
+            return []
+        sims = self.similarity(sig, doc_ids)
+        keep = np.flatnonzero(sims >= threshold)
+        # stable sort on descending similarity keeps ties in doc_id order
+        keep = keep[np.argsort(-sims[keep], kind='mergesort')]
+        if k is not None:
+            keep = keep[:k]
+        return [(doc_ids[i], float(sims[i])) for i in keep]
@@ -0,0 +1,132 @@
+"""
+Storage backends: where an LSHCache keeps its band buckets and the map of the doc_ids it has seen
+(to their band hashes, if signatures are stored).
+
+MemoryStorage, the default, keeps a band table (see lsh.bands) per band and a dict in this
+process.  lsh.redis_storage.RedisStorage keeps them in a Redis server so that several processes
+can share one index, and lsh.sharding.ShardedStorage partitions the bands across worker processes
+(or shard servers) so that the index can outgrow one process.
+"""
+from lsh.bands import DictBandTable
+
+
+class IStorage(object):
+    """
+    An interface for the storage of an LSHCache.  All the band operations work on a whole LSH
+    vector (one bucket key per band) at a time so that remote backends can batch them.
+    """
+
+    def open(self, num_bands):
+        """
+        prepare the storage for num_bands bands, keeping anything it already holds
+        """
+        raise NotImplementedError()
+
+    def clear(self, num_bands):
+        """
+        remove everything from the storage and prepare it for num_bands bands
+        """
+        raise NotImplementedError()
+
+    def get_buckets(self, lsh):
+        """
+        return a list holding the doc_ids (a sequence) of the bucket of each band that the LSH
+        vector of bucket keys falls in
+        """
+        raise NotImplementedError()
+
+    def get_buckets_batch(self, lshs):
+        """
+        return the buckets (see get_buckets) of each of a sequence of LSH vectors.  The default
+        looks up each LSH vector in turn, backends should override it to look up the buckets of
+        all of them at once
+        """
+        return map(self.get_buckets, lshs)
+
+    def new_doc_id(self, next_id):
+        """
+        return the doc_id to give a document inserted without one, given next_id, the doc_id
+        past the largest one the cache has inserted.  Storages shared by several caches allocate
+        doc_ids themselves so that caches in different processes do not give out the same ones.
+        """
+        return next_id
+
+    def insert(self, lsh, doc_id, stored=None):
+        """
+        add doc_id to the bucket of each band of the LSH vector (except the bands whose bucket
+        key is None) and record doc_id as seen along with stored (the LSH vector if signatures
+        are stored or None).  Storages shared by several caches raise a ValueError if doc_id has
+        already been inserted (by any of them).
+        """
+        raise NotImplementedError()
+
+    def remove(self, lsh, doc_id):
+        """
+        remove doc_id from the bucket of each band of the LSH vector (except the bands whose
+        bucket key is None) and forget it was seen
+        """
+        raise NotImplementedError()
+
+    def has_doc(self, doc_id):
+        """
+        whether doc_id has been inserted
+        """
+        raise NotImplementedError()
+
+    def get_doc(self, doc_id):
+        """
+        return what was stored with doc_id when it was inserted
+        """
+        raise NotImplementedError()
+
+    def num_docs(self):
+        raise NotImplementedError()
+
+
+class MemoryStorage(IStorage):
+    """
+    Keeps a band table per band and the seen doc_ids in a dict in this process
+    """
+
+    def __init__(self, band_table=DictBandTable):
+        self.band_table = band_table
+        self.tables = []
+        self.seen = {}
+
+    def open(self, num_bands):
+        if len(self.tables) != num_bands:
+            self.clear(num_bands)
+
+    def clear(self, num_bands):
+        self.tables = [self.band_table() for _ in xrange(num_bands)]
+        self.seen = {}
+
+    def get_buckets(self, lsh):
+        return [table.get(band_bucket, ()) for table, band_bucket in zip(self.tables, lsh)]
+
+    def get_buckets_batch(self, lshs):
+        # band by band: the bucket keys of a band of every LSH vector are looked up in one map
+        empty = [()] * len(lshs)
+        return zip(*[map(table.get, band_buckets, empty)
+                     for table, band_buckets in zip(self.tables, zip(*lshs))])
+
+    def insert(self, lsh, doc_id, stored=None):
+        self.seen[doc_id] = stored
+        for table, band_bucket in zip(self.tables, lsh):
+            if band_bucket is not None:
+                table.append(band_bucket, doc_id)
+
+    def remove(self, lsh, doc_id):
+        del self.seen[doc_id]
+        for table, band_bucket in zip(self.tables, lsh):
+            if band_bucket is not None:
+                table.remove(band_bucket, doc_id)
+
+    def has_doc(self, doc_id):
+        return doc_id in self.seen
+
+    def get_doc(self, doc_id):
+        return self.seen[doc_id]
+
+    def num_docs(self):
+        return len(self.seen)
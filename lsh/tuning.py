@@ -0,0 +1,281 @@
+"""
+Choosing the number of bands b, rows per band r and minimum support m of an LSHCache.
+
+A pair of documents with Jaccard similarity s agrees on a row of their minhash signatures with
+probability s, on a band with probability p = s**r and is found if at least m of the b bands
+agree, with probability P(s) = P(Binomial(b, p) >= m): the S-curve of the cache.  Given a
+similarity threshold t, the false positive rate is the mean of P(s) over the similarities below
+t and the false negative rate the mean of 1 - P(s) over those above it (taking every similarity
+to be equally likely; validate checks the choice against the similarities of a real corpus).
+
+tune searches all the (b, r, m) within a budget for those meeting target false positive and
+false negative rates and returns the cheapest: the fewest bands (each costing a posting per
+document in every band table and a lookup per query), then the fewest rows (each costing a hash
+per shingle).  It can also be run from the command line, e.g.,
+
+    python -m lsh.tuning --threshold 0.8 --max-fp 0.05 --max-fn 0.05 --max-bands 40
+
+The S-curves are computed in log space, as numpy arrays over every r, similarity and m at once,
+so they are stable and fast for hundreds of bands.
+"""
+import argparse
+import collections
+import itertools as it
+import logging
+import random
+import sys
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# the number of similarities at which the S-curve is evaluated on either side of the threshold
+_GRID = 65
+
+
+class Tuning(collections.namedtuple('Tuning', 'b r m fp fn feasible')):
+    """
+    the chosen number of bands b, rows per band r and minimum support m, the theoretical false
+    positive rate fp and false negative rate fn and whether they meet the targets
+    """
+
+    def kwargs(self):
+        """
+        the arguments of an LSHCache with these parameters
+        """
+        return {'b': self.b, 'r': self.r, 'm': self.m}
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError("numpy is required to tune LSH parameters")
+
+
+def _row_probability(similarity, sig_bits=None):
+    """
+    the probability that a row of the signatures of documents with the given similarity agree
+    """
+    similarity = np.asarray(similarity, dtype=float)
+    if sig_bits is not None:
+        # rows of b-bit signatures also agree by chance
+        similarity = similarity + (1 - similarity) * 2.0 ** -sig_bits
+    return similarity
+
+
+def _tails(p, b):
+    """
+    given an array of band match probabilities p, return the array of shape p.shape + (b + 2,)
+    whose [..., m] entry is the probability that at least m of b bands match
+    """
+    k = np.arange(b + 1)
+    # log(b choose k) as a running sum of logs, which unlike factorials does not overflow
+    log_choose = np.concatenate(([0.0], np.cumsum(np.log(b - k[1:] + 1.0) - np.log(k[1:]))))
+    p = p[..., np.newaxis]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_pmf = log_choose + np.where(k == 0, 0.0, k * np.log(p)) + \
+            np.where(k == b, 0.0, (b - k) * np.log1p(-p))
+    pmf = np.exp(log_pmf)
+    tails = np.zeros(pmf.shape[:-1] + (b + 2,))
+    tails[..., :b + 1] = np.cumsum(pmf[..., ::-1], axis=-1)[..., ::-1]
+    return np.minimum(tails, 1.0)
+
+
+def s_curve(similarity, b, r, m=1, sig_bits=None):
+    """
+    return the probability that documents with the given similarity (a number or an array) are
+    found by a cache of b bands of r rows with a minimum support of m (and b-bit signatures of
+    sig_bits bits per row, if given)
+    """
+    _require_numpy()
+    p = _row_probability(similarity, sig_bits) ** r
+    return _tails(p, b)[..., max(m, 0)]
+
+
+def error_rates(threshold, b, r, m=1, sig_bits=None):
+    """
+    return the theoretical (false positive, false negative) rates of a cache of b bands of r rows
+    with minimum support m for the given similarity threshold
+    """
+    _require_numpy()
+    fp, fn = _error_rates(threshold, b, np.array([r]), sig_bits)
+    return float(fp[0, m]), float(fn[0, m])
+
+
+def _error_rates(threshold, b, rs, sig_bits=None):
+    """
+    the (len(rs) x b + 2) arrays of the false positive and false negative rates of b bands of
+    each of rs rows and each minimum support
+    """
+    below = np.linspace(0, threshold, _GRID)
+    above = np.linspace(threshold, 1, _GRID)
+    similarity = np.concatenate((below, above))
+    p = _row_probability(similarity, sig_bits)[np.newaxis, :] ** rs[:, np.newaxis]
+    found = _tails(p, b)
+    fp = np.trapz(found[:, :_GRID], below, axis=1) / threshold if threshold > 0 \
+        else np.zeros((len(rs), b + 2))
+    fn = np.trapz(1 - found[:, _GRID:], above, axis=1) / (1 - threshold) if threshold < 1 \
+        else np.zeros((len(rs), b + 2))
+    return fp, fn
+
+
+def tune(threshold, max_fp=0.05, max_fn=0.05, max_bands=64, max_rows=None, max_rows_per_band=32,
+         max_memory=None, bytes_per_band=45, sig_bits=None):
+    """
+    return the Tuning of the cheapest (b, r, m), with at most max_bands bands, max_rows total
+    rows and max_rows_per_band rows per band, whose false positive and false negative rates for
+    the similarity threshold are at most max_fp and max_fn.  A memory budget of max_memory bytes
+    per document limits the bands to max_memory / bytes_per_band (a posting in each band costs
+    about 45 bytes in a CompactBandTable and 250 in a DictBandTable).
+
+    There is no explicit latency model: the time to hash a document grows with its total rows
+    b * r (a hash per row and shingle with minhash families) and the time of a lookup with its
+    bands b (a bucket per band), so a latency budget is given as max_rows (and max_bands).
+
+    If no parameters meet the targets, the ones which come closest (with the smallest largest
+    ratio of a rate to its target) are returned with feasible set to False.
+    """
+    _require_numpy()
+    assert 0 <= threshold <= 1, "threshold must be between 0 and 1"
+    assert max_fp > 0 and max_fn > 0, "target rates must be positive"
+    if max_memory is not None:
+        max_bands = min(max_bands, int(max_memory // bytes_per_band))
+    assert max_bands >= 1, "the budget does not allow any bands"
+
+    best, best_key = None, None
+    for b in xrange(1, max_bands + 1):
+        num_rows = max_rows_per_band if max_rows is None else min(max_rows_per_band, max_rows // b)
+        if num_rows < 1:
+            break
+        rs = np.arange(1, num_rows + 1)
+        fp, fn = _error_rates(threshold, b, rs, sig_bits)
+        fp, fn = fp[:, 1:b + 1], fn[:, 1:b + 1]
+        miss = np.maximum(fp / max_fp, fn / max_fn)
+        feasible = miss <= 1
+        if feasible.any():
+            # the fewest rows, then the lowest total error, among those meeting the targets
+            error = np.where(feasible, fp + fn, np.inf)
+            i = np.flatnonzero(feasible.any(axis=1))[0]
+            j = int(np.argmin(error[i]))
+            return Tuning(b, int(rs[i]), j + 1, float(fp[i, j]), float(fn[i, j]), True)
+        i, j = np.unravel_index(np.argmin(miss), miss.shape)
+        key = miss[i, j]
+        if best_key is None or key < best_key:
+            best_key = key
+            best = Tuning(b, int(rs[i]), int(j) + 1, float(fp[i, j]), float(fn[i, j]), False)
+    return best
+
+
+def jaccard(a, b):
+    """
+    the Jaccard similarity of the sets a and b
+    """
+    if not a and not b:
+        return 1.0
+    return len(a & b) / float(len(a | b))
+
+
+def validate(cache, docs, threshold, sample=None, seed=None):
+    """
+    measure the false positive and false negative rates of cache (an empty LSHCache) on a corpus:
+    insert docs (a sample of that many documents, drawn with random.Random(seed), if sample is
+    given) into it and compare the pairs of documents it finds with the Jaccard similarities of
+    their shingle ids (see LSHCache.shingle_ids).  Returns a dict of
+        pairs:                the number of pairs of documents
+        similar:              the number of pairs with a similarity of at least threshold
+        fp_rate, fn_rate:     the measured rates: the fraction of the pairs below the threshold
+                              that were found and of those above it which were not
+        expected_fp_rate,
+        expected_fn_rate:     the rates expected from the S-curve of the cache for the
+                              similarities of these pairs
+    As every pair of the sample is compared, keep the sample to a few thousand documents.
+    """
+    _require_numpy()
+    docs = list(docs)
+    if sample is not None and sample < len(docs):
+        docs = [docs[i] for i in sorted(random.Random(seed).sample(xrange(len(docs)), sample))]
+    found = set()
+    for doc_id, dups in enumerate(cache.insert_batch(docs)):
+        found.update((dup, doc_id) for dup in dups if dup < doc_id)
+
+    shingles = map(cache.shingle_ids, docs)
+    pairs = list(it.combinations(xrange(len(docs)), 2))
+    similarity = np.array([jaccard(shingles[i], shingles[j]) for i, j in pairs])
+    is_found = np.array([pair in found for pair in pairs], dtype=bool)
+    similar = similarity >= threshold
+    expected = s_curve(similarity, cache.num_bands(), cache.num_rows_per_band(),
+                       cache.min_support(), cache._sig_bits)
+
+    def rate(values, where):
+        return float(values[where].mean()) if where.any() else 0.0
+
+    return {
+        'pairs': len(pairs),
+        'similar': int(similar.sum()),
+        'fp_rate': rate(is_found, ~similar),
+        'fn_rate': rate(~is_found, similar),
+        'expected_fp_rate': rate(expected, ~similar),
+        'expected_fn_rate': rate(1 - expected, similar),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Choose the bands, rows per band and minimum support of an LSH cache")
+    parser.add_argument("-t", "--threshold", type=float, required=True,
+                        help="""similarity above which documents are duplicates""")
+    parser.add_argument("--max-fp", type=float, default=0.05,
+                        help="""target false positive rate.  Defaults to %(default)s""")
+    parser.add_argument("--max-fn", type=float, default=0.05,
+                        help="""target false negative rate.  Defaults to %(default)s""")
+    parser.add_argument("--max-bands", type=int, default=64,
+                        help="""largest number of bands.  Defaults to %(default)s""")
+    parser.add_argument("--max-rows", type=int,
+                        help="""largest total number of rows (hashes per shingle)""")
+    parser.add_argument("--max-rows-per-band", type=int, default=32,
+                        help="""largest number of rows per band.  Defaults to %(default)s""")
+    parser.add_argument("--max-memory", type=int,
+                        help="""largest number of bytes of band postings per document""")
+    parser.add_argument("--bytes-per-band", type=int, default=45,
+                        help="""bytes of a posting in a band table.  Defaults to %(default)s""")
+    parser.add_argument("--sig-bits", type=int, choices=(1, 2, 4, 8),
+                        help="""number of bits per row of b-bit minhash signatures""")
+    parser.add_argument("--validate", metavar='FILE',
+                        help="""validate the choice on a corpus of one whitespace tokenized document per line""")
+    parser.add_argument("--sample", type=int, default=1000,
+                        help="""number of documents of the corpus to validate on.  Defaults to %(default)s""")
+    parser.add_argument("--shingle-len", type=int, default=2,
+                        help="""length of the shingles of the corpus.  Defaults to %(default)s""")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="""seed of the sample and of the hash family of the validated cache.
+                        Defaults to %(default)s""")
+    parser.add_argument('--log', default='warning',
+                        choices=('debug', 'info', 'warning', 'error', 'critical'),
+                        help='level of logging to capture')
+    args = parser.parse_args(argv)
+    logging.getLogger().setLevel(getattr(logging, args.log.upper()))
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    tuning = tune(args.threshold, args.max_fp, args.max_fn, args.max_bands, args.max_rows,
+                  args.max_rows_per_band, args.max_memory, args.bytes_per_band, args.sig_bits)
+    print "b=%d r=%d m=%d (n=%d)" % (tuning.b, tuning.r, tuning.m, tuning.b * tuning.r)
+    print "theoretical false positive rate %.4f, false negative rate %.4f" % (tuning.fp, tuning.fn)
+    if not tuning.feasible:
+        print "no parameters within the budget meet the targets, these come closest"
+    if args.validate:
+        from lsh import LSHCache, Shingler
+        with open(args.validate) as f:
+            docs = [line.split() for line in f]
+        cache = LSHCache(shingler=Shingler(args.shingle_len), sig_bits=args.sig_bits, seed=args.seed,
+                         **tuning.kwargs())
+        result = validate(cache, docs, args.threshold, args.sample, args.seed)
+        print "validated on %(pairs)d pairs (%(similar)d similar):" % result
+        print "measured false positive rate %(fp_rate).4f, false negative rate %(fn_rate).4f" % result
+        print "expected false positive rate %(expected_fp_rate).4f, false negative rate %(expected_fn_rate).4f" % result
+    return 0 if tuning.feasible else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,484 @@
+"""
+A write-ahead log making the changes to an LSHCache durable between snapshots.
+
+The log is a directory holding snapshots (caches saved with LSHCache.save) and segments of the
+log, each named by a sequence number:
+    snapshot.<seq>.lsh  the cache with the changes of every segment before seq
+    wal.<seq>           the changes logged after those of segment seq - 1
+Each change (inserting a document, removing one or clearing the cache) is appended to the
+current segment as a record of
+    length (4 bytes) | crc32 of the payload (4 bytes) | payload
+whose payload is the kind of change, the doc_id, the band hashes (as 64-bit integers) and, for
+caches storing minhashes, the minhash signature of the document (as 32-bit integers if its rows
+fit).  A record is about 8 bytes per band, so logging costs a small fraction of hashing and
+inserting the document.
+
+The cache makes each change within the context returned by log_insert, log_remove or log_clear,
+after the change is logged: compact waits for the changes logged to be made before it starts a
+new segment and forks the snapshot, and changes wait for it to do so, so that a snapshot holds
+exactly the changes of the segments it replaces.  Replaying skips inserts of documents the cache
+already holds (and removes of those it does not).
+
+The fsync policy decides when a change is durable:
+    'always'    every record is written and synced before the change is made
+    'group'     group commit: a change waits until its record is synced, and the records logged
+                by other threads while a sync is under way are synced together by the next one
+                (with a single writer this costs as much as 'always')
+    'interval'  records are written (and synced) in groups, by a background thread, once a group
+                holds group_size records or group_delay seconds after its first record, and the
+                change is made without waiting.  A crash (of the process or the machine) loses
+                the changes of the last group_delay seconds, at most group_size of them
+    'never'     groups are written as with 'interval' but left to the operating system to sync,
+                so a crash of the machine may lose any change not yet written back
+The default, 'interval', keeps the cost of logging a small fraction of that of inserting.
+
+Opening the log loads the latest snapshot (or creates a new cache) and replays the segments
+after it.  A record torn by a crash (or failing its checksum) ends its segment, and is cut off.
+compact saves a new snapshot of the cache in a forked child process, which sees the cache as it
+was when forked while the cache goes on logging to a new segment, and then deletes the
+snapshots and segments it replaces.  Compaction runs every compact_bytes bytes of log if given.
+
+    wal = WriteAheadLog('dups.wal')
+    cache = wal.open(b=20, r=5)
+    cache.insert(doc)
+    ...
+    wal.close()
+
+Replayed documents of bounded caches (with max_docs or max_age) count their age from when they
+are replayed.  Snapshots require numpy and a cache which can be saved (see LSHCache.save).  An
+LSHForest cannot be logged, as its bands are labelled by their rows rather than by 64-bit hashes.
+"""
+import logging
+import multiprocessing
+import os
+import re
+import struct
+import sys
+import threading
+import time
+import zlib
+
+from lsh import LSHCache
+from lsh.forest import LSHForest
+from lsh.signatures import _EMPTY
+
+_INSERT, _REMOVE, _CLEAR = 1, 2, 3
+# kinds of minhash signatures in an insert record: none, 32-bit rows (with sys.maxint, the rows
+# of a document without shingles, as _EMPTY), packed b-bit rows and 64-bit rows
+_NO_SIG, _INT_SIG, _PACKED_SIG, _WIDE_SIG = 0, 1, 2, 3
+
+_FRAME = struct.Struct('<II')
+_CHANGE = struct.Struct('<BqIB')
+
+_SEGMENT = re.compile(r'^wal\.(\d+)$')
+_SNAPSHOT = re.compile(r'^snapshot\.(\d+)\.lsh$')
+
+FSYNC_POLICIES = ('always', 'group', 'interval', 'never')
+
+# the largest payload of a record read back, beyond which its length is taken to be corrupt
+_MAX_PAYLOAD = 1 << 26
+
+
+def _encode(kind, doc_id=0, lsh=(), sig=None):
+    if sig is None:
+        sig_kind, sig_bytes = _NO_SIG, ''
+    elif isinstance(sig, str):
+        sig_kind, sig_bytes = _PACKED_SIG, sig
+    elif all(h < _EMPTY or h == sys.maxint for h in sig):
+        sig_kind, sig_bytes = _INT_SIG, struct.pack('<%dI' % len(sig),
+                                                    *[_EMPTY if h == sys.maxint else h for h in sig])
+    else:
+        sig_kind, sig_bytes = _WIDE_SIG, struct.pack('<%dq' % len(sig), *sig)
+    payload = _CHANGE.pack(kind, doc_id, len(lsh), sig_kind) + struct.pack('<%dq' % len(lsh), *lsh) + sig_bytes
+    return _FRAME.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+
+def _decode(payload):
+    """
+    the (kind, doc_id, lsh, sig) of the payload of a record
+    """
+    kind, doc_id, num_bands, sig_kind = _CHANGE.unpack_from(payload)
+    start = _CHANGE.size
+    lsh = list(struct.unpack_from('<%dq' % num_bands, payload, start))
+    sig = payload[start + 8 * num_bands:]
+    if sig_kind == _NO_SIG:
+        sig = None
+    elif sig_kind == _INT_SIG:
+        sig = [sys.maxint if h == _EMPTY else h for h in struct.unpack('<%dI' % (len(sig) // 4), sig)]
+    elif sig_kind == _WIDE_SIG:
+        sig = list(struct.unpack('<%dq' % (len(sig) // 8), sig))
+    return kind, doc_id, lsh, sig
+
+
+def read_log(path):
+    """
+    yield the (kind, doc_id, lsh, sig) of each record of the segment at path, followed by the
+    offset of the end of the last whole record, which is before the end of the file if the
+    last record was torn or corrupt (including its length, which is not trusted any further
+    than the end of the file)
+    """
+    end = 0
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        while True:
+            frame = f.read(_FRAME.size)
+            if len(frame) < _FRAME.size:
+                break
+            length, crc = _FRAME.unpack(frame)
+            if length > min(_MAX_PAYLOAD, size - end - _FRAME.size):
+                break
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+                break
+            end += _FRAME.size + length
+            yield _decode(payload)
+    yield end
+
+
+def replay(cache, path):
+    """
+    apply the changes logged in the segment at path to cache (which must not be logging),
+    cutting off a torn or corrupt last record.  Inserts of documents the cache already holds and
+    removes of those it does not are skipped.  Returns the number of changes applied
+    """
+    applied = 0
+    for record in read_log(path):
+        if not isinstance(record, tuple):
+            end = record
+            break
+        kind, doc_id, lsh, sig = record
+        if kind == _INSERT:
+            if cache._storage.has_doc(doc_id):
+                continue
+            cache._store_lsh(lsh, doc_id, sig)
+        elif kind == _REMOVE:
+            if not cache._storage.has_doc(doc_id):
+                continue
+            cache._remove_lsh(lsh, doc_id)
+        elif kind == _CLEAR:
+            cache.clear()
+        applied += 1
+    if end < os.path.getsize(path):
+        logging.warning("cutting off %d bytes of a torn record at the end of %s",
+                        os.path.getsize(path) - end, path)
+        with open(path, 'r+b') as f:
+            f.truncate(end)
+    return applied
+
+
+def _save_snapshot(cache, path):
+    cache.save(path)
+
+
+class _Change(object):
+    """
+    the context of a change logged to a WriteAheadLog, within which the cache makes the change
+    """
+
+    def __init__(self, wal):
+        self._wal = wal
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._wal._made()
+
+
+class WriteAheadLog(object):
+    """
+    The write-ahead log of an LSHCache kept in directory (see the module documentation).  open
+    returns the cache, which then logs its changes until the log is closed.
+    """
+
+    def __init__(self, directory, fsync='interval', group_size=256, group_delay=0.05, compact_bytes=None):
+        assert fsync in FSYNC_POLICIES, "fsync must be one of %s" % (FSYNC_POLICIES,)
+        assert group_size >= 1, "group_size must be positive"
+        assert group_delay > 0, "group_delay must be positive"
+        self.directory = directory
+        self.fsync = fsync
+        self.group_size = group_size
+        self.group_delay = group_delay
+        self.compact_bytes = compact_bytes
+        self._cache = None
+        self._file = None
+        self._seq = 0
+        # the records of the current group
+        self._group = []
+        self._lock = threading.Lock()
+        self._group_logged = threading.Condition(self._lock)
+        # for fsync='group': the number of records logged and synced, and whether a sync is
+        # under way (outside the lock), which the loggers of later records wait for
+        self._logged = 0
+        self._synced = 0
+        self._syncing = False
+        self._group_synced = threading.Condition(self._lock)
+        # the number of changes logged but not yet made by the cache, and whether compact is
+        # starting a new segment (waiting for them to be made, which new changes wait for)
+        self._making = 0
+        self._switching = False
+        self._changes_made = threading.Condition(self._lock)
+        self._compact_lock = threading.Lock()
+        self._flusher = None
+        self._closing = False
+        # the bytes logged since the last snapshot
+        self._logged_bytes = 0
+        self._compaction = None
+
+    def _path(self, name, seq):
+        return os.path.join(self.directory, name % seq)
+
+    def _files(self, pattern):
+        """
+        the sorted sequence numbers of the files of the directory matching pattern
+        """
+        return sorted(int(match.group(1)) for match in map(pattern.match, os.listdir(self.directory)) if match)
+
+    def open(self, cls=LSHCache, **kwargs):
+        """
+        return the cache of the log: its latest snapshot (an instance of cls) or, if it has none,
+        cls(**kwargs), with the logged changes since replayed.  The cache logs its changes from
+        then on
+        """
+        assert self._cache is None, "log already open"
+        if issubclass(cls, LSHForest):
+            raise ValueError("an LSHForest cannot be logged, as its bands are not hashed to integers")
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        snapshots = self._files(_SNAPSHOT)
+        if snapshots:
+            start = snapshots[-1]
+            cache = cls.from_file(self._path('snapshot.%08d.lsh', start))
+        else:
+            start = 0
+            cache = cls(**kwargs)
+        segments = [seq for seq in self._files(_SEGMENT) if seq >= start]
+        for seq in segments:
+            path = self._path('wal.%08d', seq)
+            logging.info("replayed %d changes from %s", replay(cache, path), path)
+            self._logged_bytes += os.path.getsize(path)
+        self._remove_before(start)
+        self._seq = max(segments + [start - 1]) + 1
+        self._file = open(self._path('wal.%08d', self._seq), 'ab')
+        self._sync_directory()
+        self._cache = cache
+        self._closing = False
+        cache._wal = self
+        if self.fsync in ('interval', 'never'):
+            self._flusher = threading.Thread(target=self._flush_groups, name='lsh-wal')
+            self._flusher.daemon = True
+            self._flusher.start()
+        return cache
+
+    def log_insert(self, doc_id, lsh, sig=None):
+        """
+        log inserting doc_id, returning the context within which the cache inserts it
+        """
+        return self._log(_encode(_INSERT, doc_id, lsh, sig))
+
+    def log_remove(self, doc_id, lsh):
+        """
+        log removing doc_id, returning the context within which the cache removes it
+        """
+        return self._log(_encode(_REMOVE, doc_id, lsh))
+
+    def log_clear(self):
+        """
+        log clearing the cache, returning the context within which the cache clears itself
+        """
+        return self._log(_encode(_CLEAR))
+
+    def _log(self, record):
+        if self.compact_bytes is not None and self._logged_bytes >= self.compact_bytes and \
+                self._compaction is None:
+            self.compact(wait=False)
+        with self._lock:
+            while self._switching:
+                self._changes_made.wait()
+            self._group.append(record)
+            self._logged_bytes += len(record)
+            self._making += 1
+            try:
+                if self.fsync == 'always':
+                    self._write_group(True)
+                elif self.fsync == 'group':
+                    self._logged += 1
+                    self._wait_synced(self._logged)
+                elif len(self._group) == 1:
+                    self._group_logged.notify()
+                elif len(self._group) >= self.group_size:
+                    self._write_group(self.fsync == 'interval')
+            except:
+                self._made_locked()
+                raise
+        return _Change(self)
+
+    def _made(self):
+        """
+        note that the cache has made a change it logged
+        """
+        with self._lock:
+            self._made_locked()
+
+    def _made_locked(self):
+        self._making -= 1
+        if not self._making:
+            self._changes_made.notify_all()
+
+    def _wait_synced(self, logged):
+        """
+        return once the first logged records are synced (holding the lock).  Unless another
+        thread is syncing, this one writes the records logged so far and syncs them, releasing
+        the lock meanwhile so that other threads can log the records of the next sync
+        """
+        while self._synced < logged:
+            if self._syncing:
+                self._group_synced.wait()
+                continue
+            self._syncing = True
+            target = self._logged
+            try:
+                self._write_group(False)
+                fileno = self._file.fileno()
+                self._lock.release()
+                try:
+                    os.fsync(fileno)
+                finally:
+                    self._lock.acquire()
+                self._synced = target
+            finally:
+                self._syncing = False
+                self._group_synced.notify_all()
+
+    def _wait_idle(self):
+        """
+        wait (holding the lock) for a sync under way to finish, before replacing the file
+        """
+        while self._syncing:
+            self._group_synced.wait()
+
+    def _write_group(self, sync):
+        """
+        write out the current group (holding the lock)
+        """
+        if self._group:
+            self._file.write(''.join(self._group))
+            self._group = []
+        self._file.flush()
+        if sync:
+            os.fsync(self._file.fileno())
+
+    def _flush_groups(self):
+        """
+        write out each group group_delay seconds after its first record (unless it fills first)
+        """
+        while True:
+            with self._lock:
+                while not self._group and not self._closing:
+                    self._group_logged.wait()
+                if self._closing:
+                    return
+            # rather than a wait with a timeout, which polls in python 2
+            time.sleep(self.group_delay)
+            with self._lock:
+                if self._group and self._file is not None:
+                    self._write_group(self.fsync == 'interval')
+
+    def flush(self):
+        """
+        write out (and sync, unless fsync is 'never') the records logged so far
+        """
+        with self._lock:
+            self._write_group(self.fsync != 'never')
+
+    def _sync_directory(self):
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _remove_before(self, seq):
+        """
+        remove the snapshots and segments replaced by the snapshot seq
+        """
+        for name, pattern in (('snapshot.%08d.lsh', _SNAPSHOT), ('wal.%08d', _SEGMENT)):
+            for old in self._files(pattern):
+                if old < seq:
+                    os.remove(self._path(name, old))
+
+    def compact(self, wait=True):
+        """
+        save a snapshot of the cache, in a child process forked now, and then remove the
+        snapshots and segments it replaces.  The cache logs to a new segment meanwhile.  If wait
+        is False, the snapshot is saved (and the old files removed) in the background.  Returns
+        False if a compaction is already running
+        """
+        assert self._cache is not None, "log is not open"
+        if not self._compact_lock.acquire(wait):
+            return False
+        try:
+            if self._compaction is not None:
+                if not wait:
+                    return False
+                self._compaction.join()
+            with self._lock:
+                # the snapshot must hold every change logged to the segments it replaces, and no
+                # change logged to the new one
+                self._switching = True
+                try:
+                    while self._making:
+                        self._changes_made.wait()
+                    self._wait_idle()
+                    self._write_group(self.fsync != 'never')
+                    self._file.close()
+                    self._seq += 1
+                    self._file = open(self._path('wal.%08d', self._seq), 'ab')
+                    self._logged_bytes = 0
+                    seq = self._seq
+                    process = multiprocessing.Process(target=_save_snapshot,
+                                                      args=(self._cache, self._path('snapshot.%08d.lsh', seq)))
+                    process.start()
+                finally:
+                    self._switching = False
+                    self._changes_made.notify_all()
+
+            def finish():
+                process.join()
+                if process.exitcode == 0:
+                    self._sync_directory()
+                    self._remove_before(seq)
+                else:
+                    logging.error("saving snapshot %d failed with exit code %s", seq, process.exitcode)
+                self._compaction = None
+
+            compaction = self._compaction = threading.Thread(target=finish, name='lsh-wal-compaction')
+            compaction.daemon = True
+            compaction.start()
+        finally:
+            self._compact_lock.release()
+        if wait:
+            compaction.join()
+        return True
+
+    def close(self):
+        """
+        write out the records logged so far, wait for any compaction and stop logging
+        """
+        if self._cache is None:
+            return
+        compaction = self._compaction
+        if compaction is not None:
+            compaction.join()
+        with self._lock:
+            self._wait_idle()
+            self._write_group(self.fsync != 'never')
+            self._closing = True
+            self._group_logged.notify()
+            self._file.close()
+            self._file = None
+        if self._flusher is not None:
+            self._flusher.join()
+            self._flusher = None
+        self._cache._wal = None
+        self._cache = None
@@ -13,5 +13,8 @@ setup(
             ]
         },
     install_requires=[
-       ]
+       ],
+    extras_require={
+        'numpy': ['numpy'],
+       }
     )
@@ -5,8 +5,36 @@ Created on Dec 13, 2013
 '''
 import unittest
 import random
+import itertools as it
+import sys
+import os
+import shutil
+import tempfile
+import json
+import threading
+import time
+import multiprocessing
+import subprocess
+import pickle
+import copy
+from multiprocessing.connection import Client
+try:
+    import numpy as np
+except ImportError:
+    np = None
 from nltk.metrics.distance import jaccard_distance
-from lsh import LSHCache, Shingler, XORHashFamily, MultiplyHashFamily
+from lsh import LSHCache, Shingler, RollingShingler, XORHashFamily, MultiplyHashFamily, OnePermutationHashFamily, CompactBandTable, DictBandTable
+from lsh import IHashFamily, ISignatureFamily
+from lsh import tuning, pbinom
+from lsh.hashing import stable_hash, band_hashes, band_hash_matrix, TokenHashes, window_hashes, _tuple_hash
+from lsh.instrument import prometheus_text
+from lsh.bands import OrderedBucket
+from lsh.forest import LSHForest, PrefixBandTable
+from lsh import lsh_app, sharding, wal
+from lsh.sharding import ShardedStorage
+from lsh.signatures import SignatureStore, pack_bits, unpack_bits
+from lsh.redis_storage import RedisConnection, RedisError, RedisStorage
+from resp_server import RESPServer
 
 class HashFamilyTest(unittest.TestCase):
     def _test_family(self, hash_family):
@@ -34,7 +62,157 @@ class HashFamilyTest(unittest.TestCase):
     
     def testMultiply(self):
         self._test_family(MultiplyHashFamily)
+
+    def testSeed(self):
+        for hash_family in (XORHashFamily, MultiplyHashFamily, OnePermutationHashFamily):
+            family = hash_family(10, 131071, seed=42)
+            random.seed(1234)
+            seeded = hash_family(10, 131071, seed=42)
+            self.assertEqual(family.__dict__, seeded.__dict__)
+            # the random module is left alone
+            self.assertEqual(random.Random(1234).random(), random.random())
+            self.assertNotEqual(family.__dict__, hash_family(10, 131071, seed=43).__dict__)
+
+    @unittest.skipIf(np is None, "numpy is not installed")
+    def testHashArray(self):
+        xs = [0, 1, 1234, 131070, -5, 2 ** 40, 2 ** 70]
+        for hash_family in (XORHashFamily, MultiplyHashFamily):
+            random.seed(1234)
+            family = hash_family(10, 131071)
+            self.assertListEqual([list(family.hashn(x)) for x in xs],
+                                 family.hash_array(xs).tolist())
+            self.assertListEqual([list(family.hashn(x)) for x in xs[:4]],
+                                 family.hash_array(xs[:4]).tolist())
         
+class OnePermutationTest(unittest.TestCase):
+    def testSignature(self):
+        random.seed(1234)
+        family = OnePermutationHashFamily(20, 131071)
+        sig = family.signature(range(1000))
+        self.assertEqual(20, len(sig))
+        self.assertTrue(all(h != sys.maxint for h in sig))
+        # a single value fills every bin by densification
+        self.assertEqual(1, len(set(family.signature([5]))))
+        self.assertListEqual([sys.maxint] * 20, family.signature([]))
+        sets = [range(1000), range(500, 1500), [5], [], range(3)]
+        if np is not None:
+            lengths = map(len, sets)
+            self.assertListEqual(map(family.signature, sets),
+                                 family.signature_matrix(sum(sets, []), lengths).tolist())
+
+    def testSignatureFamily(self):
+        # whole signature families are not hash families, and only need to provide signature
+        self.assertFalse(isinstance(OnePermutationHashFamily(20, 131071), IHashFamily))
+
+        class MinFamily(ISignatureFamily):
+            def __init__(self, num_hashes, num_buckets, seed=None):
+                self._n = num_hashes
+
+            def signature(self, xs):
+                return [min(xs) + i if len(xs) else sys.maxint for i in xrange(self._n)]
+
+        docs = [doc.split() for doc in ["a b c d", "a b c e", "x y z"]]
+        engines = ('python', 'numpy') if np is not None else ('python',)
+        for engine in engines:
+            cache = LSHCache(b=5, r=2, minhash=MinFamily, engine=engine, shingler=Shingler(1))
+            dups = cache.insert_batch(docs)
+            self.assertEqual(set(), dups[2])
+            self.assertEqual(cache.get_dups(docs[2]), set([2]))
+        with self.assertRaises(AssertionError):
+            LSHCache(minhash=object)
+
+    def testCollisionProbability(self):
+        # rows agree with probability equal to the jaccard similarity (here 1/3)
+        random.seed(1234)
+        agree = 0.0
+        for _ in xrange(200):
+            family = OnePermutationHashFamily(20, 131071)
+            a, b = family.signature(range(0, 200)), family.signature(range(100, 300))
+            agree += sum(x == y for x, y in zip(a, b))
+        self.assertAlmostEqual(1.0 / 3, agree / (200 * 20), places=1)
+
+    def testCache(self):
+        docs = [doc.split() for doc in ["lipstick on a pig",
+                                        "you can put lipstick on a pig",
+                                        "they were going to send us binders full of women",
+                                        "",
+                                        "they were going to send us binders of women",
+                                        "you can put lipstick on a pig"]]
+        engines = ('python', 'numpy') if np is not None else ('python',)
+        results = []
+        for engine in engines:
+            random.seed(12345)
+            cache = LSHCache(b=25, r=4, minhash=OnePermutationHashFamily, engine=engine)
+            results.append(cache.insert_batch(docs))
+            random.seed(12345)
+            cache = LSHCache(b=25, r=4, minhash=OnePermutationHashFamily, engine=engine)
+            results.append(map(cache.insert, docs))
+        self.assertTrue(all(result == results[0] for result in results))
+        self.assertTrue(1 in results[0][5])
+        self.assertTrue(2 in results[0][4])
+
+
+class HashingTest(unittest.TestCase):
+    def testStableHash(self):
+        values = ['a', u'a', ('a', 'b'), (u'a', 'b'), ('ab',), (None, 'a'), (1, 2), None, 5, -1, 2 ** 70]
+        hashes = map(stable_hash, values)
+        self.assertTrue(all(0 <= h < 2 ** 63 for h in hashes))
+        # unicode strings hash as their utf-8 bytes
+        self.assertEqual(hashes[0], hashes[1])
+        self.assertEqual(hashes[2], hashes[3])
+        self.assertEqual(len(values) - 2, len(set(hashes)))
+        self.assertEqual(5, stable_hash(5))
+        self.assertNotEqual(stable_hash(('a', 'b'), seed=1), stable_hash(('a', 'b')))
+        self.assertNotEqual(stable_hash(5, seed=1), 5)
+        # the items of tuples are hashed separately, so joining them cannot make tuples collide
+        self.assertNotEqual(stable_hash(('a\x00b',)), stable_hash(('a', 'b')))
+        self.assertNotEqual(stable_hash(('a', '')), stable_hash(('a\x00',)))
+        # other values are hashed by their repr
+        self.assertEqual(stable_hash(1.5), stable_hash(1.5))
+        self.assertNotEqual(stable_hash(1.5), stable_hash('1.5'))
+        self.assertTrue(LSHCache().insert([1.5, 2.5]) is not None)
+
+    def testWindowHashes(self):
+        tokens = ['a', u'b', 'c', None, 5, 'a', 'b', 1.5]
+        token_hashes = TokenHashes()
+        hashes = token_hashes.hashes(tokens)
+        self.assertEqual(len(set(tokens)), len(token_hashes))
+        for n in (1, 2, 3, 5):
+            expected = [stable_hash(tuple(tokens[i:i + n])) for i in xrange(len(tokens) - n + 1)]
+            self.assertListEqual(expected, window_hashes(hashes, n))
+            self.assertListEqual([stable_hash(window, seed=1) for window in zip(*[tokens[k:] for k in xrange(n)])],
+                                 window_hashes(TokenHashes(seed=1).hashes(tokens), n, seed=1))
+        # unhashable tokens are hashed without being kept
+        self.assertListEqual(token_hashes.hashes(['a', 'b']), token_hashes.hashes(['a', 'b', [1]])[:2])
+        shingler = Shingler(2, 3)
+        for doc in (tokens, ['a'], []):
+            expected = map(stable_hash, shingler.shingle(doc))
+            self.assertListEqual(expected, shingler.shingle_hashes(token_hashes.hashes(doc), token_hashes[None]))
+        cache = LSHCache(shingler=shingler)
+        self.assertSetEqual(set(h % 131071 for h in expected), cache.shingle_ids([]))
+
+    def testAcrossProcesses(self):
+        # unlike the built-in hash, shingle ids and band keys do not depend on PYTHONHASHSEED
+        code = 'from lsh import LSHCache; print LSHCache(b=4, r=2, seed=1)._get_lsh_from_doc("a b c".split())'
+        outputs = set()
+        for hash_seed in ('1', '2'):
+            env = dict(os.environ, PYTHONHASHSEED=hash_seed)
+            outputs.add(subprocess.check_output([sys.executable, '-c', code], env=env,
+                                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+        self.assertEqual(1, len(outputs))
+
+    def testBandHashes(self):
+        sigs = [[random.randint(0, 131070) for _ in xrange(20)] for _ in xrange(10)]
+        sigs.append([sys.maxint] * 20)
+        lshs = [band_hashes(sig, 5, 4) for sig in sigs]
+        self.assertTrue(all(0 <= h < 2 ** 63 for lsh in lshs for h in lsh))
+        self.assertEqual(1, len(set(lshs[-1])))
+        self.assertNotEqual(lshs[0], band_hashes(sigs[0], 5, 4, seed=1))
+        if np is not None:
+            self.assertListEqual(lshs, band_hash_matrix(np.array(sigs), 5, 4).tolist())
+            self.assertListEqual(lshs, band_hash_matrix(np.array(sigs, dtype=object), 5, 4).tolist())
+
+
 class ShinglerTest(unittest.TestCase):
     def testLenOne(self):
         s = Shingler(1)
@@ -59,6 +237,23 @@ class ShinglerTest(unittest.TestCase):
         self.assertSetEqual(set([(None,'a',),(None,None,'a',)]), set(s.shingle("a")))
         
     
+    def testRolling(self):
+        docs = ["abcdef", "a", "", "ab", "abcabcabc", "the quick brown fox".split()]
+        for args in ((1,), (2,), (3,), (2, 4)):
+            s, rolling = Shingler(*args), RollingShingler(*args)
+            for doc in docs:
+                ids = list(rolling.shingle(doc))
+                self.assertEqual(len(list(s.shingle(doc))), len(ids))
+                # equal shingles get equal ids and different shingles different ids
+                self.assertEqual(len(set(s.shingle(doc))), len(set(ids)))
+                self.assertTrue(all(0 <= i < 2 ** 63 for i in ids))
+                if np is not None:
+                    self.assertListEqual(ids, rolling.shingle_array(doc).tolist())
+        self.assertListEqual(list(RollingShingler(2).shingle("abcd")),
+                             list(RollingShingler(2).shingle("abcd")))
+        self.assertNotEqual(list(RollingShingler(2).shingle("a")), list(RollingShingler(1).shingle("a")))
+        self.assertEqual("RollingShingler(len 2<=3)", str(RollingShingler(2, 3)))
+
     def testBadArgs(self):
         with self.assertRaises(AssertionError):
             Shingler(0)
@@ -66,6 +261,607 @@ class ShinglerTest(unittest.TestCase):
             Shingler(2,1)
        
         
+class BandTableTest(unittest.TestCase):
+    def testCompactBandTable(self):
+        random.seed(1234)
+        compact, expected = CompactBandTable(), DictBandTable()
+        keys = [random.randint(-2 ** 63, 2 ** 63 - 1) for _ in xrange(200)] + [0, -1, 1]
+        for doc_id in xrange(2000):
+            key = random.choice(keys)
+            compact.append(key, doc_id)
+            expected.append(key, doc_id)
+        self.assertEqual(len(expected), len(compact))
+        for key in keys:
+            self.assertListEqual(expected[key], compact.get(key))
+            self.assertTrue(key in compact)
+        self.assertIsNone(compact.get(12345))
+        self.assertEqual((), compact.get(12345, ()))
+        self.assertFalse(12345 in compact)
+        self.assertDictEqual(dict(expected), dict(compact.iteritems()))
+
+    def testCompactRemove(self):
+        random.seed(1234)
+        compact, expected = CompactBandTable(), DictBandTable()
+        keys = [random.randint(-2 ** 63, 2 ** 63 - 1) for _ in xrange(300)]
+        postings = []
+        for doc_id in xrange(5000):
+            key = random.choice(keys)
+            compact.append(key, doc_id)
+            expected.append(key, doc_id)
+            postings.append((key, doc_id))
+            if len(postings) > 200:
+                key, removed = postings.pop(random.randrange(len(postings)))
+                compact.remove(key, removed)
+                expected.remove(key, removed)
+        self.assertEqual(len(expected), len(compact))
+        self.assertDictEqual(dict(expected), dict(compact.iteritems()))
+        for key in keys:
+            self.assertEqual(expected.get(key), compact.get(key))
+        # removed postings are reused
+        self.assertTrue(len(compact._docs) <= 201)
+        with self.assertRaises(ValueError):
+            compact.remove(keys[0], 123456)
+
+    def testCompactHotRemove(self):
+        rng = random.Random(1234)
+        compact, expected = CompactBandTable(), DictBandTable()
+        for doc_id in xrange(2000):
+            key = 0 if rng.random() < 0.9 else rng.randint(1, 5)
+            compact.append(key, doc_id)
+            expected.append(key, doc_id)
+            if 0 in expected and rng.random() < 0.4:
+                # mostly the oldest doc_id of the hot bucket, as when evicting
+                bucket = list(expected[0])
+                removed = bucket[0] if rng.random() < 0.7 else rng.choice(bucket)
+                compact.remove(0, removed)
+                expected.remove(0, removed)
+        self.assertDictEqual(dict((key, list(bucket)) for key, bucket in expected.iteritems()),
+                             dict(compact.iteritems()))
+        # the postings of the hot bucket were indexed once removing searched a long way for them
+        self.assertEqual(len(expected[0]), compact._postings.size)
+        with self.assertRaises(ValueError):
+            compact.remove(0, 123456)
+        # the most recent doc_id of another bucket
+        with self.assertRaises(ValueError):
+            compact.remove(0, expected[1][-1])
+        for doc_id in list(expected[0]):
+            compact.remove(0, doc_id)
+        self.assertIsNone(compact.get(0))
+        self.assertEqual(0, compact._postings.size)
+        compact.append(0, 5000)
+        self.assertListEqual([5000], compact.get(0))
+
+    def testDictRemove(self):
+        rng = random.Random(1234)
+        table, expected = DictBandTable(), []
+        for doc_id in xrange(1000):
+            table.append(0, doc_id)
+            expected.append(doc_id)
+            if rng.random() < 0.3:
+                # mostly the oldest doc_id, as when evicting
+                removed = expected[0] if rng.random() < 0.7 else rng.choice(expected)
+                table.remove(0, removed)
+                expected.remove(removed)
+        bucket = table.get(0)
+        # large buckets remove doc_ids without searching for them but are read as lists
+        self.assertTrue(isinstance(bucket, OrderedBucket))
+        self.assertListEqual(expected, list(bucket))
+        self.assertEqual(len(expected), len(bucket))
+        self.assertListEqual(expected[::-7], bucket[::-7])
+        self.assertTrue(expected[3] in bucket and 1000 not in bucket)
+        self.assertListEqual(expected, pickle.loads(pickle.dumps(bucket)))
+        if np is not None:
+            self.assertListEqual(expected, np.asarray(bucket, dtype=np.int64).tolist())
+        with self.assertRaises(ValueError):
+            table.remove(0, 1000)
+        for doc_id in expected:
+            table.remove(0, doc_id)
+        self.assertFalse(0 in table)
+
+    def testCompactCache(self):
+        docs = [doc.split() for doc in ["lipstick on a pig",
+                                        "you can put lipstick on a pig",
+                                        "you may put lipstick on a pig but it's still a pig",
+                                        "they were going to send us binders full of women",
+                                        "they were going to send us binders of women",
+                                        "you can put lipstick on a pig"]]
+        random.seed(12345)
+        expected = LSHCache(b=25, r=4, m=2).insert_batch(docs)
+        random.seed(12345)
+        cache = LSHCache(b=25, r=4, m=2, band_table=CompactBandTable)
+        self.assertListEqual(expected, cache.insert_batch(docs))
+        cache.clear()
+        self.assertEqual(0, len(cache._storage.tables[0]))
+
+
+class ForestTest(unittest.TestCase):
+    def testPrefixBandTable(self):
+        table = PrefixBandTable(min_merge=2)
+        for doc_id, key in enumerate([(1, 2, 3), (1, 2, 4), (1, 3, 3), (2, 2, 3), (1, 2, 3)]):
+            table.append(key, doc_id)
+        self.assertListEqual([0, 4], table.get((1, 2, 3)))
+        self.assertEqual(None, table.get((1, 2, 5)))
+        self.assertListEqual([0, 1, 4], table.prefix((1, 2)))
+        self.assertListEqual([0, 1, 2, 4], table.prefix((1,)))
+        self.assertListEqual(range(5), table.prefix(()))
+        self.assertEqual(4, len(table))
+        self.assertTrue((2, 2, 3) in table)
+        table.remove((1, 2, 3), 0)
+        table.remove((2, 2, 3), 3)
+        with self.assertRaises(ValueError):
+            table.remove((2, 2, 3), 3)
+        self.assertListEqual([(1, 2, 3), (1, 2, 4), (1, 3, 3)], [key for key, _ in table.iteritems()])
+        self.assertListEqual([1, 4], table.prefix((1, 2)))
+
+    def testPrefixRemove(self):
+        rng = random.Random(1234)
+        table, expected = PrefixBandTable(min_merge=16), {}
+        keys = [(rng.randint(0, 3), rng.randint(0, 3)) for _ in xrange(10)]
+        for doc_id in xrange(1000):
+            key = rng.choice(keys)
+            table.append(key, doc_id)
+            expected.setdefault(key, []).append(doc_id)
+            if rng.random() < 0.45:
+                # mostly the oldest doc_id, as when evicting
+                key = rng.choice(expected.keys())
+                removed = min(expected[key]) if rng.random() < 0.7 else rng.choice(expected[key])
+                size = len(table._labels)
+                table.remove(key, removed)
+                expected[key].remove(removed)
+                if not expected[key]:
+                    del expected[key]
+                # removing from the large list leaves a tombstone rather than moving the list
+                self.assertTrue(len(table._labels) in (size, 0) or table._tombstones == 0)
+        self.assertTrue(table._tombstones > 0)
+        self.assertEqual(len(expected), len(table))
+        self.assertDictEqual(expected, dict(table.iteritems()))
+        for key in keys:
+            self.assertEqual(expected.get(key), table.get(key))
+            self.assertListEqual(sorted(it.chain.from_iterable(doc_ids for label, doc_ids in expected.iteritems()
+                                                               if label[0] == key[0])),
+                                 table.prefix(key[:1]))
+        # merging drops the tombstones
+        table._merge()
+        self.assertEqual(0, table._tombstones)
+        self.assertEqual(sum(map(len, expected.values())), len(table._labels))
+
+    def testForest(self):
+        rand = random.Random(1234)
+        base = [rand.randint(0, 100000) for _ in xrange(100)]
+        # documents sharing 90, 70, 50 and 0 of the 100 shingles of the first document
+        docs = [base] + [base[:k] + [rand.randint(0, 100000) for _ in xrange(100 - k)] for k in (90, 70, 50, 0)]
+        forest = LSHForest(b=20, r=10, shingler=Shingler(1), seed=12345)
+        sigs = map(forest._get_sig_from_doc, docs)
+
+        def matching(r, m=1):
+            # the docs whose signatures agree with that of base on the first r rows of m bands
+            return set(doc_id for doc_id, sig in enumerate(sigs)
+                       if sum(sig[10 * band:10 * band + r] == sigs[0][10 * band:10 * band + r]
+                              for band in xrange(20)) >= m)
+        self.assertListEqual([set(), set([0]) & matching(10)], forest.insert_batch(docs)[:2])
+        cache = LSHCache(b=20, r=10, shingler=Shingler(1), seed=12345)
+        cache.insert_batch(docs)
+        for doc in docs:
+            self.assertSetEqual(cache.get_dups(doc), forest.get_dups(doc))
+            self.assertSetEqual(cache.get_dups(doc), forest.get_dups(doc, r=10, m=1))
+        # fewer rows per band find less similar documents
+        for r in (10, 5, 3, 2):
+            self.assertSetEqual(matching(r), forest.get_dups(base, r=r))
+        self.assertTrue(matching(10) < matching(3))
+        self.assertSetEqual(matching(2) - set([0]), forest.get_dups(base, 0, r=2))
+        # and requiring more matching bands finds only the most similar
+        self.assertSetEqual(matching(3, 5), forest.get_dups(base, r=3, m=5))
+        self.assertSetEqual(matching(10, 10), forest.get_dups(base, m=10))
+        self.assertTrue(1 in matching(3, 5) and 4 not in matching(2))
+        self.assertListEqual([forest.get_dups(doc, r=3) for doc in docs], forest.get_dups_batch(docs, r=3))
+        if np is not None:
+            offsets, dup_ids = forest.get_dups_batch(docs, r=3, flat=True)
+            self.assertListEqual([forest.get_dups(doc, r=3) for doc in docs],
+                                 [set(dup_ids[start:end]) for start, end in zip(offsets, offsets[1:])])
+        self.assertTrue(forest.theoretical_percent_found(0.5, r=3) > forest.theoretical_percent_found(0.5))
+        self.assertAlmostEqual(cache.theoretical_percent_found(0.7), forest.theoretical_percent_found(0.7))
+        with self.assertRaises(AssertionError):
+            forest.get_dups(base, r=11)
+        with self.assertRaises(AssertionError):
+            LSHForest(band_table=CompactBandTable)
+
+        forest.remove(1, docs[1])
+        self.assertSetEqual(set([0, 2, 3]), forest.get_dups(base, r=3))
+        self.assertEqual(4, len(forest._storage.tables[0]))
+
+        # a forest can neither be saved nor merged into a cache
+        with self.assertRaises(ValueError):
+            forest.save(os.devnull)
+        with self.assertRaises(AssertionError):
+            cache.merge(forest)
+
+    def testForestOptions(self):
+        rand = random.Random(1234)
+        base = [rand.randint(0, 100000) for _ in xrange(100)]
+        docs = [base[:k] + [rand.randint(0, 100000) for _ in xrange(100 - k)] for k in (100, 90, 90, 90, 70)]
+        forest = LSHForest(b=20, r=10, shingler=Shingler(1), seed=4, instrument=True, max_bucket_size=3)
+        forest.insert_batch(docs)
+        self.assertEqual(5, forest.stats()['reductions'])
+        unlimited = LSHForest(b=20, r=10, shingler=Shingler(1), seed=4)
+        unlimited.insert_batch(docs)
+        # lookups with any minimum support are counted, and skip the buckets of 3 or more doc_ids
+        for m in (1, 2):
+            skipped = forest.stats()['stop_bucket_events'].get('buckets_skipped', 0)
+            dups = forest.get_dups(base, r=3, m=m)
+            self.assertTrue(dups < unlimited.get_dups(base, r=3, m=m))
+            self.assertTrue(forest.stats()['stop_bucket_events']['buckets_skipped'] > skipped)
+        self.assertEqual(7, forest.stats()['reductions'])
+        self.assertEqual(7, forest.stats()['stages']['reduce']['count'])
+
+
+@unittest.skipIf(np is None, "numpy is not installed")
+class SignatureStoreTest(unittest.TestCase):
+    docs = [doc.split() for doc in ["lipstick on a pig",
+                                    "you can put lipstick on a pig",
+                                    "you can put lipstick on a pig it's still a pig",
+                                    "i think they put some lipstick on a pig but it's still a pig",
+                                    "they were going to send us binders full of women"]]
+
+    def testStore(self):
+        store = SignatureStore(4, capacity=2)
+        store[0] = [1, 2, 3, 4]
+        store[5] = [1, 2, 0, sys.maxint]
+        self.assertListEqual([1, 2, 0, sys.maxint], store[5])
+        self.assertTrue(5 in store)
+        self.assertFalse(3 in store)
+        self.assertEqual(2, len(store))
+        with self.assertRaises(KeyError):
+            store[3]
+        self.assertListEqual([1.0, 0.5], store.similarity([1, 2, 3, 4], [0, 5]).tolist())
+        self.assertListEqual([(5, 1.0), (0, 0.5)], store.rank([1, 2, 0, sys.maxint], [0, 5, 3]))
+        self.assertListEqual([(5, 1.0)], store.rank([1, 2, 0, sys.maxint], [0, 5], threshold=0.75))
+        self.assertListEqual([(0, 0.75)], store.rank([1, 2, 3, 0], [5, 0], k=1))
+        del store[5]
+        self.assertFalse(5 in store)
+
+    def testRankedDups(self):
+        random.seed(12345)
+        cache = LSHCache(b=50, r=2, store_minhashes=True)
+        cache.insert_batch(self.docs[:4] + self.docs[:1])
+        ranked = cache.get_ranked_dups(self.docs[0])
+        self.assertSetEqual(cache.get_dups(self.docs[0]), set(doc_id for doc_id, _ in ranked))
+        self.assertListEqual([(0, 1.0), (4, 1.0)], ranked[:2])
+        sims = [sim for _, sim in ranked]
+        self.assertListEqual(sorted(sims, reverse=True), sims)
+        self.assertListEqual(ranked[:3], cache.get_ranked_dups(self.docs[0], k=3))
+        self.assertListEqual([(0, 1.0)], cache.get_ranked_dups(None, 4, threshold=0.9))
+        self.assertTrue(all(sim >= 0.5 for _, sim in cache.get_ranked_dups(self.docs[1], threshold=0.5)))
+        with self.assertRaises(AssertionError):
+            LSHCache().get_ranked_dups(self.docs[0])
+
+        # every insertion path stores the same signatures
+        for kwargs in ({'engine': 'numpy'}, {'workers': 2}):
+            random.seed(12345)
+            other = LSHCache(b=50, r=2, store_minhashes=True, engine=kwargs.get('engine', 'python'))
+            other.insert_batch(self.docs[:4] + self.docs[:1], workers=kwargs.get('workers'))
+            self.assertListEqual(ranked, other.get_ranked_dups(self.docs[0]))
+        cache.clear()
+        self.assertEqual(0, len(cache._minhashes))
+
+    def testBBit(self):
+        sigs = [[0, 1, 2, 3, 255, sys.maxint, 7], [5, 5, 5, 5, 5, 5, 5]]
+        for bits in (1, 2, 4, 8):
+            packed = pack_bits(sigs, bits)
+            self.assertEqual((2, -(-7 * bits // 8)), packed.shape)
+            self.assertListEqual([[h & ((1 << bits) - 1) for h in sig] for sig in sigs],
+                                 unpack_bits(packed, bits, 7).tolist())
+
+        store = SignatureStore(4, capacity=2, bits=2)
+        self.assertEqual(1, store._sigs.shape[1])
+        store[0] = [1, 2, 3, 4]
+        store[3] = pack_bits([[1, 2, 0, 0]], 2)[0].tostring()
+        self.assertListEqual([1, 2, 0, 0], store[3])
+        self.assertListEqual([1, 2, 3, 0], store[0])
+        # half the rows agreeing is what dissimilar 1-bit signatures do by chance
+        store = SignatureStore(2, bits=1)
+        store[0], store[1] = [0, 1], [0, 0]
+        self.assertListEqual([1.0, 0.0], store.similarity([0, 1], [0, 1]).tolist())
+        self.assertListEqual([(0, 1.0)], store.rank([0, 1], [0, 1], threshold=0.5))
+
+    def testBBitCache(self):
+        rand = random.Random(1234)
+        docs = [[rand.randint(0, 10000) for _ in xrange(200)] for _ in xrange(20)]
+        docs.append(docs[0][:150] + docs[1][:50])
+        random.seed(12345)
+        cache = LSHCache(b=40, r=5, store_minhashes=True, sig_bits=4, shingler=Shingler(1))
+        dups = cache.insert_batch(docs)
+        self.assertEqual(set([0]), dups[-1])
+        self.assertEqual(100, cache._minhashes._sigs.shape[1])
+        (doc_id, sim), = cache.get_ranked_dups(None, 20)
+        self.assertEqual(0, doc_id)
+        # the estimate is close to the jaccard similarity of 3/5
+        self.assertAlmostEqual(0.6, sim, places=1)
+
+        # every insertion path computes the same b-bit signatures
+        for kwargs in ({'engine': 'numpy'}, {'workers': 2}):
+            random.seed(12345)
+            other = LSHCache(b=40, r=5, store_minhashes=True, sig_bits=4, shingler=Shingler(1),
+                             engine=kwargs.get('engine', 'python'))
+            self.assertListEqual(dups, other.insert_batch(docs, workers=kwargs.get('workers')))
+            self.assertTrue((cache._minhashes._sigs == other._minhashes._sigs).all())
+        cache.remove(20)
+        self.assertListEqual([], cache.get_ranked_dups(None, 0))
+
+
+class RemoveTest(unittest.TestCase):
+    docs = SignatureStoreTest.docs
+
+    def _test_remove(self, **kwargs):
+        random.seed(12345)
+        cache = LSHCache(b=50, r=2, **kwargs)
+        cache.insert_batch(self.docs)
+        self.assertSetEqual(set([0, 1, 2, 3]), cache.get_dups(self.docs[1]))
+        cache.remove(1, self.docs[1])
+        self.assertSetEqual(set([0, 2, 3]), cache.get_dups(self.docs[1]))
+        self.assertEqual(4, cache.num_docs())
+        self.assertEqual(4, cache.max_doc_id())
+        with self.assertRaises(AssertionError):
+            cache.remove(1, self.docs[1])
+        # a removed doc_id can be inserted again
+        self.assertSetEqual(set([0, 2, 3]), cache.insert(self.docs[1], 1))
+        return cache
+
+    def testRemove(self):
+        self._test_remove()
+        self._test_remove(band_table=CompactBandTable)
+        cache = self._test_remove(store_signatures=True)
+        cache.remove(0)
+        self.assertSetEqual(set([1, 2, 3]), cache.get_dups(self.docs[0]))
+        if np is not None:
+            cache = self._test_remove(store_minhashes=True)
+            cache.remove(0)
+            self.assertListEqual([1, 2, 3], sorted(doc_id for doc_id, _ in cache.get_ranked_dups(self.docs[0])))
+        with self.assertRaises(AssertionError):
+            self._test_remove().remove(0)
+
+    def testMaxDocs(self):
+        random.seed(12345)
+        cache = LSHCache(b=50, r=2, max_docs=2)
+        self.assertListEqual([set(), set([0]), set([1]), set([2])],
+                             cache.insert_batch(self.docs[:4]))
+        self.assertEqual(2, cache.num_docs())
+        self.assertEqual(3, cache.max_doc_id())
+        self.assertSetEqual(set([2, 3]), cache.get_dups(self.docs[0]))
+
+    def testMaxAge(self):
+        now = [1000.0]
+        random.seed(12345)
+        cache = LSHCache(b=50, r=2, max_age=10)
+        cache._clock = lambda: now[0]
+        cache.insert(self.docs[0])
+        now[0] += 5
+        self.assertSetEqual(set([0]), cache.insert(self.docs[1]))
+        now[0] += 5
+        self.assertSetEqual(set([1]), cache.get_dups(self.docs[0]))
+        self.assertEqual(1, cache.num_docs())
+        now[0] += 5
+        cache.evict_expired()
+        self.assertEqual(0, cache.num_docs())
+        self.assertEqual(1, cache.max_doc_id())
+
+    def testSteadyState(self):
+        cache = LSHCache(max_docs=50, band_table=CompactBandTable)
+        for i in xrange(500):
+            cache.insert([random.randint(0, 10) for _ in xrange(10)])
+        self.assertEqual(50, cache.num_docs())
+        self.assertTrue(all(len(table._docs) <= 51 for table in cache._storage.tables))
+
+
+class InstrumentTest(unittest.TestCase):
+    docs = [doc.split() for doc in ["lipstick on a pig",
+                                    "you can put lipstick on a pig",
+                                    "you can put lipstick on a pig",
+                                    "they were going to send us binders full of women",
+                                    "you can put lipstick on a pig"]]
+
+    def testDisabled(self):
+        cache = LSHCache()
+        self.assertEqual(LSHCache._get_sig.__func__, cache._get_sig.__func__)
+        stats = cache.stats()
+        self.assertFalse('stages' in stats)
+        self.assertEqual(20, len(stats['bands']))
+
+    def testStats(self):
+        cache = LSHCache(b=10, r=2, instrument=True)
+        dups = map(cache.insert, self.docs)
+        cache.get_dups(self.docs[0])
+        stats = cache.stats(top=3)
+        self.assertEqual(5, stats['num_docs'])
+        for stage in ('shingle', 'minhash', 'band_hash'):
+            self.assertEqual(6, stats['stages'][stage]['count'])
+            self.assertEqual(6, sum(count for _, count in stats['stages'][stage]['histogram']))
+        self.assertEqual(6, stats['reductions'])
+        self.assertEqual(sum(map(len, dups)) + len(cache.get_dups(self.docs[0])), stats['candidates'])
+        self.assertTrue(all(band['postings'] == 5 for band in stats['bands']))
+        self.assertEqual(sum(band['buckets'] for band in stats['bands']),
+                         sum(count for _, count in stats['bucket_sizes']))
+        # the three copies of the same document share a bucket of each band
+        largest = [size for size, _, _ in stats['largest_buckets']]
+        self.assertEqual(3, len(largest))
+        self.assertListEqual(sorted(largest, reverse=True), largest)
+        self.assertTrue(largest[-1] >= 3)
+        self.assertEqual(largest[0], max(band['largest'] for band in stats['bands']))
+
+        text = prometheus_text(stats)
+        self.assertTrue('lsh_docs 5\n' in text)
+        self.assertTrue('lsh_stage_seconds_count{stage="minhash"} 6\n' in text)
+        self.assertTrue('lsh_stage_seconds_bucket{le="+Inf",stage="minhash"} 6\n' in text)
+        self.assertTrue('lsh_band_postings{band="9"} 5\n' in text)
+        self.assertTrue('lsh_bucket_size_count %d\n' % sum(band['buckets'] for band in stats['bands']) in text)
+        for line in text.splitlines():
+            self.assertTrue(line.startswith('# TYPE ') or len(line.split(' ')) == 2, line)
+
+    @unittest.skipIf(np is None, "numpy is not installed")
+    def testBatch(self):
+        cache = LSHCache(b=10, r=2, engine='numpy', instrument=True)
+        cache.insert_batch(self.docs, chunk_size=2)
+        stats = cache.stats()
+        self.assertEqual(3, stats['stages']['minhash_batch']['count'])
+        self.assertEqual(3, stats['stages']['band_hash_batch']['count'])
+        self.assertEqual(5, stats['stages']['shingle']['count'])
+
+
+class StopBucketTest(unittest.TestCase):
+    doc = "you can put lipstick on a pig".split()
+
+    def testSkip(self):
+        cache = LSHCache(b=5, r=2, max_bucket_size=3)
+        self.assertListEqual([set(), set([0]), set([0, 1]), set(), set()],
+                             [cache.insert(self.doc) for _ in xrange(5)])
+        self.assertTrue(all(len(bucket) == 3 for bucket in cache._storage.get_buckets(cache._get_lsh_from_doc(self.doc))))
+        self.assertSetEqual(set(), cache.get_dups(self.doc))
+        stats = cache.stats()
+        self.assertEqual(5, stats['stop_buckets'])
+        self.assertDictEqual({'postings_dropped': 10, 'buckets_skipped': 15}, stats['stop_bucket_events'])
+        self.assertTrue('lsh_stop_bucket_events_total{event="postings_dropped"} 10\n' in prometheus_text(stats))
+
+        # documents left out of stop buckets can still be removed, and removals reopen them
+        cache.remove(3, self.doc)
+        cache.remove(0, self.doc)
+        self.assertSetEqual(set([1, 2]), cache.get_dups(self.doc))
+        self.assertSetEqual(set([1, 2]), cache.insert(self.doc, 10))
+        self.assertSetEqual(set(), cache.get_dups(self.doc))
+        self.assertEqual(4, cache.num_docs())
+
+    def testSample(self):
+        cache = LSHCache(b=5, r=2, max_bucket_size=3, stop_bucket_policy='sample', stop_bucket_sample=2)
+        self.assertListEqual([set(), set([0]), set([0, 1]), set([0, 2]), set([0, 2])],
+                             [cache.insert(self.doc) for _ in xrange(5)])
+        self.assertEqual(10, cache.stats()['stop_bucket_events']['buckets_sampled'])
+        with self.assertRaises(AssertionError):
+            LSHCache(stop_bucket_policy='drop')
+
+    def testUnlimited(self):
+        cache = LSHCache(b=5, r=2)
+        self.assertListEqual([set(), set([0]), set([0, 1]), set([0, 1, 2])],
+                             [cache.insert(self.doc) for _ in xrange(4)])
+        self.assertFalse('stop_bucket_events' in cache.stats())
+
+
+class ReduceTest(unittest.TestCase):
+    @staticmethod
+    def _count(buckets, min_support):
+        counts = {}
+        for bucket in buckets:
+            for doc_id in bucket:
+                counts[doc_id] = counts.get(doc_id, 0) + 1
+        return set(doc_id for doc_id, count in counts.iteritems() if count >= min_support)
+
+    def _random_buckets(self, rng):
+        num_ids = rng.choice([10, 1000, 10 ** 9])
+        size = rng.choice([0, 3, 100, 400])
+        return [rng.sample(xrange(num_ids), rng.randint(0, min(size, num_ids)))
+                for _ in xrange(rng.randint(0, 12))]
+
+    def testReduce(self):
+        rng = random.Random(7)
+        for _ in xrange(300):
+            buckets = self._random_buckets(rng)
+            self.assertEqual(self._count(buckets, 1), LSHCache._reduce_sets(buckets))
+            for min_support in (1, 2, 3, len(buckets), len(buckets) + 1):
+                self.assertEqual(self._count(buckets, min_support),
+                                 LSHCache._reduce_sets_by_min(buckets, min_support))
+
+    def testEarlyStop(self):
+        # no doc_id can be in 3 of the buckets once the first two are disjoint
+        buckets = [[1], [2], [3], [1, 2]]
+        self.assertEqual(set(), LSHCache._reduce_sets_by_min(buckets, 3))
+        self.assertEqual(set([1, 2]), LSHCache._reduce_sets_by_min(buckets, 2))
+        self.assertEqual(set(), LSHCache._reduce_sets_by_min(buckets[:1], 2))
+
+    @unittest.skipIf(np is None, "numpy is not installed")
+    def testReduceArrays(self):
+        rng = random.Random(11)
+        for _ in xrange(300):
+            buckets = self._random_buckets(rng)
+            for min_support in (2, 3, len(buckets)):
+                self.assertEqual(self._count(buckets, min_support),
+                                 LSHCache._reduce_arrays_by_min(buckets, min_support))
+        # negative and sparse doc_ids are counted with unique rather than bincount
+        buckets = [[-5, 2, 10 ** 12] + range(10, 600), [-5, 2, 10 ** 12] + range(600, 1000)]
+        self.assertEqual(set([-5, 2, 10 ** 12]), LSHCache._reduce_arrays_by_min(buckets, 2))
+
+    @unittest.skipIf(np is None, "numpy is not installed")
+    def testNumpyCache(self):
+        docs = [[random.Random(i % 7).randint(0, 50) for _ in xrange(30)] for i in xrange(200)]
+        random.seed(5)
+        python = LSHCache(b=20, r=2, m=3)
+        random.seed(5)
+        numpy = LSHCache(b=20, r=2, m=3, engine='numpy')
+        self.assertEqual(python.insert_batch(docs), numpy.insert_batch(docs))
+
+
+class _NoShingler(Shingler):
+    def shingle(self, doc):
+        return iter(())
+
+
+@unittest.skipIf(np is None, "numpy is not installed")
+class TuningTest(unittest.TestCase):
+    def testSCurve(self):
+        for b, r, m in ((2, 1, 1), (20, 5, 1), (25, 4, 3), (10, 10, 10)):
+            cache = LSHCache(b=b, r=r, m=m)
+            for pct in (0.0, 0.3, 0.5, 0.8, 1.0):
+                self.assertAlmostEqual(cache.theoretical_percent_found(pct), tuning.s_curve(pct, b, r, m))
+        cache = LSHCache(b=20, r=5, sig_bits=2)
+        self.assertAlmostEqual(cache.theoretical_percent_found(0.5), tuning.s_curve(0.5, 20, 5, sig_bits=2))
+        curve = tuning.s_curve(np.linspace(0, 1, 11), 20, 5)
+        self.assertTrue((np.diff(curve) > 0).all())
+        # large numbers of bands neither overflow nor lose precision
+        self.assertAlmostEqual(0.5, pbinom(0.5, 2001, 1000))
+        self.assertAlmostEqual(0.5, tuning.s_curve(0.5, 2001, 1, 1001))
+
+    def testTune(self):
+        result = tuning.tune(0.8, max_fp=0.05, max_fn=0.05)
+        self.assertTrue(result.feasible)
+        self.assertTrue(result.fp <= 0.05 and result.fn <= 0.05)
+        self.assertEqual((result.fp, result.fn), tuning.error_rates(0.8, result.b, result.r, result.m))
+        # no fewer bands meet the targets
+        for b in xrange(1, result.b):
+            for r in xrange(1, 33):
+                for m in xrange(1, b + 1):
+                    fp, fn = tuning.error_rates(0.8, b, r, m)
+                    self.assertFalse(fp <= 0.05 and fn <= 0.05)
+        self.assertEqual(result, tuning.tune(0.8, max_memory=45 * 64))
+        self.assertTrue(tuning.tune(0.8, max_rows=result.b * result.r).feasible)
+        self.assertFalse(tuning.tune(0.8, max_bands=result.b - 1).feasible)
+        self.assertFalse(tuning.tune(0.8, max_rows=20).feasible)
+        self.assertEqual(result.kwargs(), dict(b=result.b, r=result.r, m=result.m))
+
+    def testValidate(self):
+        rand = random.Random(1234)
+        docs = [[rand.randint(0, 1000) for _ in xrange(50)] for _ in xrange(30)]
+        docs += [doc[:45] + [rand.randint(0, 1000) for _ in xrange(5)] for doc in docs[:10]]
+        result = tuning.tune(0.7, max_fp=0.1, max_fn=0.1)
+        measured = tuning.validate(LSHCache(shingler=Shingler(1), seed=1, **result.kwargs()), docs, 0.7)
+        self.assertEqual(40 * 39 / 2, measured['pairs'])
+        self.assertEqual(10, measured['similar'])
+        # the rates are those of the pairs found by a cache hashing the same way
+        reference = LSHCache(shingler=Shingler(1), seed=1, **result.kwargs()).insert_batch(docs)
+        found = set((dup, doc_id) for doc_id, dups in enumerate(reference) for dup in dups)
+        similar = set((doc_id, doc_id + 30) for doc_id in xrange(10))
+        self.assertAlmostEqual(len(similar - found) / 10.0, measured['fn_rate'])
+        self.assertAlmostEqual(len(found - similar) / (40 * 39 / 2 - 10.0), measured['fp_rate'])
+        self.assertTrue(measured['expected_fn_rate'] < 0.1)
+        self.assertTrue(measured['expected_fp_rate'] < 0.1)
+
+        # a sample is drawn with the given seed
+        samples = [tuning.validate(LSHCache(shingler=Shingler(1), seed=1, **result.kwargs()), docs, 0.7,
+                                   sample=20, seed=seed) for seed in (3, 3, 4)]
+        self.assertEqual(20 * 19 / 2, samples[0]['pairs'])
+        self.assertEqual(samples[0], samples[1])
+        self.assertNotEqual(samples[0], samples[2])
+
+    def testMain(self):
+        self.assertEqual(0, tuning.main(['--threshold', '0.8']))
+        self.assertEqual(1, tuning.main(['--threshold', '0.8', '--max-bands', '2']))
+
+
 class LSHTest(unittest.TestCase):
     
     def testExample(self):
@@ -103,15 +899,15 @@ class LSHTest(unittest.TestCase):
         cache = LSHCache(b=25,r=4)
         self.assertListEqual([set(),
                               set([0]),
-                              set(),
+                              set([0]),
                               set([1]),
-                              set([2]),
-                              set([0,1]),
-                              set([0,1,5]),
+                              set([0,2]),
+                              set([0,2,4]),
+                              set([1,3]),
                               set(),
                               set([7]),
                               set(),
-                              set([9])],
+                              set()],
                               cache.insert_batch([doc.split() for doc in docs]))
         # stricter still
         random.seed(12345)
@@ -121,12 +917,12 @@ class LSHTest(unittest.TestCase):
                               set(),
                               set([1]),
                               set(),
-                              set([0,1]),
-                              set([0,1,3,5]),
+                              set([0]),
+                              set([1,3]),
                               set(),
                               set([7]),
                               set(),
-                              set([])],
+                              set()],
                               cache.insert_batch([doc.split() for doc in docs]))
         # most strict
         random.seed(12345)
@@ -136,7 +932,7 @@ class LSHTest(unittest.TestCase):
                               set(),
                               set(),
                               set(),
-                              set(),
+                              set([0]),
                               set([1]),
                               set(),
                               set(),
@@ -149,17 +945,144 @@ class LSHTest(unittest.TestCase):
         cache = LSHCache(b=50,r=2,m=3)
         self.assertListEqual([set(),
                               set([0]),
-                              set(),
+                              set([0,1]),
                               set([0,1,2]),
-                              set([0,2,3]),
-                              set([0,1,3]),
-                              set([0,1,3,5]),
+                              set([2,3]),
+                              set([0,1,2,3]),
+                              set([0,1,2,3,5]),
                               set(),
                               set([7]),
                               set(),
                               set([9])],
                               cache.insert_batch([doc.split() for doc in docs]))
 
+    @unittest.skipIf(np is None, "numpy is not installed")
+    def testNumpyEngine(self):
+        docs = ["lipstick on a pig",
+                "you can put lipstick on a pig",
+                "you may put lipstick on a pig but it's still a pig",
+                "they were going to send us binders full of women",
+                "they were going to send us binders of women",
+                "a"]
+        for minhash in (XORHashFamily, MultiplyHashFamily):
+            random.seed(12345)
+            cache = LSHCache(b=25, r=4, minhash=minhash)
+            random.seed(12345)
+            np_cache = LSHCache(b=25, r=4, minhash=minhash, engine='numpy')
+            for doc in docs:
+                shingle_vec = cache._get_shingle_vec(doc.split())
+                self.assertListEqual(cache._get_sig(shingle_vec), np_cache._get_sig(shingle_vec))
+            self.assertListEqual(cache.insert_batch([doc.split() for doc in docs]),
+                                 np_cache.insert_batch([doc.split() for doc in docs]))
+        self.assertListEqual([sys.maxint] * 100, np_cache._get_sig(set()))
+
+    def testRollingShingler(self):
+        docs = [doc.split() for doc in ["lipstick on a pig",
+                                        "you can put lipstick on a pig",
+                                        "they were going to send us binders full of women",
+                                        "",
+                                        "they were going to send us binders of women",
+                                        "you can put lipstick on a pig"]]
+        engines = ('python', 'numpy') if np is not None else ('python',)
+        results = []
+        for engine in engines:
+            random.seed(12345)
+            cache = LSHCache(b=25, r=4, shingler=RollingShingler(2, 3), engine=engine)
+            results.append(cache.insert_batch(docs))
+            random.seed(12345)
+            cache = LSHCache(b=25, r=4, shingler=RollingShingler(2, 3), engine=engine)
+            results.append(map(cache.insert, docs))
+        self.assertTrue(all(result == results[0] for result in results))
+        self.assertTrue(1 in results[0][5])
+
+    @unittest.skipIf(np is None, "numpy is not installed")
+    def testNumpyBatch(self):
+        docs = [doc.split() for doc in ["lipstick on a pig",
+                                        "you can put lipstick on a pig",
+                                        "they were going to send us binders full of women",
+                                        "",
+                                        "they were going to send us binders of women",
+                                        "you can put lipstick on a pig"]]
+        for universe_size in (131071, 2 ** 62 + 135):
+            random.seed(12345)
+            expected = LSHCache(b=25, r=4, universe_size=universe_size).insert_batch(docs)
+            for chunk_size in (1, 4, 1000):
+                random.seed(12345)
+                cache = LSHCache(b=25, r=4, universe_size=universe_size, engine='numpy')
+                self.assertListEqual(expected, cache.insert_batch(docs, chunk_size=chunk_size))
+        # documents with explicit doc ids and documents without shingles
+        cache = LSHCache(shingler=_NoShingler(), engine='numpy')
+        self.assertListEqual([set(), set([10])],
+                             cache.insert_batch([("abc", 10), "def"], chunk_size=2))
+        self.assertEqual(11, cache.max_doc_id())
+
+    def testParallelBatch(self):
+        docs = [doc.split() for doc in ["lipstick on a pig",
+                                        "you can put lipstick on a pig",
+                                        "they were going to send us binders full of women",
+                                        "they were going to send us binders of women",
+                                        "you can put lipstick on a pig"]] * 3
+        queries = [doc.split() for doc in ["put lipstick on a pig", "binders full of women"]]
+        engines = ('python', 'numpy') if np is not None else ('python',)
+        for engine in engines:
+            random.seed(12345)
+            serial = LSHCache(b=25, r=4, engine=engine)
+            expected = serial.insert_batch(docs)
+            random.seed(12345)
+            cache = LSHCache(b=25, r=4, engine=engine)
+            self.assertListEqual(expected, cache.insert_batch(docs, chunk_size=2, workers=2))
+            self.assertListEqual(map(serial.get_dups, queries),
+                                 cache.get_dups_batch(queries, chunk_size=1, workers=2))
+            self.assertListEqual(map(serial.get_dups, queries), cache.get_dups_batch(queries))
+            self.assertListEqual([serial.get_dups(docs[0], 0)],
+                                 cache.get_dups_batch([(docs[0], 0)], workers=2))
+
+    def testDupsBatch(self):
+        docs = [doc.split() for doc in ["lipstick on a pig",
+                                        "you can put lipstick on a pig",
+                                        "they were going to send us binders full of women",
+                                        "they were going to send us binders of women",
+                                        "",
+                                        "you can put lipstick on a pig"]] * 2
+        queries = docs[:4] + [docs[5], (docs[1], 1), (docs[3], 100), "something else entirely".split()]
+        engines = ('python', 'numpy') if np is not None else ('python',)
+        for engine, m, max_bucket_size in it.product(engines, (1, 3), (None, 4)):
+            random.seed(12345)
+            cache = LSHCache(b=25, r=4, m=m, engine=engine, store_signatures=True,
+                             max_bucket_size=max_bucket_size)
+            cache.insert_batch(docs)
+            expected = [cache.get_dups(*query) if isinstance(query, tuple) else cache.get_dups(query)
+                        for query in queries]
+            self.assertListEqual(expected, cache.get_dups_batch(queries))
+            self.assertListEqual(expected, cache.get_dups_batch(queries, chunk_size=4))
+            doc_ids = [0, 1, 3, 11]
+            by_id = [cache.get_dups(None, doc_id) for doc_id in doc_ids]
+            self.assertListEqual(by_id, cache.get_dups_batch_by_id(doc_ids, chunk_size=3))
+            self.assertListEqual([], cache.get_dups_batch_by_id([]))
+            if np is None:
+                continue
+            for chunk_size in (1, 4, 1000):
+                offsets, dup_ids = cache.get_dups_batch(queries, chunk_size=chunk_size, flat=True)
+                self.assertListEqual([0] + list(np.cumsum(map(len, expected))), offsets.tolist())
+                self.assertListEqual(expected, [set(dup_ids[start:end]) for start, end in zip(offsets, offsets[1:])])
+                self.assertTrue(all(list(dup_ids[start:end]) == sorted(dup_ids[start:end])
+                                    for start, end in zip(offsets, offsets[1:])))
+            offsets, dup_ids = cache.get_dups_batch_by_id(doc_ids, flat=True)
+            self.assertListEqual(by_id, [set(dup_ids[start:end]) for start, end in zip(offsets, offsets[1:])])
+            offsets, dup_ids = cache.get_dups_batch([], flat=True)
+            self.assertListEqual([0], offsets.tolist())
+            self.assertEqual(0, len(dup_ids))
+        if np is not None:
+            # doc_ids too large to be offset by document when sorting the unions of buckets
+            cache = LSHCache(b=25, r=4, engine='numpy')
+            cache.insert_batch([(docs[1], 2 ** 62 + 1), (docs[5], 2 ** 62), (docs[0], 5)])
+            offsets, dup_ids = cache.get_dups_batch([docs[1], (docs[5], 2 ** 62)], flat=True)
+            self.assertListEqual(sorted(cache.get_dups(docs[1])) + sorted(cache.get_dups(docs[5], 2 ** 62)),
+                                 dup_ids.tolist())
+            self.assertTrue(2 ** 62 + 1 in dup_ids[offsets[1]:])
+        with self.assertRaises(AssertionError):
+            LSHCache().get_dups_batch_by_id([0])
+
     def testClear(self):
         random.seed(12345)
         lsh = LSHCache()
@@ -192,6 +1115,10 @@ class LSHTest(unittest.TestCase):
         lsh = LSHCache(b=25,r=4,m=3)
         self.assertAlmostEqual(0.2032, lsh.theoretical_percent_found(0.5), places=4)
         self.assertAlmostEqual(0.9997, lsh.theoretical_percent_found(0.8), places=4)
+        # rows of 1 bit signatures agree by chance half the time
+        lsh = LSHCache(b=2,r=1,sig_bits=1)
+        self.assertEqual(0.75, lsh.theoretical_percent_found(0.0))
+        self.assertEqual(1 - 0.25 ** 2, lsh.theoretical_percent_found(0.5))
         
     def testLSH(self):
         strings = [
@@ -229,6 +1156,8 @@ class LSHTest(unittest.TestCase):
             LSHCache(n=100, r=7)
         with self.assertRaises(AssertionError):
             LSHCache(n=100, b=7)
+        with self.assertRaises(AssertionError):
+            LSHCache(engine='fortran')
         
     def testLSHArgs(self):
         lsh = LSHCache()
@@ -281,6 +1210,736 @@ class LSHTest(unittest.TestCase):
         self.assertEqual(1, lsh.min_support())
 
 
+@unittest.skipIf(np is None, "numpy is not installed")
+class AppTest(unittest.TestCase):
+    docs = ["lipstick on a pig",
+            "you can put lipstick on a pig",
+            "they were going to send us binders full of women",
+            "they were going to send us binders of women",
+            "you can put lipstick on a pig",
+            "a b c d e f"]
+
+    def _cache(self):
+        return LSHCache(b=25, r=4, seed=12345)
+
+    def _service(self, **kwargs):
+        return lsh_app.DedupService(self._cache(), **kwargs)
+
+    def testBatching(self):
+        reference = self._cache()
+        expected = reference.insert_batch([doc.split() for doc in self.docs])
+        service = self._service(batch_size=4, max_wait=0.5)
+        requests = [service.submit('insert', doc.split()) for doc in self.docs]
+        service.start()
+        try:
+            results = [request.wait(10) for request in requests]
+            self.assertEqual(range(len(self.docs)), [result['doc_id'] for result in results])
+            self.assertEqual(map(sorted, expected), [result['dups'] for result in results])
+            self.assertEqual(2, service.batches)
+            # the same doc as docs[4], which is always a duplicate
+            dups = service.call('query', self.docs[1].split(), timeout=10)['dups']
+            self.assertEqual(sorted(reference.get_dups(self.docs[1].split())), dups)
+            self.assertTrue(set([1, 4]) <= set(dups))
+            result = service.call('insert_or_query', self.docs[3].split(), timeout=10)
+            self.assertEqual({'inserted': False, 'dups': sorted(reference.get_dups(self.docs[3].split()))}, result)
+            result = service.call('insert_or_query', "something else entirely".split(), timeout=10)
+            self.assertEqual({'doc_id': 6, 'inserted': True, 'dups': []}, result)
+            with self.assertRaises(ValueError):
+                service.call('insert', self.docs[0].split(), 0, timeout=10)
+        finally:
+            service.stop()
+        self.assertEqual(7, service.cache.num_docs())
+
+    def testBadDoc(self):
+        service = self._service(batch_size=3, max_wait=0.5)
+        requests = [service.submit('insert', self.docs[1].split()), service.submit('insert', 5),
+                    service.submit('insert', self.docs[4].split())]
+        service.start()
+        try:
+            self.assertEqual({'doc_id': 0, 'dups': []}, requests[0].wait(10))
+            with self.assertRaises(ValueError):
+                requests[1].wait(10)
+            self.assertEqual({'doc_id': 1, 'dups': [0]}, requests[2].wait(10))
+            self.assertEqual(1, service.batches)
+        finally:
+            service.stop()
+        with self.assertRaises(ValueError):
+            lsh_app._parse_doc('{"doc": ["a", 1.5]}')
+        with self.assertRaises(ValueError):
+            lsh_app._parse_doc('{"doc": ["a", true]}')
+        self.assertEqual(([u'a', 1], None), lsh_app._parse_doc('{"doc": ["a", 1]}'))
+
+    def testTimeout(self):
+        service = self._service()
+        with self.assertRaises(lsh_app.Timeout):
+            service.call('insert', self.docs[0].split(), timeout=0.01)
+
+    def testStats(self):
+        service = self._service(stats_interval=3600)
+        service.start()
+        try:
+            self.assertEqual([], service.stats()['largest_buckets'])
+            service.call('insert', self.docs[0].split(), timeout=10)
+            stats = service.stats()
+            self.assertEqual(1, stats['num_docs'])
+            self.assertEqual(1, stats['requests'])
+            self.assertEqual([], stats['largest_buckets'])
+            service.stats_interval = 0
+            self.assertNotEqual([], service.stats()['largest_buckets'])
+        finally:
+            service.stop()
+
+    def testBackpressure(self):
+        service = self._service(max_pending=2)
+        service.submit('insert', self.docs[0].split())
+        service.submit('insert', self.docs[1].split())
+        with self.assertRaises(lsh_app.Overloaded):
+            service.submit('insert', self.docs[2].split())
+        self.assertEqual(1, service.rejected)
+
+    def testServer(self):
+        import json
+        import urllib2
+        service = self._service()
+        server = lsh_app.DedupServer(('localhost', 0), service)
+        service.start()
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        url = 'http://localhost:%d/' % server.server_address[1]
+
+        def post(path, body):
+            try:
+                response = urllib2.urlopen(url + path, json.dumps(body), 10)
+                return response.getcode(), json.loads(response.read())
+            except urllib2.HTTPError as e:
+                return e.code, json.loads(e.read())
+        try:
+            self.assertEqual((200, {'doc_id': 0, 'dups': []}), post('insert', {'doc': self.docs[1]}))
+            self.assertEqual((200, {'doc_id': 7, 'dups': [0]}), post('insert', {'doc': self.docs[4].split(), 'doc_id': 7}))
+            self.assertEqual((200, {'dups': [0, 7]}), post('query', {'doc': self.docs[1]}))
+            self.assertEqual(400, post('insert', {'doc': self.docs[1], 'doc_id': 7})[0])
+            self.assertEqual(400, post('query', {'text': self.docs[1]})[0])
+            self.assertEqual(400, post('query', {'doc': [1.5]})[0])
+            self.assertEqual(404, post('delete', {'doc': self.docs[1]})[0])
+            stats = json.loads(urllib2.urlopen(url + 'stats', timeout=10).read())
+            self.assertEqual(2, stats['num_docs'])
+            self.assertTrue('lsh_docs 2' in urllib2.urlopen(url + 'metrics', timeout=10).read())
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+            service.stop()
+
+    def testArgs(self):
+        args = lsh_app.parse_args(['--log', 'warning', 'serve', '--port', '0', '-b', '10', '-r', '3',
+                                   '--band-table', 'compact'])
+        self.assertEqual(args.command, lsh_app.serve)
+        cache = lsh_app.make_cache(args)
+        self.assertEqual((10, 3), (cache.num_bands(), cache.num_rows_per_band()))
+
+    def _expected_dups(self):
+        # the duplicates found by inserting every doc, which include docs[1] for docs[4]
+        expected = self._cache().insert_batch([doc.split() for doc in self.docs])
+        self.assertTrue(1 in expected[4])
+        return expected
+
+    def testDedupRecords(self):
+        records = [(None, doc, doc) for doc in self.docs]
+        expected = self._expected_dups()
+        dups = list(lsh_app.dedup_records(self._cache(), records, chunk_size=4))
+        self.assertEqual([{'id': doc_id, 'dups': sorted(doc_dups)} for doc_id, doc_dups in enumerate(expected)
+                          if doc_dups], dups)
+        # each doc joins the cluster of its smallest duplicate
+        clusters = list(lsh_app.dedup_records(self._cache(), records, 'clusters', chunk_size=4))
+        cluster_ids = []
+        for doc_id, doc_dups in enumerate(expected):
+            cluster_ids.append(cluster_ids[min(doc_dups)] if doc_dups else doc_id)
+        self.assertEqual(cluster_ids, [result['cluster'] for result in clusters])
+        unique = list(lsh_app.dedup_records(self._cache(), records, 'unique', chunk_size=4))
+        self.assertEqual([doc for doc, doc_dups in zip(self.docs, expected) if not doc_dups], unique)
+
+    def testDedupRecordsBounded(self):
+        records = [('r%d' % i, self.docs[i % len(self.docs)], None) for i in xrange(200)]
+        reference = LSHCache(b=25, r=4, seed=12345, max_docs=10)
+        cluster_ids = []
+        for record_id, doc, _ in records:
+            doc_dups = reference.insert(doc.split())
+            cluster_ids.append(cluster_ids[min(doc_dups)] if doc_dups else record_id)
+        results = lsh_app.dedup_records(LSHCache(b=25, r=4, seed=12345, max_docs=10), records, 'clusters',
+                                        chunk_size=4)
+        clusters = []
+        for result in results:
+            clusters.append(result['cluster'])
+            # only the ids and clusters of the documents still in the cache are kept
+            self.assertTrue(len(results.gi_frame.f_locals['ids']) <= 10)
+            self.assertTrue(len(results.gi_frame.f_locals['clusters']) <= 21)
+        self.assertEqual(cluster_ids, clusters)
+
+    def testDedup(self):
+        import json
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path, output = os.path.join(tmpdir, 'docs.jsonl'), os.path.join(tmpdir, 'dups.jsonl')
+            with open(path, 'w') as f:
+                for i, doc in enumerate(self.docs):
+                    f.write(json.dumps({'id': 'doc%d' % i, 'body': doc}) + '\n\n')
+            self.assertEqual(0, lsh_app.main(['--log', 'warning', 'dedup', path, '--format', 'jsonl',
+                                              '--text-field', 'body', '--id-field', 'id', '-o', output,
+                                              '-b', '25', '-r', '4', '--seed', '12345',
+                                              '--chunk-size', '2', '--progress', '0']))
+            with open(output) as f:
+                dups = [json.loads(line) for line in f]
+            self.assertEqual([{'id': 'doc%d' % doc_id, 'dups': ['doc%d' % dup for dup in sorted(doc_dups)]}
+                              for doc_id, doc_dups in enumerate(self._expected_dups()) if doc_dups], dups)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class MergeTest(unittest.TestCase):
+    docs = [doc.split() for doc in ["lipstick on a pig",
+                                    "you can put lipstick on a pig",
+                                    "you may put lipstick on a pig",
+                                    "they were going to send us binders full of women",
+                                    "they were going to send us binders of women",
+                                    "a b c d e f",
+                                    "a b c d e g"]]
+
+    def _split(self, **kwargs):
+        """
+        the cache of every doc and the caches of the even and of the odd docs
+        """
+        full = LSHCache(b=10, r=3, seed=42, **kwargs)
+        full.insert_batch(self.docs)
+        params = json.loads(json.dumps(full.params()))
+        even, odd = LSHCache.from_params(params), LSHCache.from_params(params)
+        for doc_id, doc in enumerate(self.docs):
+            (odd if doc_id % 2 else even).insert(doc, doc_id)
+        return full, even, odd
+
+    def _assert_same(self, expected, cache):
+        self.assertEqual(expected.num_docs(), cache.num_docs())
+        for doc in self.docs:
+            self.assertSetEqual(expected.get_dups(doc), cache.get_dups(doc))
+
+    def testParams(self):
+        cache = LSHCache(b=10, r=3, m=2, seed=42, minhash=XORHashFamily, max_docs=5)
+        params = json.loads(json.dumps(cache.params()))
+        self.assertEqual(cache.params(), LSHCache.from_params(params).params())
+        self.assertEqual(cache.params(), LSHCache(b=10, r=3, m=2, seed=42, minhash=XORHashFamily, max_docs=5).params())
+        self.assertEqual(CompactBandTable, LSHCache.from_params(params, band_table=CompactBandTable)._band_table)
+        self.assertRaises(AssertionError, LSHCache, seed=42, minhash=XORHashFamily(100, 131071))
+
+    def testMerge(self):
+        full, even, odd = self._split()
+        new_ids, pairs = even.merge(odd, find_dups=True)
+        self.assertEqual({}, new_ids)
+        self._assert_same(full, even)
+        self.assertEqual(full.max_doc_id(), even.max_doc_id())
+        self.assertEqual(sorted((doc_id, dup_id) for doc_id in (1, 3, 5)
+                                for dup_id in full.get_dups(self.docs[doc_id]) if dup_id % 2 == 0), pairs)
+        self.assertIn((5, 6), pairs)
+
+        # merging the odd docs again gives them new doc_ids
+        new_ids = even.merge(odd)
+        self.assertEqual({1: 7, 3: 8, 5: 9}, new_ids)
+        self.assertSetEqual(full.get_dups(self.docs[1]) | set([7]), even.get_dups(self.docs[1]))
+
+        self.assertRaises(AssertionError, even.merge, LSHCache(b=10, r=3, seed=43))
+        self.assertRaises(AssertionError, even.merge, LSHCache(b=10, r=3, seed=42, shingler=Shingler(3)))
+
+    @unittest.skipIf(np is None, "numpy is not installed")
+    def testMergeMinhashes(self):
+        full, even, odd = self._split(store_minhashes=True, max_docs=10)
+        even.merge(odd)
+        self._assert_same(full, even)
+        self.assertEqual(full.get_ranked_dups(self.docs[1]), even.get_ranked_dups(self.docs[1]))
+        # evicts the oldest docs to make room for the odd docs, merged again twice
+        even.merge(odd)
+        even.merge(odd)
+        self.assertEqual(10, even.num_docs())
+        self.assertFalse(even._storage.has_doc(0))
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'odd.lsh')
+            odd.save(path)
+            full, even, _ = self._split(store_minhashes=True, max_docs=10)
+            even.merge(LSHCache.from_file(path))
+            self._assert_same(full, even)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class PersistTest(unittest.TestCase):
+    docs = [doc.split() for doc in ["lipstick on a pig",
+                                    "you can put lipstick on a pig",
+                                    "they were going to send us binders full of women",
+                                    "they were going to send us binders of women",
+                                    "you may put lipstick on a pig but it's still a pig",
+                                    "a b c d e f"]]
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'cache.lsh')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _test_round_trip(self, minhash, mmap, store_signatures=False):
+        random.seed(12345)
+        cache = LSHCache(b=25, r=4, m=2, minhash=minhash, store_signatures=store_signatures)
+        cache.insert_batch(self.docs[:4])
+        cache.insert(self.docs[0], 10)
+        cache.save(self.path)
+
+        loaded = LSHCache.from_file(self.path, mmap=mmap)
+        self.assertEqual(cache.num_docs(), loaded.num_docs())
+        self.assertEqual(cache.max_doc_id(), loaded.max_doc_id())
+        self.assertEqual((25, 4, 2), (loaded.num_bands(), loaded.num_rows_per_band(), loaded.min_support()))
+        for doc in self.docs:
+            self.assertSetEqual(cache.get_dups(doc), loaded.get_dups(doc))
+        if store_signatures:
+            self.assertSetEqual(cache.get_dups(None, 1), loaded.get_dups(None, 1))
+        self.assertListEqual(cache.insert_batch(self.docs), loaded.insert_batch(self.docs))
+        self.assertEqual(cache.num_docs(), loaded.num_docs())
+        with self.assertRaises(AssertionError):
+            loaded.insert(self.docs[0], 10)
+        loaded.remove(10, self.docs[0])
+        loaded.insert(self.docs[0], 10)
+        loaded.remove(0, self.docs[0])
+        loaded.insert(self.docs[0], 0)
+
+        # a loaded (and modified) cache saves and loads the same way
+        loaded.save(self.path)
+        reloaded = LSHCache.from_file(self.path, mmap=mmap)
+        for doc in self.docs:
+            self.assertSetEqual(cache.get_dups(doc), reloaded.get_dups(doc))
+        self.assertEqual(cache.num_docs(), reloaded.num_docs())
+
+    def testRoundTrip(self):
+        for minhash in (XORHashFamily, MultiplyHashFamily):
+            for mmap in (True, False):
+                self._test_round_trip(minhash, mmap)
+                self._test_round_trip(minhash, mmap, store_signatures=True)
+
+    def testCompactRoundTrip(self):
+        cache = LSHCache(band_table=CompactBandTable)
+        cache.insert_batch(self.docs)
+        cache.save(self.path)
+        loaded = LSHCache.from_file(self.path, mmap=False)
+        self.assertTrue(isinstance(loaded._storage.tables[0], CompactBandTable))
+        for doc in self.docs:
+            self.assertSetEqual(cache.get_dups(doc), loaded.get_dups(doc))
+
+    def testMinhashRoundTrip(self):
+        for sig_bits in (None, 2):
+            random.seed(12345)
+            cache = LSHCache(store_minhashes=True, sig_bits=sig_bits)
+            cache.insert_batch(self.docs)
+            cache.save(self.path)
+            loaded = LSHCache.from_file(self.path)
+            # the signatures are used as they are mapped, without copying them
+            self.assertTrue(isinstance(loaded._minhashes._sigs, np.memmap))
+            for doc in self.docs:
+                self.assertListEqual(cache.get_ranked_dups(doc), loaded.get_ranked_dups(doc))
+            # and are mapped copy-on-write, so storing into them leaves the file as it is
+            loaded.remove(1)
+            loaded.insert(self.docs[0], 1)
+            loaded.insert(self.docs[0], 2000)
+            self.assertListEqual([(0, 1.0), (1, 1.0), (2000, 1.0)], loaded.get_ranked_dups(self.docs[0], k=3))
+            reloaded = LSHCache.from_file(self.path)
+            for doc in self.docs:
+                self.assertListEqual(cache.get_ranked_dups(doc), reloaded.get_ranked_dups(doc))
+
+    def testBoundedRoundTrip(self):
+        for mmap in (True, False):
+            cache = LSHCache(max_docs=4)
+            cache.insert_batch(self.docs)
+            cache.save(self.path)
+            loaded = LSHCache.from_file(self.path, mmap=mmap)
+            self.assertEqual(4, loaded.num_docs())
+            self.assertListEqual([2, 3, 4, 5], loaded._insert_times.keys())
+            for target in (cache, loaded):
+                target.remove(3)
+                target.insert(self.docs[0])
+                target.insert(self.docs[1])
+            self.assertListEqual(cache._insert_times.keys(), list(loaded._insert_times.iterkeys()))
+            self.assertEqual(4, loaded.num_docs())
+            self.assertFalse(loaded._storage.has_doc(2))
+            loaded.clear()
+            self.assertEqual(0, len(loaded._insert_times))
+
+    def testMappedBuckets(self):
+        cache = LSHCache(b=25, r=4)
+        cache.insert_batch(self.docs)
+        cache.save(self.path)
+        tables = LSHCache.from_file(self.path)._storage.tables
+        key, bucket = next(tables[0].iteritems())
+        num_buckets = len(tables[0])
+        tables[0].append(1, 100)
+        self.assertEqual(num_buckets + 1, len(tables[0]))
+        tables[0].remove(1, 100)
+        self.assertEqual({}, tables[0]._overlay)
+        for doc_id in bucket:
+            tables[0].remove(key, doc_id)
+        self.assertFalse(key in tables[0])
+        self.assertIsNone(tables[0].get(key))
+        self.assertEqual(num_buckets - 1, len(tables[0]))
+        self.assertFalse(key in dict(tables[0].iteritems()))
+
+    def testRollingRoundTrip(self):
+        cache = LSHCache(shingler=RollingShingler(2, 3))
+        cache.insert_batch(self.docs)
+        cache.save(self.path)
+        loaded = LSHCache.from_file(self.path)
+        self.assertTrue(isinstance(loaded.shingler(), RollingShingler))
+        for doc in self.docs:
+            self.assertSetEqual(cache.get_dups(doc), loaded.get_dups(doc))
+
+    def testEmpty(self):
+        LSHCache().save(self.path)
+        cache = LSHCache.from_file(self.path)
+        self.assertEqual(0, cache.num_docs())
+        self.assertSetEqual(set(), cache.insert(self.docs[0]))
+        self.assertSetEqual(set([0]), cache.insert(self.docs[0]))
+
+    def testUnserializable(self):
+        with self.assertRaises(ValueError):
+            LSHCache(shingle_hash=lambda shingle: 0).save(self.path)
+        with open(self.path, 'wb') as f:
+            f.write('not an lsh cache')
+        with self.assertRaises(ValueError):
+            LSHCache.from_file(self.path)
+
+
+class WriteAheadLogTest(unittest.TestCase):
+    docs = PersistTest.docs
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _assert_same(self, expected, cache):
+        self.assertEqual(expected.num_docs(), cache.num_docs())
+        self.assertEqual(expected.max_doc_id(), cache.max_doc_id())
+        for doc in self.docs:
+            self.assertSetEqual(expected.get_dups(doc), cache.get_dups(doc))
+
+    def _changes(self, cache):
+        cache.insert_batch(self.docs)
+        cache.remove(1)
+        cache.insert(self.docs[1], 10)
+
+    def testReplay(self):
+        random.seed(12345)
+        expected = LSHCache(b=10, r=3, m=2, store_minhashes=True)
+        self._changes(expected)
+        random.seed(12345)
+        crashed = wal.WriteAheadLog(self.tmpdir, fsync='always')
+        self._changes(crashed.open(b=10, r=3, m=2, store_minhashes=True))
+        # reopen the log without closing it, as after a crash
+        log = wal.WriteAheadLog(self.tmpdir)
+        random.seed(12345)
+        cache = log.open(b=10, r=3, m=2, store_minhashes=True)
+        self._assert_same(expected, cache)
+        self.assertEqual(expected.get_ranked_dups(None, 10), cache.get_ranked_dups(None, 10))
+        # changes after replaying are logged to a new segment
+        cache.clear()
+        cache.insert(self.docs[0])
+        log.close()
+        random.seed(12345)
+        cache = wal.WriteAheadLog(self.tmpdir).open(b=10, r=3, m=2, store_minhashes=True)
+        self.assertEqual(1, cache.num_docs())
+        self.assertEqual(['wal.00000000', 'wal.00000001', 'wal.00000002'], sorted(os.listdir(self.tmpdir)))
+
+    def testTornRecord(self):
+        random.seed(12345)
+        expected = LSHCache(b=10, r=3, max_docs=5)
+        self._changes(expected)
+        random.seed(12345)
+        log = wal.WriteAheadLog(self.tmpdir, fsync='never')
+        self._changes(log.open(b=10, r=3, max_docs=5))
+        log.close()
+        path = os.path.join(self.tmpdir, 'wal.00000000')
+        size = os.path.getsize(path)
+        with open(path, 'ab') as f:
+            f.write(wal._encode(wal._INSERT, 11, range(10))[:-3])
+        random.seed(12345)
+        self._assert_same(expected, wal.WriteAheadLog(self.tmpdir).open(b=10, r=3, max_docs=5))
+        self.assertEqual(size, os.path.getsize(path))
+        # a corrupt length is not read any further than the end of the file
+        with open(path, 'ab') as f:
+            f.write(wal._FRAME.pack(0xfffffff0, 0) + wal._encode(wal._INSERT, 11, range(10)))
+        self.assertEqual(size, list(wal.read_log(path))[-1])
+
+    def testGroupCommit(self):
+        log = wal.WriteAheadLog(self.tmpdir, fsync='group')
+        log.open(b=10, r=3)
+        path = os.path.join(self.tmpdir, 'wal.00000000')
+        # each change is written (and synced) by the time it is logged
+        with log.log_insert(0, range(10)):
+            pass
+        self.assertEqual(2, len(list(wal.read_log(path))))
+        syncs = []
+        fsync = wal.os.fsync
+
+        def slow_fsync(fd):
+            syncs.append(fd)
+            time.sleep(0.01)
+            fsync(fd)
+
+        def insert(start):
+            for doc_id in xrange(start, start + 20):
+                with log.log_insert(doc_id, range(10)):
+                    pass
+        wal.os.fsync = slow_fsync
+        try:
+            threads = [threading.Thread(target=insert, args=(start,)) for start in xrange(1, 81, 20)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            wal.os.fsync = fsync
+        records = list(wal.read_log(path))[:-1]
+        self.assertEqual(range(81), sorted(doc_id for _, doc_id, _, _ in records))
+        # the records logged by the threads while one of them synced were synced together
+        self.assertTrue(len(syncs) < 80)
+        log.close()
+
+    def testForest(self):
+        with self.assertRaises(ValueError):
+            wal.WriteAheadLog(self.tmpdir).open(cls=LSHForest, b=10, r=3)
+
+    def testSignatures(self):
+        # the rows of the signature of a document without shingles are sys.maxint
+        log = wal.WriteAheadLog(self.tmpdir, fsync='always')
+        log.open(b=10, r=3, shingler=_NoShingler(), store_minhashes=True).insert(self.docs[0])
+        cache = wal.WriteAheadLog(self.tmpdir).open(b=10, r=3, shingler=_NoShingler(), store_minhashes=True)
+        self.assertListEqual([sys.maxint] * 30, cache._minhashes[0])
+        for sig in ([sys.maxint, 0, 2 ** 32 - 2], [2 ** 32 - 1, 2 ** 40, sys.maxint]):
+            self.assertListEqual(sig, wal._decode(wal._encode(wal._INSERT, 0, range(3), sig)[wal._FRAME.size:])[3])
+
+    @unittest.skipIf(np is None, "numpy is not installed")
+    def testConcurrentCompaction(self):
+        log = wal.WriteAheadLog(self.tmpdir, fsync='group', compact_bytes=2000)
+        cache = log.open(b=10, r=3)
+        fsync = wal.os.fsync
+
+        def slow_fsync(fd):
+            time.sleep(0.002)
+            fsync(fd)
+
+        def insert(start):
+            for doc_id in xrange(start, start + 50):
+                cache.insert(self.docs[doc_id % len(self.docs)], doc_id)
+        wal.os.fsync = slow_fsync
+        try:
+            threads = [threading.Thread(target=insert, args=(start,)) for start in xrange(0, 200, 50)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            wal.os.fsync = fsync
+        log.close()
+        self.assertTrue(any(name.startswith('snapshot') for name in os.listdir(self.tmpdir)))
+        cache = wal.WriteAheadLog(self.tmpdir).open()
+        # every insert is in the snapshot or in the log after it, and in only one of them
+        self.assertEqual(200, cache.num_docs())
+        self.assertTrue(set(xrange(0, 200, len(self.docs))) <= cache.get_dups(self.docs[0]))
+        self.assertTrue(all(cache._storage.has_doc(doc_id) for doc_id in xrange(200)))
+        # replaying a segment again changes nothing
+        segment = os.path.join(self.tmpdir, sorted(os.listdir(self.tmpdir))[-1])
+        self.assertEqual(0, wal.replay(cache, segment))
+        self.assertEqual(200, cache.num_docs())
+
+    @unittest.skipIf(np is None, "numpy is not installed")
+    def testCompaction(self):
+        random.seed(12345)
+        expected = LSHCache(b=10, r=3, m=2, store_signatures=True)
+        random.seed(12345)
+        log = wal.WriteAheadLog(self.tmpdir, group_size=2)
+        cache = log.open(b=10, r=3, m=2, store_signatures=True)
+        for target in (expected, cache):
+            target.insert_batch(self.docs[:3])
+        self.assertTrue(log.compact())
+        self.assertEqual(['snapshot.00000001.lsh', 'wal.00000001'], sorted(os.listdir(self.tmpdir)))
+        for target in (expected, cache):
+            target.remove(0)
+            target.insert_batch(self.docs[3:])
+        log.close()
+        log = wal.WriteAheadLog(self.tmpdir, compact_bytes=1)
+        cache = log.open()
+        self._assert_same(expected, cache)
+        # compacts (in the background) on the next change, as the log holds more than a byte, to
+        # snapshot 3 as this log opened segment 2
+        for target in (expected, cache):
+            target.insert(self.docs[0], 20)
+        log.close()
+        self.assertEqual(['snapshot.00000003.lsh', 'wal.00000003'], sorted(os.listdir(self.tmpdir)))
+        self._assert_same(expected, wal.WriteAheadLog(self.tmpdir).open())
+
+
+class RedisStorageTest(unittest.TestCase):
+    docs = PersistTest.docs
+
+    def setUp(self):
+        self.server = RESPServer()
+        self.conn = RedisConnection(port=self.server.port)
+
+    def tearDown(self):
+        self.conn.close()
+        self.server.stop()
+
+    def testRedisStorage(self):
+        random.seed(12345)
+        expected = LSHCache(b=25, r=4, m=2, store_signatures=True)
+        random.seed(12345)
+        cache = LSHCache(b=25, r=4, m=2, store_signatures=True,
+                         storage=RedisStorage(self.conn, prefix='test'))
+        self.assertListEqual(expected.insert_batch(self.docs), cache.insert_batch(self.docs))
+        self.assertEqual(expected.num_docs(), cache.num_docs())
+        self.assertSetEqual(expected.get_dups(None, 1), cache.get_dups(None, 1))
+        for doc in self.docs:
+            self.assertSetEqual(expected.get_dups(doc), cache.get_dups(doc))
+        with self.assertRaises(AssertionError):
+            cache.insert(self.docs[0], 1)
+
+        # each lookup of a document is a single pipeline of one command per band
+        commands = self.server.commands
+        cache.get_dups(self.docs[0])
+        self.assertEqual(25, self.server.commands - commands)
+        # and the lookups of a batch a single pipeline for all of them
+        self.assertListEqual(map(expected.get_dups, self.docs), cache.get_dups_batch(self.docs))
+
+        # a second cache (e.g., in another process) shares the same index
+        random.seed(12345)
+        other = LSHCache(b=25, r=4, m=2, storage=RedisStorage(RedisConnection(port=self.server.port),
+                                                              prefix='test'))
+        self.assertSetEqual(expected.get_dups(self.docs[1]), other.get_dups(self.docs[1]))
+
+        cache.remove(1)
+        self.assertSetEqual(expected.get_dups(self.docs[1]) - set([1]), other.get_dups(self.docs[1]))
+        self.assertEqual(expected.num_docs() - 1, other.num_docs())
+
+        # and inserts into it, its documents given doc_ids none of the caches has given out
+        new_id = len(self.docs)
+        self.assertSetEqual(expected.get_dups(self.docs[2]) - set([1]), other.insert(self.docs[2]))
+        self.assertSetEqual(set([new_id]), cache.get_dups(self.docs[2]) - expected.get_dups(self.docs[2]))
+        cache.insert(self.docs[3])
+        self.assertEqual(new_id + 1, cache.max_doc_id())
+        # a doc_id inserted by another cache after it was checked is refused, without being added
+        # to any bucket
+        data = copy.deepcopy(self.server.data)
+        commands = self.server.commands
+        with self.assertRaises(ValueError):
+            cache._storage.insert(cache._get_lsh_from_doc(self.docs[0]), new_id)
+        self.assertEqual(data, self.server.data)
+        # and an insert is a single command
+        self.assertEqual(1, self.server.commands - commands)
+
+        cache.clear()
+        self.assertEqual(0, other.num_docs())
+        self.assertEqual({}, self.server.data)
+
+    def testErrors(self):
+        with self.assertRaises(RedisError):
+            self.conn.execute('NOSUCHCOMMAND')
+        self.assertEqual('PONG', self.conn.execute('PING'))
+        if np is not None:
+            with self.assertRaises(ValueError):
+                LSHCache(storage=RedisStorage(self.conn)).save(os.devnull)
+
+
+class ShardedStorageTest(unittest.TestCase):
+    def _docs(self):
+        rng = random.Random(1234)
+        words = map(str, xrange(200))
+        base = [[rng.choice(words) for _ in xrange(20)] for _ in xrange(50)]
+        docs = []
+        for _ in xrange(300):
+            doc = list(rng.choice(base))
+            doc[rng.randrange(20)] = 'x'
+            docs.append(doc)
+        return docs
+
+    def _test_storage(self, storage, m):
+        docs = self._docs()
+        random.seed(12345)
+        expected = LSHCache(b=10, r=3, m=m, store_signatures=True)
+        random.seed(12345)
+        cache = LSHCache(b=10, r=3, m=m, store_signatures=True, storage=storage)
+        try:
+            self.assertListEqual(expected.insert_batch(docs), cache.insert_batch(docs))
+            for doc in docs[:20]:
+                self.assertSetEqual(expected.get_dups(doc), cache.get_dups(doc))
+            for doc_id in xrange(0, 300, 7):
+                expected.remove(doc_id)
+                cache.remove(doc_id)
+            self.assertEqual(expected.num_docs(), cache.num_docs())
+            self.assertListEqual(expected.get_dups_batch(docs), cache.get_dups_batch(docs))
+            self.assertEqual(expected.stats()['bands'], cache.stats()['bands'])
+            cache.clear()
+            self.assertEqual(set(), cache.get_dups(docs[0]))
+        finally:
+            storage.close()
+
+    def testShards(self):
+        self._test_storage(ShardedStorage(3), 1)
+        # more shards than bands leaves some shards without bands
+        self._test_storage(ShardedStorage(12, band_table=CompactBandTable), 2)
+
+    def testShardServer(self):
+        import socket
+        sock = socket.socket()
+        sock.bind(('localhost', 0))
+        address = sock.getsockname()
+        sock.close()
+        server = multiprocessing.Process(target=sharding.serve_shard, args=(address, 'key'))
+        server.daemon = True
+        server.start()
+        try:
+            for _ in xrange(100):
+                try:
+                    Client(address, authkey='key').close()
+                    break
+                except socket.error:
+                    time.sleep(0.05)
+            # the probing connection was served and closed, the next one is the storage's
+            self._test_storage(ShardedStorage(addresses=[address], authkey='key'), 2)
+        finally:
+            server.terminate()
+            server.join()
+        # requests are pickled, so a shard only listens on the network with an authkey
+        with self.assertRaises(ValueError):
+            sharding.serve_shard(('0.0.0.0', 0))
+        with self.assertRaises(SystemExit):
+            sharding.main(['--listen', '0.0.0.0:0'])
+
+    def testErrors(self):
+        storage = ShardedStorage(2)
+        cache = LSHCache(b=4, r=2, storage=storage)
+        try:
+            cache.insert(['a', 'b', 'c'], 0)
+            lsh, other = cache._get_lsh_from_doc(['a', 'b', 'c']), cache._get_lsh_from_doc(['d', 'e', 'f'])
+            # removing a doc_id from buckets it is not in fails in the shards, and the bands
+            # (of any shard) it was removed from get it back
+            for mixed in (other, lsh[:2] + other[2:], [lsh[0], other[1], lsh[2], other[3]]):
+                with self.assertRaises(sharding.ShardError):
+                    storage.remove(mixed, 0)
+                self.assertEqual(1, cache.num_docs())
+                self.assertEqual([[0]] * 4, map(list, storage.get_buckets(lsh)))
+            self.assertEqual([1] * 4, map(len, storage.tables))
+            cache.remove(0, ['a', 'b', 'c'])
+            self.assertEqual(0, cache.num_docs())
+            self.assertEqual(set(), cache.get_dups(['a', 'b', 'c']))
+        finally:
+            storage.close()
+
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testLSHCreation']
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,172 @@
+'''
+A small in-process stand-in for a Redis server, speaking enough of the Redis protocol
+(RESP) for testing lsh.redis_storage
+'''
+import fnmatch
+import SocketServer
+import threading
+
+from lsh.redis_storage import _INSERT_SCRIPT
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+    def _read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        assert line[0] == '*', 'only multi-bulk commands are supported'
+        args = []
+        for _ in xrange(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    @staticmethod
+    def _encode(reply):
+        if reply is None:
+            return '$-1\r\n'
+        if isinstance(reply, bool):
+            reply = int(reply)
+        if isinstance(reply, int):
+            return ':%d\r\n' % reply
+        if isinstance(reply, Exception):
+            return '-ERR %s\r\n' % reply
+        if isinstance(reply, (list, set)):
+            return '*%d\r\n' % len(reply) + ''.join(_Handler._encode(item) for item in reply)
+        return '$%d\r\n%s\r\n' % (len(reply), reply)
+
+    def handle(self):
+        while True:
+            args = self._read_command()
+            if args is None:
+                return
+            with self.server.lock:
+                try:
+                    reply = getattr(self.server, 'cmd_' + args[0].lower())(*args[1:])
+                except Exception as e:
+                    reply = e
+            self.wfile.write(self._encode(reply))
+            self.wfile.flush()
+
+
+class RESPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        SocketServer.TCPServer.__init__(self, ('127.0.0.1', 0), _Handler)
+        self.lock = threading.Lock()
+        self.data = {}
+        self.scans = {}
+        self.next_scan = 0
+        self.commands = 0
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def _count(self):
+        self.commands += 1
+
+    def cmd_ping(self):
+        return 'PONG'
+
+    def cmd_keys(self, pattern):
+        self._count()
+        return [key for key in self.data if fnmatch.fnmatchcase(key, pattern)]
+
+    def cmd_scan(self, cursor, *args):
+        self._count()
+        options = dict(zip(args[::2], args[1::2]))
+        pattern, count = options.get('MATCH', '*'), int(options.get('COUNT', 10))
+        # a cursor is the id of a snapshot of the keys yet to be scanned
+        keys = self.scans.pop(int(cursor), None) if cursor != '0' else sorted(self.data)
+        keys, rest = keys[:count], keys[count:]
+        cursor = 0
+        if rest:
+            self.next_scan += 1
+            cursor = self.next_scan
+            self.scans[cursor] = rest
+        return [str(cursor), [key for key in keys if fnmatch.fnmatchcase(key, pattern)]]
+
+    def cmd_incr(self, key):
+        self._count()
+        self.data[key] = str(int(self.data.get(key, 0)) + 1)
+        return int(self.data[key])
+
+    def cmd_del(self, *keys):
+        self._count()
+        return sum(1 for key in keys if self.data.pop(key, None) is not None)
+
+    def cmd_sadd(self, key, *members):
+        self._count()
+        s = self.data.setdefault(key, set())
+        before = len(s)
+        s.update(members)
+        return len(s) - before
+
+    def cmd_srem(self, key, *members):
+        self._count()
+        s = self.data.get(key, set())
+        removed = len(s.intersection(members))
+        s.difference_update(members)
+        if not s:
+            self.data.pop(key, None)
+        return removed
+
+    def cmd_smembers(self, key):
+        self._count()
+        return sorted(self.data.get(key, set()))
+
+    def cmd_hset(self, key, field, value):
+        self._count()
+        h = self.data.setdefault(key, {})
+        new = field not in h
+        h[field] = value
+        return new
+
+    def cmd_hsetnx(self, key, field, value):
+        self._count()
+        h = self.data.setdefault(key, {})
+        if field in h:
+            return False
+        h[field] = value
+        return True
+
+    def cmd_hget(self, key, field):
+        self._count()
+        return self.data.get(key, {}).get(field)
+
+    def cmd_hexists(self, key, field):
+        self._count()
+        return field in self.data.get(key, {})
+
+    def cmd_hdel(self, key, *fields):
+        self._count()
+        h = self.data.get(key, {})
+        return sum(1 for field in fields if h.pop(field, None) is not None)
+
+    def cmd_eval(self, script, num_keys, *args):
+        # the scripts of lsh.redis_storage, run as python under the lock of the server
+        assert script == _INSERT_SCRIPT, 'unknown script'
+        keys, argv = args[:int(num_keys)], args[int(num_keys):]
+        commands = self.commands
+        if self.cmd_hsetnx(keys[0], argv[0], argv[1]):
+            for key in keys[1:]:
+                self.cmd_sadd(key, argv[0])
+            inserted = 1
+        else:
+            inserted = 0
+        self.commands = commands + 1
+        return inserted
+
+    def cmd_hlen(self, key):
+        self._count()
+        return len(self.data.get(key, {}))